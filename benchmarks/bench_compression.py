@@ -0,0 +1,137 @@
+"""
+Compares websocket compression settings on traffic shaped like the bot's: registering every
+account at once, then a stream of single-account refreshes. Reports bytes on the wire, CPU
+spent compressing and decompressing, and zlib memory held per connection.
+
+    python -m benchmarks.bench_compression [--accounts 100 1000] [--reloads 500]
+"""
+import argparse
+import json
+import random
+import secrets
+import time
+import urllib.parse
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import OP_TEXT, Frame
+
+import ws_defs
+from benchmarks.common import print_table
+
+# name -> `websocket.compression` settings
+PRESETS = {
+    "off": {"enabled": False},
+    "default": {},
+    "fast": {"level": 1},
+    "small window": {"client_max_window_bits": 10, "mem_level": 4},
+    "no context takeover": {"client_no_context_takeover": True},
+    "max": {"level": 9, "mem_level": 9},
+}
+
+with open("example_configuration.json") as f:
+    BOT_CONFIG = json.load(f)["bot_config"]
+
+
+def _client(i: int, rng: random.Random) -> ws_defs.WsMessageDataSendClientsClient:
+    user = {
+        "id": rng.randrange(10**9, 7 * 10**9),
+        "first_name": f"User{i}",
+        "last_name": "",
+        "username": f"user_{i}",
+        "language_code": "en",
+        "allows_write_to_pm": True,
+    }
+    web_app_data = urllib.parse.urlencode(
+        {
+            "query_id": "AA" + secrets.token_urlsafe(16),
+            "user": json.dumps(user, separators=(",", ":")),
+            "auth_date": str(1700000000 + rng.randrange(10**6)),
+            "hash": secrets.token_hex(32),
+        }
+    )
+    return ws_defs.WsMessageDataSendClientsClient(
+        name=f"account{i}",
+        proxy=f"http://login{i % 7}:{secrets.token_hex(4)}@10.0.{i // 256 % 256}.{i % 256}:8080",
+        web_app_data=web_app_data,
+        web_app_url="https://clicker.joincommunity.xyz/clicker#tgWebAppData=" + web_app_data,
+        configuration=BOT_CONFIG,
+    )
+
+
+def traffic(accounts: int, reloads: int) -> list:
+    """Encoded frames the client would send: one registration, then refreshes."""
+    rng = random.Random(accounts)
+    clients = [_client(i, rng) for i in range(accounts)]
+    frames = [
+        ws_defs.codecs.LEGACY_CODEC.encode(
+            ws_defs.WsMessage(
+                ws_defs.WsMessageTypes.MT_C_SentClients, ws_defs.WsDataSentClients(clients)
+            )
+        ).encode()
+    ]
+    for _ in range(reloads):
+        client = _client(rng.randrange(accounts), rng)
+        frames.append(
+            ws_defs.codecs.LEGACY_CODEC.encode(
+                ws_defs.WsMessage(ws_defs.WsMessageTypes.MT_C_ClientReloaded, client)
+            ).encode()
+        )
+    return frames
+
+
+def _zlib_memory(window_bits: int, mem_level: int) -> int:
+    # from zconf.h: deflate needs (1 << (windowBits+2)) + (1 << (memLevel+9)), inflate 1 << windowBits
+    return (1 << (window_bits + 2)) + (1 << (mem_level + 9)) + (1 << window_bits)
+
+
+def run(preset: str, frames: list) -> list:
+    settings = PRESETS[preset]
+    raw = sum(len(frame) for frame in frames)
+    if not settings.get("enabled", True):
+        return [preset, f"{raw / 1024:.0f} KiB", "0%", "0.000s", "0 KiB"]
+
+    window_bits = settings.get("client_max_window_bits", 15)
+    mem_level = settings.get("mem_level", 5)
+    no_context_takeover = settings.get("client_no_context_takeover", False)
+    compress_settings = {"memLevel": mem_level}
+    if "level" in settings:
+        compress_settings["level"] = settings["level"]
+    client = PerMessageDeflate(False, no_context_takeover, 15, window_bits, compress_settings)
+    server = PerMessageDeflate(no_context_takeover, False, window_bits, 15)
+
+    wire = 0
+    started = time.process_time()
+    for data in frames:
+        encoded = client.encode(Frame(OP_TEXT, data))
+        wire += len(encoded.data)
+        assert server.decode(encoded, max_size=None).data == data
+    cpu = time.process_time() - started
+
+    memory = 0 if no_context_takeover else _zlib_memory(window_bits, mem_level)
+    return [
+        preset,
+        f"{wire / 1024:.0f} KiB",
+        f"{1 - wire / raw:.0%}",
+        f"{cpu:.3f}s",
+        f"{memory / 1024:.0f} KiB",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--accounts", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--reloads", type=int, default=500)
+    parser.add_argument("--presets", nargs="+", default=list(PRESETS), choices=PRESETS)
+    args = parser.parse_args()
+
+    for accounts in args.accounts:
+        frames = traffic(accounts, args.reloads)
+        print(f"\n{accounts} accounts, {args.reloads} refreshes")
+        print_table(
+            ["settings", "on the wire", "saved", "cpu", "zlib memory/connection"],
+            [run(preset, frames) for preset in args.presets],
+        )
+
+
+if __name__ == "__main__":
+    main()
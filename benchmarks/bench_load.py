@@ -0,0 +1,119 @@
+"""
+Runs the bot against the local mock server and fake telegram with simulated accounts and
+reports how it scales: startup (authenticating every account), time until the server has
+every client, reload latency percentiles under a reload storm, time to get through a print
+flood, and the bot's resident memory.
+
+    python -m benchmarks.bench_load [--accounts 10 100 1000 10000] [--latency-ms 50]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.common import format_bytes, print_table, rss_bytes
+from mock import sandbox, telegram
+from mock.server import MockServer
+
+
+def child(args):
+    backend = telegram.FakeTelegramBackend(
+        telegram.FakeTelegramSettings(
+            latency_ms=args.latency_ms,
+            latency_jitter_ms=args.latency_ms / 2,
+            flood_wait_probability=args.flood_wait_probability,
+            flood_wait_sec=args.flood_wait_sec,
+        )
+    )
+    client = sandbox.import_client(args.child[0], args.child[1], backend)
+    asyncio.run(client.main())
+
+
+def _percentile(values: list, p: int) -> str:
+    if len(values) < 2:
+        return "n/a"
+    return f"{statistics.quantiles(values, n=100)[p - 1] * 1000:.0f}ms"
+
+
+async def run(accounts: int, args) -> list:
+    directory = sandbox.create_sandbox(accounts, json.loads(args.config))
+    server = MockServer()
+    await server.start()
+    log = open(os.path.join(directory, "client.log"), "w")
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "benchmarks.bench_load",
+            "--child", directory, server.url,
+            "--latency-ms", str(args.latency_ms),
+            "--flood-wait-probability", str(args.flood_wait_probability),
+            "--flood-wait-sec", str(args.flood_wait_sec),
+        ],
+        cwd=sandbox.REPO_DIR,
+        stdin=subprocess.DEVNULL,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        started = time.perf_counter()
+        connection = await server.connection(timeout=args.timeout)
+        startup = time.perf_counter() - started
+        registration = await connection.request_clients(timeout=args.timeout)
+        rss = rss_bytes(process.pid)
+        latencies = await connection.reload_storm(args.reloads, args.reload_concurrency)
+        flood = await connection.print_flood(args.prints)
+    except asyncio.TimeoutError:
+        print(f"{accounts} accounts: timed out, see {directory}/client.log")
+        return [accounts] + ["timeout"] * 7
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+        await server.stop()
+
+    shutil.rmtree(directory, ignore_errors=True)
+    return [
+        accounts,
+        f"{startup:.1f}s",
+        f"{registration:.2f}s",
+        _percentile(latencies, 50),
+        _percentile(latencies, 95),
+        _percentile(latencies, 99),
+        f"{flood:.2f}s",
+        format_bytes(rss),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--accounts", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--latency-ms", type=float, default=50, help="fake telegram latency")
+    parser.add_argument("--flood-wait-probability", type=float, default=0.0)
+    parser.add_argument("--flood-wait-sec", type=int, default=5)
+    parser.add_argument("--reloads", type=int, default=500)
+    parser.add_argument("--reload-concurrency", type=int, default=50)
+    parser.add_argument("--prints", type=int, default=1000)
+    parser.add_argument("--timeout", type=float, default=900)
+    parser.add_argument(
+        "--config", default="{}", help="JSON merged into the configuration, e.g. '{\"protocol\": {...}}'"
+    )
+    parser.add_argument("--child", nargs=2, metavar=("DIRECTORY", "URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    rows = [asyncio.run(run(accounts, args)) for accounts in args.accounts]
+    print_table(
+        ["accounts", "startup", "registration", "reload p50", "p95", "p99", "print flood", "rss"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
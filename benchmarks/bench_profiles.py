@@ -0,0 +1,129 @@
+"""
+Measures the per-account cost of the telegram profiles on the configured accounts:
+resident memory and CPU time while the clients sit connected for `--duration` seconds.
+Run it from the bot folder, with the bot itself stopped (it uses the same sessions).
+
+With `--mock N` it runs on N simulated accounts and fake telegram instead, which checks the
+benchmark itself and the bot's own per-account cost; the fake clients ignore the telethon
+options, so the profiles only differ on real accounts.
+
+    python -m benchmarks.bench_profiles [--profiles default minimal] [--duration 120] [--mock 100]
+"""
+import argparse
+import asyncio
+import json
+import shutil
+import subprocess
+import sys
+
+from benchmarks.common import cpu_seconds, format_bytes, print_table, rss_bytes
+
+
+def _without_profile(kwargs: dict) -> dict:
+    return {key: value for key, value in kwargs.items() if key != "profile"}
+
+
+async def measure(profile: str, duration: float, limit: int) -> dict:
+    import notcoin_client
+
+    # keep every client connected for the whole measurement
+    notcoin_client.connection_pool = None
+    accounts = notcoin_client.load_accounts()[:limit]
+    for account in accounts:
+        # from the configured layers rather than account.tg_kwargs, which already has the
+        # configured profile's preset applied as if its keys had been set explicitly
+        account.tg_kwargs = notcoin_client.resolve_tg_kwargs(
+            _without_profile(notcoin_client.configuration["tg_kwargs"]),
+            _without_profile(account.tg_kwargs_override),
+            {"profile": profile},
+        )
+
+    rss_before, cpu_before = rss_bytes(), cpu_seconds()
+    await asyncio.gather(*[account.prepare_telegram_client() for account in accounts])
+    rss_connected, cpu_connected = rss_bytes(), cpu_seconds()
+    await asyncio.sleep(duration)
+    rss_after, cpu_after = rss_bytes(), cpu_seconds()
+    for account in accounts:
+        await account.telegram_client.disconnect()
+
+    return {
+        "accounts": len(accounts),
+        "rss_connect": rss_connected - rss_before,
+        "rss_idle": rss_after - rss_connected,
+        "cpu_connect": cpu_connected - cpu_before,
+        "cpu_idle": cpu_after - cpu_connected,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profiles", nargs="+", default=["default", "minimal"])
+    parser.add_argument("--duration", type=float, default=120)
+    parser.add_argument("--accounts", type=int, default=1000, help="at most this many")
+    parser.add_argument("--mock", type=int, metavar="N", help="use N simulated accounts")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--sandbox", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.sandbox:
+            from mock import sandbox, telegram
+
+            backend = telegram.FakeTelegramBackend(
+                telegram.FakeTelegramSettings(latency_ms=0, latency_jitter_ms=0, connect_ms=0)
+            )
+            sandbox.import_client(args.sandbox, "ws://bench", backend)
+        result = asyncio.run(measure(args.child, args.duration, args.accounts))
+        print("RESULT " + json.dumps(result))
+        return
+
+    directory = None
+    if args.mock:
+        from mock import sandbox
+
+        directory = sandbox.create_sandbox(args.mock)
+    try:
+        rows = run(args, directory)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+    print_table(
+        ["profile", "accounts", "rss/account (connect)", "rss/account (idle growth)",
+         "cpu/account (connect)", "cpu/account (idle)"],
+        rows,
+    )
+
+
+def run(args, directory) -> list:
+    rows = []
+    for profile in args.profiles:
+        # a fresh process per profile, so memory of one run doesn't count towards the next
+        output = subprocess.run(
+            [
+                sys.executable, "-m", "benchmarks.bench_profiles",
+                "--child", profile,
+                "--duration", str(args.duration),
+                "--accounts", str(args.accounts),
+                *(["--sandbox", directory] if directory else []),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+        result = json.loads(output.rsplit("RESULT ", 1)[1])
+        n = max(result["accounts"], 1)
+        rows.append(
+            [
+                profile,
+                result["accounts"],
+                format_bytes(result["rss_connect"] // n),
+                format_bytes(result["rss_idle"] // n),
+                f"{result['cpu_connect'] / n * 1000:.1f} ms",
+                f"{result['cpu_idle'] / n / args.duration * 1000:.3f} ms/s",
+            ]
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+Microbenchmarks of the protocol layer: encoding and decoding every message type in
+`ws_defs.binds` with each available codec, and the cost of `WebsocketClient.process_message`
+per handled message type, with fake telegram. Compares against a saved baseline and exits
+with 1 when a case got slower, or allocates more, than the threshold.
+
+    python -m benchmarks.bench_protocol --save-baseline   # on the code before a change
+    python -m benchmarks.bench_protocol [--threshold 0.25] [--filter decode]
+"""
+import argparse
+import asyncio
+import contextlib
+import enum
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+import typing
+
+import ws_defs
+from benchmarks.common import print_table
+from ws_defs import codecs
+from ws_defs.schema import SomeWsData
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "bench_protocol.json")
+LIST_ITEMS = 100  # items in generated lists, e.g. clients in MT_C_SentClients
+ALLOC_SLACK = 256  # bytes of peak allocation growth that never count as a regression
+
+T = ws_defs.WsMessageTypes
+
+
+def sample_value(tp, depth: int = 0):
+    """A representative value of a schema field type."""
+    origin = typing.get_origin(tp)
+    if isinstance(tp, typing.ForwardRef):  # WsDataBatch's messages
+        return ws_defs.WsMessage(T.MT_S_Print, sample_data(ws_defs.WsDataPrint))
+    if tp is str:
+        return "query_id=AAHx&user=%7B%22id%22%3A1%7D&auth_date=1700000000&hash=" + "ab" * 32
+    if tp is int:
+        return 1700000000
+    if tp is bool:
+        return True
+    if tp is typing.Any:
+        return 123
+    if tp is dict or origin is dict:
+        with open(os.path.join(os.path.dirname(__file__), "..", "example_configuration.json")) as f:
+            return json.load(f)["bot_config"]
+    if origin is list:
+        (item,) = typing.get_args(tp)
+        count = LIST_ITEMS if depth == 0 else 3
+        return [sample_value(item, depth + 1) for _ in range(count)]
+    if isinstance(tp, type) and issubclass(tp, enum.Enum):
+        return list(tp)[0]
+    if isinstance(tp, type) and issubclass(tp, SomeWsData):
+        return sample_data(tp, depth + 1)
+    raise TypeError(f"No sample for {tp!r}")
+
+
+def sample_data(data_class, depth: int = 0) -> SomeWsData:
+    return data_class(
+        *[sample_value(field.type, depth) for field in data_class.__ws_fields__]
+    )
+
+
+def measure(function: typing.Callable[[], typing.Any], min_time: float) -> typing.Tuple[float, int]:
+    """Best seconds per call over a few rounds, and the peak bytes allocated by one call."""
+    function()  # warm up
+    calls = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 5:
+            break
+        calls *= 2
+    best = elapsed / calls
+    for _ in range(4):
+        started = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, (time.perf_counter() - started) / calls)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak - baseline
+
+
+def codec_cases() -> typing.Dict[str, typing.Callable[[], typing.Any]]:
+    cases = {}
+    for factory in codecs.available_codecs().values():
+        codec = factory()
+        for message_type, data_class in ws_defs.ws_defs.binds.items():
+            message = ws_defs.WsMessage(
+                message_type, sample_data(data_class) if data_class else None
+            )
+            frame = codec.encode(message)
+            cases[f"{codec.name} encode {message_type.name}"] = (
+                lambda codec=codec, message=message: codec.encode(message)
+            )
+            cases[f"{codec.name} decode {message_type.name}"] = (
+                lambda codec=codec, frame=frame: codec.decode(frame)
+            )
+    return cases
+
+
+class NullWebsocket:
+    subprotocol = None
+
+    async def send(self, frame):
+        if not isinstance(frame, (str, bytes)):
+            for _ in frame:
+                pass
+
+    async def recv(self):
+        await asyncio.Event().wait()
+
+
+def handler_case_names(accounts: int) -> typing.List[str]:
+    return [
+        "handle MT_S_Print",
+        "handle MT_S_LocaledMessage",
+        "handle MT_S_ClientFullyStopped",
+        "handle MT_S_ReloadClient",
+        f"handle MT_S_SendClients ({accounts} accounts)",
+    ]
+
+
+def handler_cases(accounts: int) -> typing.Tuple[typing.Dict[str, typing.Callable], typing.Callable]:
+    """
+    process_message cases, each running one frame through a client connected to a null
+    websocket and waiting for the handler and the reply it sends; and a cleanup function.
+    """
+    from mock import sandbox, telegram
+
+    directory = sandbox.create_sandbox(accounts)
+    backend = telegram.FakeTelegramBackend(
+        telegram.FakeTelegramSettings(latency_ms=0, latency_jitter_ms=0, connect_ms=0)
+    )
+    client_module = sandbox.import_client(directory, "ws://bench", backend)
+    # NOTCOIN_MEMORY_PROFILE turns on tracemalloc, which would slow everything down
+    tracemalloc.stop()
+    # the handlers' log lines would drown the results
+    logging.disable(logging.CRITICAL)
+
+    loop = asyncio.new_event_loop()
+    client = client_module.WebsocketClient(client_module.load_accounts(), "bench", "bench")
+    connection = loop.create_task(client.serve_connection(NullWebsocket()))
+    loop.run_until_complete(asyncio.sleep(0))
+
+    codec = codecs.LEGACY_CODEC
+    devnull = open(os.devnull, "w")
+
+    def frame(message_type, data=None):
+        return codec.encode(ws_defs.WsMessage(message_type, data))
+
+    async def handle(message):
+        """process_message, then waits for the handlers it started and the replies they queued."""
+        with contextlib.redirect_stdout(devnull):
+            await client.process_message(message)
+            while not client._send_queue.empty() or any(
+                not task.done()
+                for task in client._handlers
+                if task.get_coro().__name__ != "_write_loop"
+            ):
+                await asyncio.sleep(0)
+
+    def case(*messages):
+        """Handles the messages in turn, one per call."""
+        messages = itertools.cycle(messages)
+        return lambda: loop.run_until_complete(handle(next(messages)))
+
+    locales = {client_module.LOCALE: {f"key{i}": "Account {} has {} coins, {}" for i in range(200)}}
+    loop.run_until_complete(handle(frame(T.MS_S_Locales, ws_defs.WsDataLocales(locales))))
+    names = list(client.accounts)
+
+    cases = dict(zip(handler_case_names(accounts), [
+        case(frame(T.MT_S_Print, ws_defs.WsDataPrint("Some text", ws_defs.Color.Green))),
+        case(frame(
+            T.MT_S_LocaledMessage,
+            ws_defs.WsDataLocaledMessage("key7", ["account1", 123456, "ok"], ws_defs.Color.Blue),
+        )),
+        case(frame(T.MT_S_ClientFullyStopped, ws_defs.WsDataClientFullyStopped(names[0]))),
+        # a different account every time, so one account's cached web app data doesn't answer them all
+        case(*[frame(T.MT_S_ReloadClient, ws_defs.WsDataReloadClient(name)) for name in names]),
+        case(frame(T.MT_S_SendClients)),
+    ]))
+
+    def cleanup():
+        connection.cancel()
+        with contextlib.suppress(BaseException):
+            loop.run_until_complete(connection)
+        loop.close()
+        devnull.close()
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return cases, cleanup
+
+
+def compare(results: typing.Dict[str, typing.Tuple[float, int]], baseline: dict, threshold: float):
+    rows = []
+    regressions = []
+    for name, (seconds, peak) in results.items():
+        before = baseline.get(name)
+        time_change = alloc_change = ""
+        if before:
+            ratio = seconds / before["seconds"] - 1
+            time_change = f"{ratio:+.0%}"
+            slower = ratio > threshold
+            growth = peak - before["peak_bytes"]
+            alloc_change = f"{growth / 1024:+.1f} KiB"
+            allocates_more = growth > max(before["peak_bytes"] * threshold, ALLOC_SLACK)
+            if slower:
+                time_change += " REGRESSION"
+            if allocates_more:
+                alloc_change += " REGRESSION"
+            if slower or allocates_more:
+                regressions.append(name)
+        rows.append([
+            name,
+            f"{seconds * 1e6:.1f}us",
+            f"{1 / seconds:,.0f}/s",
+            f"{peak / 1024:.1f} KiB",
+            time_change,
+            alloc_change,
+        ])
+    print_table(
+        ["case", "per call", "throughput", "peak alloc", "time vs baseline", "alloc vs baseline"],
+        rows,
+    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--filter", default="", help="only cases whose name contains this")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to spend per case")
+    parser.add_argument("--accounts", type=int, default=100, help="accounts for MT_S_SendClients")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="allowed slowdown and peak allocation growth, 0.25 = 25%%",
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    cases = codec_cases()
+    cleanup = None
+    if any(args.filter in name for name in handler_case_names(args.accounts)):
+        handlers, cleanup = handler_cases(args.accounts)
+        cases.update(handlers)
+    try:
+        results = {
+            name: measure(function, args.min_time)
+            for name, function in cases.items()
+            if args.filter in name
+        }
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, {} if args.save_baseline else baseline, args.threshold)
+
+    if args.save_baseline:
+        # cases left out by --filter keep their saved numbers
+        baseline.update(
+            (name, {"seconds": seconds, "peak_bytes": peak}) for name, (seconds, peak) in results.items()
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(
+                baseline,
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions:
+        print(
+            f"{len(regressions)} cases are more than {args.threshold:.0%} slower, or allocate"
+            f" more, than the baseline"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares the session backends: time to open every account's session at startup,
+file descriptors held while they are open, and the cost of the small writes Telethon
+makes on every update-state change.
+
+    python -m benchmarks.bench_sessions [--accounts 100 1000 5000]
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+from telethon.crypto import AuthKey
+from telethon.sessions import SQLiteSession
+from telethon.tl import types
+
+import session_storage
+from benchmarks.common import open_fds, print_table
+
+BACKENDS = ("sqlite", "shared", "memory")
+
+
+def _fake_user(i: int) -> types.User:
+    return types.User(id=1000 + i, access_hash=i * 7919, username=f"user{i}", first_name="x")
+
+
+def _open_session(backend: str, directory: str, store, name: str):
+    if backend == "sqlite":
+        return SQLiteSession(os.path.join(directory, name))
+    return session_storage.AccountSession(store, name)
+
+
+def _touch(session, i: int):
+    session.set_update_state(
+        0,
+        types.updates.State(
+            pts=i, qts=0, date=datetime.datetime.now(tz=datetime.timezone.utc), seq=i, unread_count=0
+        ),
+    )
+    session.process_entities(types.contacts.ResolvedPeer(
+        peer=types.PeerUser(1000 + i), chats=[], users=[_fake_user(i)]
+    ))
+    session.save()
+
+
+def run(backend: str, accounts: int) -> list:
+    with tempfile.TemporaryDirectory() as directory:
+        names = [f"account{i}" for i in range(accounts)]
+
+        # create the sessions, as a previous run of the bot would have
+        store = session_storage.open_store(backend, os.path.join(directory, "sessions.db"))
+        for i, name in enumerate(names):
+            session = _open_session(backend, directory, store, name)
+            session.set_dc(2, "149.154.167.51", 443)
+            session.auth_key = AuthKey(os.urandom(256))
+            _touch(session, i)
+            session.close()
+        if store is not None:
+            store.close()
+
+        fds_before = open_fds()
+        started = time.perf_counter()
+        store = session_storage.open_store(backend, os.path.join(directory, "sessions.db"))
+        sessions = [_open_session(backend, directory, store, name) for name in names]
+        assert all(session.auth_key is not None for session in sessions)
+        startup = time.perf_counter() - started
+        fds_open = open_fds()
+
+        started = time.perf_counter()
+        for i, session in enumerate(sessions):
+            _touch(session, i + 1)
+        if store is not None:
+            store.flush()
+        writes = time.perf_counter() - started
+
+        for session in sessions:
+            session.close()
+        if store is not None:
+            store.close()
+
+        fds = "n/a" if fds_before is None else fds_open - fds_before
+        return [backend, accounts, f"{startup:.3f}s", fds, f"{writes:.3f}s"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--accounts", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    args = parser.parse_args()
+
+    rows = [run(backend, n) for n in args.accounts for backend in args.backends]
+    print_table(["backend", "accounts", "startup", "open fds", "1 update/account"], rows)
+
+
+if __name__ == "__main__":
+    main()
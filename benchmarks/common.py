@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import typing
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def open_fds() -> typing.Optional[int]:
+    """Number of open file descriptors (handles on windows), None where it can't be read."""
+    if psutil is not None:
+        process = psutil.Process()
+        return process.num_handles() if sys.platform == "win32" else process.num_fds()
+    for path in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return None
+
+
+def rss_bytes(pid: typing.Optional[int] = None) -> typing.Optional[int]:
+    """
+    Current resident set size of this process (or `pid`); for this process, the peak on
+    platforms without psutil or /proc.
+    """
+    if psutil is not None:
+        return psutil.Process(pid).memory_info().rss
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    if resource is not None and pid is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    return None
+
+
+def cpu_seconds() -> float:
+    return time.process_time()
+
+
+def format_bytes(value: typing.Optional[int]) -> str:
+    if value is None:
+        return "n/a"
+    if abs(value) < 1024 * 1024:  # per-account numbers
+        return f"{value / 1024:.1f} KiB"
+    return f"{value / 1024 / 1024:.1f} MiB"
+
+
+def print_table(headers: typing.List[str], rows: typing.List[list]):
+    widths = [
+        max(len(str(x)) for x in [header] + [row[i] for row in rows])
+        for i, header in enumerate(headers)
+    ]
+    print("  ".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(x).ljust(w) for x, w in zip(row, widths)))
@@ -0,0 +1,6 @@
+"""
+Visibility into a running bot: metrics in the Prometheus text format (`diagnostics.metrics`)
+served over a local HTTP endpoint (`diagnostics.http`), per-account spans written to a file
+(`diagnostics.tracing`), memory profiling on demand (`diagnostics.memory`), and a watchdog
+for calls that block the event loop (`diagnostics.loop_monitor`).
+"""
@@ -0,0 +1,78 @@
+"""
+A minimal HTTP server on the bot's event loop for the diagnostics endpoints, e.g. `/metrics`
+for Prometheus. GET only, one request per connection; meant to listen on localhost.
+"""
+import asyncio
+import inspect
+import logging
+import typing
+
+logger = logging.getLogger("notcoin").getChild("diagnostics")
+
+# returns (content type, body), or an awaitable of it for handlers that take a while
+Handler = typing.Callable[
+    [], typing.Union[typing.Tuple[str, str], typing.Awaitable[typing.Tuple[str, str]]]
+]
+
+_REASONS = {200: "OK", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class DiagnosticsServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 9464):
+        self.host = host
+        self.port = port
+        self.routes: typing.Dict[str, Handler] = {}
+        self._server: typing.Optional[asyncio.AbstractServer] = None
+
+    def add_route(self, path: str, handler: Handler):
+        self.routes[path] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Diagnostics on http://{self.host}:{self.port} ({', '.join(self.routes)})")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass  # headers
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2:
+                return
+            method, path = parts[0], parts[1].split("?")[0]
+            handler = self.routes.get(path)
+            if method != "GET":
+                status, content_type, body = 405, "text/plain", ""
+            elif handler is None:
+                status, content_type, body = 404, "text/plain", "\n".join(self.routes) + "\n"
+            else:
+                try:
+                    status = 200
+                    result = handler()
+                    if inspect.isawaitable(result):
+                        result = await result
+                    content_type, body = result
+                except Exception as e:
+                    logger.exception(f"Diagnostics handler for {path} failed")
+                    status, content_type, body = 500, "text/plain", f"{e!r}\n"
+            payload = body.encode()
+            writer.write(
+                (
+                    f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                    f"Content-Type: {content_type}; charset=utf-8\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode()
+                + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
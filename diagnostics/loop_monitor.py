@@ -0,0 +1,171 @@
+"""
+Watches the event loop that everything runs on (telethon, the websocket, logging) for calls
+that block it.
+
+A task on the loop wakes up every `interval_sec` and records how late it ran (the scheduling
+lag) and a heartbeat. A watchdog thread checks the heartbeat; once the loop is `slow_ms`
+behind, it samples the loop thread's stack every `sample_interval_ms` until the loop comes back,
+then logs how long it was blocked and where it spent that time.
+"""
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+import typing
+
+from diagnostics import metrics
+
+logger = logging.getLogger("notcoin").getChild("loop")
+
+LOOP_LAG_SECONDS = metrics.Histogram(
+    "notcoin_loop_lag_seconds",
+    "How late the event loop ran a timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_STALLS = metrics.Counter(
+    "notcoin_loop_stalls_total", "Times the event loop was blocked for longer than slow_ms"
+)
+LOOP_STALLED_SECONDS = metrics.Counter(
+    "notcoin_loop_stalled_seconds_total", "Time the event loop spent in those stalls"
+)
+
+STACK_DEPTH = 12
+
+
+class Stall(typing.NamedTuple):
+    started_at: float  # unix time
+    duration: float
+    samples: int
+    # (samples, formatted stack), the most common first
+    stacks: typing.List[typing.Tuple[int, str]]
+
+    def describe(self, stacks: int = 1) -> str:
+        lines = [f"Event loop was blocked for {self.duration * 1000:.0f}ms"]
+        for count, stack in self.stacks[:stacks]:
+            lines.append(f"in {count} of {self.samples} samples:\n{stack}")
+        return "\n".join(lines)
+
+
+def _short_path(filename: str) -> str:
+    return "/".join(filename.replace("\\", "/").split("/")[-2:])
+
+
+def _format_stack(frame) -> str:
+    return "\n".join(
+        f"  {_short_path(entry.filename)}:{entry.lineno} in {entry.name}"
+        for entry in traceback.extract_stack(frame, limit=STACK_DEPTH)
+    )
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        interval: float = 0.25,
+        slow_ms: float = 200,
+        sample_interval_ms: float = 20,
+        keep_stalls: int = 20,
+        stuck_sec: float = 10,
+    ):
+        self.interval = interval
+        self.slow = slow_ms / 1000
+        self.sample_interval = sample_interval_ms / 1000
+        self.stuck = stuck_sec
+        self.stalls: typing.Deque[Stall] = collections.deque(maxlen=keep_stalls)
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._loop_thread: typing.Optional[int] = None
+        self._watchdog: typing.Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    async def run(self):
+        """Measures the lag until cancelled, with the watchdog thread running alongside."""
+        loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        lag_metric = LOOP_LAG_SECONDS.labels()
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - expected)
+                self._heartbeat = time.monotonic()
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                lag_metric.observe(lag)
+        finally:
+            self._stopped.set()
+
+    def _watch(self):
+        stall_heartbeat = None
+        stall_started_at = 0.0
+        stacks: typing.Counter[str] = collections.Counter()
+        reported_stuck = False
+        while not self._stopped.wait(self.sample_interval):
+            heartbeat = self._heartbeat
+            behind = time.monotonic() - heartbeat - self.interval
+            if behind < self.slow:
+                if stall_heartbeat is not None and heartbeat != stall_heartbeat:
+                    self._stall_ended(
+                        stall_started_at, heartbeat - stall_heartbeat - self.interval, stacks
+                    )
+                    stall_heartbeat = None
+                continue
+
+            if stall_heartbeat is None:
+                stall_heartbeat = heartbeat
+                stall_started_at = time.time() - behind
+                stacks = collections.Counter()
+                reported_stuck = False
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                stacks[_format_stack(frame)] += 1
+            if behind >= self.stuck and not reported_stuck and stacks:
+                # the loop may never come back, so don't wait for it to say where it is stuck
+                reported_stuck = True
+                logger.warning(
+                    f"Event loop has been blocked for {behind:.1f}s, now in:\n"
+                    + stacks.most_common(1)[0][0]
+                )
+
+    def _stall_ended(self, started_at: float, duration: float, stacks: typing.Counter[str]):
+        stall = Stall(
+            started_at,
+            duration,
+            sum(stacks.values()),
+            [(count, stack) for stack, count in stacks.most_common()],
+        )
+        self.stalls.append(stall)
+        LOOP_STALLS.inc()
+        LOOP_STALLED_SECONDS.inc(duration)
+        logger.warning(stall.describe())
+
+    def report(self) -> str:
+        lines = [
+            f"Loop lag: last {self.last_lag * 1000:.1f}ms, max {self.max_lag * 1000:.1f}ms, "
+            f"{len(self.stalls)} recent stalls over {self.slow * 1000:.0f}ms"
+        ]
+        for stall in reversed(self.stalls):
+            started = time.strftime("%H:%M:%S", time.localtime(stall.started_at))
+            lines.append("")
+            lines.append(f"{started} " + stall.describe(stacks=3))
+        return "\n".join(lines) + "\n"
+
+
+def from_settings(settings: dict) -> typing.Optional[LoopMonitor]:
+    """A monitor for the `diagnostics.loop_monitor` settings, None if they turn it off."""
+    if not settings.get("enabled", True):
+        return None
+    return LoopMonitor(
+        settings.get("interval_sec", 0.25),
+        settings.get("slow_ms", 200),
+        settings.get("sample_interval_ms", 20),
+        settings.get("keep_stalls", 20),
+        settings.get("stuck_sec", 10),
+    )
@@ -0,0 +1,198 @@
+"""
+Memory profiling with tracemalloc, off unless asked for: tracing every allocation slows the
+whole bot down, so it is only switched on to investigate.
+
+While on, a snapshot is taken every `interval_sec` and compared with the previous one; the
+report gives the traced memory of each subsystem (telethon, websockets, ws_defs, logging, ...)
+now, since the last report and since the first one, and the allocation sites that changed
+the most. Allocations are attributed to the innermost of the `frames` traced frames that
+belongs to a known subsystem, so `json` called from telethon counts for telethon.
+"""
+import asyncio
+import logging
+import os
+import signal
+import tracemalloc
+import typing
+
+logger = logging.getLogger("notcoin").getChild("memory")
+
+ENV_VAR = "NOTCOIN_MEMORY_PROFILE"
+
+# the first of these found in the path of a file names its subsystem
+SUBSYSTEMS = (
+    "telethon",
+    "websockets",
+    "ws_defs",
+    "diagnostics",
+    "logging",
+    "colorlog",
+    "asyncio",
+    "msgpack",
+)
+MODULE_SUBSYSTEMS = {
+    "notcoin_client.py": "bot",
+    "session_storage.py": "sessions",
+    "ws_compression.py": "websockets",
+}
+
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def subsystem(filename: str) -> str:
+    parts = filename.replace("\\", "/").split("/")
+    for name in SUBSYSTEMS:
+        if name in parts:
+            return name
+    return MODULE_SUBSYSTEMS.get(parts[-1], "other")
+
+
+def traceback_subsystem(traceback: tracemalloc.Traceback) -> str:
+    """The subsystem of the innermost frame that has one, e.g. telethon for json it calls."""
+    for frame in reversed(traceback):  # most recent (innermost) frame first
+        name = subsystem(frame.filename)
+        if name != "other":
+            return name
+    return "other"
+
+
+def _format_size(size: int, sign: bool = False) -> str:
+    text = f"{abs(size) / 1024 / 1024:.1f} MiB" if abs(size) >= 1024 * 1024 else f"{abs(size) / 1024:.0f} KiB"
+    if size < 0:
+        return "-" + text
+    return ("+" if sign else "") + text
+
+
+class MemoryProfiler:
+    def __init__(
+        self,
+        interval: float = 300,
+        top: int = 10,
+        frames: int = 5,
+        count_accounts: typing.Optional[typing.Callable[[], int]] = None,
+    ):
+        self.interval = interval
+        self.top = top
+        self.frames = frames
+        self.count_accounts = count_accounts
+        self.last_report: typing.Optional[str] = None
+        self.logger = logger
+        self._previous: typing.Optional[tracemalloc.Snapshot] = None
+        self._previous_sizes: typing.Dict[str, int] = {}
+        self._started_sizes: typing.Optional[typing.Dict[str, int]] = None
+
+    @property
+    def active(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def enable(self):
+        if self.active:
+            return
+        tracemalloc.start(self.frames)
+        self._previous = None
+        self._started_sizes = None
+        self.logger.info(f"Memory profiling on, reporting every {self.interval:.0f}s")
+
+    def disable(self):
+        if not self.active:
+            return
+        tracemalloc.stop()
+        self._previous = None
+        self._started_sizes = None
+        self.logger.info("Memory profiling off")
+
+    def toggle(self):
+        if self.active:
+            self.disable()
+        else:
+            self.enable()
+
+    def install_signal_handler(self, loop: asyncio.AbstractEventLoop):
+        """`kill -USR1 <pid>` switches profiling on and off (not available on windows)."""
+        if hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, self.toggle)
+
+    def report(self, update: bool = True) -> str:
+        """
+        Takes a snapshot and describes it compared to the previous report; with `update`, it
+        becomes the report the next one is compared to. Blocks for the whole snapshot, see
+        `report_in_executor`.
+        """
+        if not self.active:
+            return (
+                f"Memory profiling is off; set {ENV_VAR}=1, diagnostics.memory.enabled "
+                "or send SIGUSR1 to switch it on"
+            )
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED)
+        traced, peak = tracemalloc.get_traced_memory()
+        sizes: typing.Dict[str, int] = {}
+        for stat in snapshot.statistics("traceback"):
+            name = traceback_subsystem(stat.traceback)
+            sizes[name] = sizes.get(name, 0) + stat.size
+        previous_sizes = self._previous_sizes if self._previous is not None else sizes
+        started_sizes = self._started_sizes if self._started_sizes is not None else sizes
+
+        total = sum(sizes.values())
+        lines = [
+            f"Memory: {_format_size(traced)} traced (peak {_format_size(peak)}), "
+            f"{_format_size(total - sum(previous_sizes.values()), sign=True)} since the last report, "
+            f"{_format_size(total - sum(started_sizes.values()), sign=True)} since the first report"
+        ]
+        accounts = self.count_accounts() if self.count_accounts is not None else 0
+        if accounts:
+            lines[0] += f"; {accounts} accounts, {_format_size(total // accounts)} each"
+        lines.append("By subsystem (now, since the last report, since the first report):")
+        for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+            lines.append(
+                f"  {name:12s} {_format_size(size):>10s} "
+                f"{_format_size(size - previous_sizes.get(name, 0), sign=True):>11s} "
+                f"{_format_size(size - started_sizes.get(name, 0), sign=True):>11s}"
+            )
+
+        if self._previous is not None:
+            lines.append("Allocation sites that changed the most since the last report:")
+            for stat in snapshot.compare_to(self._previous, "traceback")[: self.top]:
+                frame = stat.traceback[-1]
+                lines.append(
+                    f"  {_format_size(stat.size_diff, sign=True):>11s} ({stat.count_diff:+d} blocks) "
+                    f"{traceback_subsystem(stat.traceback):12s} {frame.filename}:{frame.lineno}"
+                )
+        text = "\n".join(lines)
+        if update:
+            self._previous = snapshot
+            self._previous_sizes = sizes
+            if self._started_sizes is None:
+                self._started_sizes = sizes
+            self.last_report = text
+        return text
+
+    async def report_in_executor(self, update: bool = True) -> str:
+        """`report()` in a thread, so the snapshot doesn't stop the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.report, update)
+
+    async def run(self):
+        """Logs a report every `interval` seconds while profiling is on."""
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.active:
+                self.logger.info(await self.report_in_executor())
+
+
+def from_settings(
+    settings: dict, count_accounts: typing.Optional[typing.Callable[[], int]] = None
+) -> MemoryProfiler:
+    """A profiler for the `diagnostics.memory` settings, already on if they or the env var ask."""
+    profiler = MemoryProfiler(
+        settings.get("interval_sec", 300),
+        settings.get("top", 10),
+        settings.get("frames", 5),
+        count_accounts,
+    )
+    if settings.get("enabled") or os.getenv(ENV_VAR, "").lower() in ("true", "1", "yes"):
+        profiler.enable()
+    return profiler
@@ -0,0 +1,235 @@
+"""
+A small Prometheus-style metrics registry, without the `prometheus_client` dependency.
+
+Updating a metric is an attribute increment (counters, gauges) or a bisect (histograms) on a
+child looked up once with `labels()`, so it is cheap enough for every websocket frame. Values
+that already live elsewhere, like the connection state of each account, are read at scrape
+time through a `function` instead of being kept up to date. Counters and histograms updated in
+another process are moved over with `take_changes` there and `add_changes` here.
+"""
+import abc
+import bisect
+import math
+import typing
+
+LabelValues = typing.Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: typing.Dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric"):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, names, values, value in metric.samples():
+                lines.append(
+                    f"{metric.name}{suffix}{_format_labels(names, values)} {_format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric(abc.ABC):
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: typing.Sequence[str] = (),
+        function: typing.Optional[typing.Callable[[], typing.Dict[LabelValues, float]]] = None,
+        registry: typing.Optional[Registry] = REGISTRY,
+    ):
+        """
+        `function`, if given, returns {label values: value} when scraped; the metric then
+        keeps no values of its own.
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.function = function
+        self._children: typing.Dict[LabelValues, typing.Any] = {}
+        if registry is not None:
+            registry.register(self)
+
+    @abc.abstractmethod
+    def _new_child(self):
+        return None
+
+    def labels(self, *values) -> typing.Any:
+        """The child for these label values; keep it to update it without the lookup."""
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} has labels {self.label_names}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, typing.Sequence[str], LabelValues, float]]:
+        """(name suffix, label names, label values, value) of every sample."""
+        if self.function is not None:
+            for values, value in self.function().items():
+                yield "", self.label_names, values, value
+            return
+        for values, child in list(self._children.items()):
+            yield "", self.label_names, values, child.value
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().value += amount
+
+    def take(self) -> typing.List[list]:
+        """[label values, value] of the children counted since the last take, reset to 0."""
+        changes = []
+        for values, child in list(self._children.items()):
+            if child.value:
+                changes.append([values, child.value])
+                child.value = 0
+        return changes
+
+    def add(self, values: LabelValues, value: float):
+        self.labels(*values).value += value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.labels().value = value
+
+
+class _HistogramValue:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: typing.Sequence[float]):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # counts are per bucket here, they are made cumulative when rendered
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: typing.Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(*args, **kwargs)
+
+    def _new_child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def take(self) -> typing.List[list]:
+        """[label values, [bucket counts, sum]] of the children observed since the last take."""
+        changes = []
+        for values, child in list(self._children.items()):
+            if any(child.counts):
+                changes.append([values, [child.counts, child.sum]])
+                child.counts = [0] * len(child.counts)
+                child.sum = 0.0
+        return changes
+
+    def add(self, values: LabelValues, value: list):
+        counts, total = value
+        child = self.labels(*values)
+        for i, count in enumerate(counts):
+            child.counts[i] += count
+        child.sum += total
+
+    def samples(self):
+        bucket_labels = self.label_names + ("le",)
+        for values, child in list(self._children.items()):
+            total = 0
+            for upper_bound, count in zip(self.upper_bounds + (math.inf,), child.counts):
+                total += count
+                yield "_bucket", bucket_labels, values + (_format_value(upper_bound),), total
+            yield "_sum", self.label_names, values, child.sum
+            yield "_count", self.label_names, values, total
+
+
+def take_changes(metrics: typing.Iterable[typing.Union[Counter, Histogram]]) -> dict:
+    """
+    What `metrics` counted since the last call, as JSON-friendly data for `add_changes` in
+    the process that serves them; they start again from 0 here.
+    """
+    changes = {}
+    for metric in metrics:
+        taken = metric.take()
+        if taken:
+            changes[metric.name] = taken
+    return changes
+
+
+def add_changes(changes: dict, registry: Registry = REGISTRY):
+    for name, children in changes.items():
+        metric = registry._metrics.get(name)
+        if metric is None:
+            continue
+        for values, value in children:
+            metric.add(tuple(values), value)
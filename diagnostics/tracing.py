@@ -0,0 +1,270 @@
+"""
+Opt-in tracing of what happens for each account, written as JSON lines of spans.
+
+A span is opened with `with tracing.span("name", account=...)`. Spans opened inside it, in the
+same task or in tasks started from it, become its children through a context variable, so a
+refresh requested by the server carries the request as the parent of every telegram call it
+makes. A span without a parent starts a trace.
+
+Whether a trace is written is decided when it ends: a `sample_rate` share of them, and every
+trace that took at least `slow_ms`, so the slow ones can always be looked at afterwards. Spans
+are written by a background thread; when it falls behind by `buffer_spans` spans, new ones are
+dropped and counted instead of queueing up in memory.
+
+A trace continues in another process by sending `context()` along with the request and opening
+the span there with `remote_span()`. That process writes its part to its own file, when the
+trace was picked by `sample_rate` in the first process or its own part took `slow_ms`.
+
+While tracing is off `span()` returns a shared no-op, so the instrumentation costs a call.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import typing
+
+logger = logging.getLogger("notcoin").getChild("tracing")
+
+_current: contextvars.ContextVar[typing.Optional["Span"]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def _new_id() -> str:
+    return f"{random.getrandbits(64):016x}"
+
+
+class _Trace:
+    __slots__ = ("trace_id", "sampled", "spans", "exported", "dropped")
+
+    def __init__(self, sampled: bool, trace_id: typing.Optional[str] = None):
+        self.trace_id = trace_id or _new_id()
+        self.sampled = sampled
+        self.spans: typing.List[dict] = []
+        self.exported: typing.Optional[bool] = None  # decided when the root span ends
+        self.dropped = 0
+
+
+class Span:
+    __slots__ = (
+        "tracer", "trace", "span_id", "parent_id", "root", "name", "attributes", "started", "_token"
+    )
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        parent: typing.Optional["Span"],
+        attributes: dict,
+        remote_parent: typing.Optional[dict] = None,
+    ):
+        self.tracer = tracer
+        self.name = name
+        # random rather than counted, so spans of one trace from several processes don't clash
+        self.span_id = _new_id()
+        # the first span of the trace in this process, which decides whether it is written
+        self.root = parent is None
+        if parent is not None:
+            self.trace = parent.trace
+            self.parent_id = parent.span_id
+        elif remote_parent is not None:
+            self.trace = _Trace(remote_parent["sampled"], remote_parent["trace"])
+            self.parent_id = remote_parent["span"]
+        else:
+            self.trace = _Trace(random.random() < tracer.sample_rate)
+            self.parent_id = None
+        self.attributes = attributes
+        self.started = time.time()
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.finish(exc)
+
+    def finish(self, error: typing.Optional[BaseException] = None):
+        self.tracer._finished(self, time.time() - self.started, error)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = 0.1,
+        slow_ms: float = 5000,
+        buffer_spans: int = 10000,
+        max_spans_per_trace: int = 1000,
+    ):
+        self.path = path.format(pid=os.getpid())
+        self.sample_rate = sample_rate
+        self.slow_sec = slow_ms / 1000
+        self.max_spans_per_trace = max_spans_per_trace
+        self.written = 0
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(buffer_spans)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a")
+        self._writer = threading.Thread(target=self._write_loop, name="span-writer", daemon=True)
+        self._writer.start()
+
+    def _finished(self, span: Span, duration: float, error: typing.Optional[BaseException]):
+        record = {
+            "trace": span.trace.trace_id,
+            "span": span.span_id,
+            "parent": span.parent_id,
+            "name": span.name,
+            "start": span.started,
+            "duration_ms": round(duration * 1000, 3),
+            **span.attributes,
+        }
+        if error is not None:
+            record["error"] = repr(error)
+        trace = span.trace
+
+        if trace.exported is not None:
+            # a task started in the trace outlived its root
+            if trace.exported:
+                self._export(record)
+            return
+        if len(trace.spans) < self.max_spans_per_trace or span.root:
+            trace.spans.append(record)
+        else:
+            trace.dropped += 1
+        if not span.root:
+            return
+
+        trace.exported = trace.sampled or duration >= self.slow_sec
+        if trace.exported:
+            if trace.dropped:
+                record["dropped_spans"] = trace.dropped
+            for record in trace.spans:
+                self._export(record)
+        trace.spans = []
+
+    def _export(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            lines = [record]
+            # write whatever else is already waiting in one go
+            while len(lines) < 1000:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self._write(lines)
+                    return
+                lines.append(record)
+            self._write(lines)
+
+    def _write(self, records: typing.List[dict]):
+        try:
+            self._file.write("".join(json.dumps(record, default=str) + "\n" for record in records))
+            self._file.flush()
+            self.written += len(records)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Writing spans to {self.path} failed: {e!r}")
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join(5)
+        self._file.close()
+
+
+_tracer: typing.Optional[Tracer] = None
+
+
+def configure(settings: dict) -> typing.Optional[Tracer]:
+    """Starts tracing with the `diagnostics.tracing` settings, if they enable it."""
+    global _tracer
+    if not settings.get("enabled"):
+        return None
+    _tracer = Tracer(
+        settings.get("path", "traces/spans-{pid}.jsonl"),
+        settings.get("sample_rate", 0.1),
+        settings.get("slow_ms", 5000),
+        settings.get("buffer_spans", 10000),
+        settings.get("max_spans_per_trace", 1000),
+    )
+    logger.info(f"Tracing to {_tracer.path}")
+    return _tracer
+
+
+def tracer() -> typing.Optional[Tracer]:
+    return _tracer
+
+
+def span(name: str, **attributes) -> typing.Union[Span, _NoopSpan]:
+    """A child of the current span, or the root of a new trace; use it with `with`."""
+    if _tracer is None:
+        return NOOP_SPAN
+    return Span(_tracer, name, _current.get(), attributes)
+
+
+def remote_span(
+    name: str, remote_parent: typing.Optional[dict], **attributes
+) -> typing.Union[Span, _NoopSpan]:
+    """
+    Like `span()`, continuing the trace of `remote_parent`, the `context()` of a span in
+    another process; the root of a new trace without it.
+    """
+    if _tracer is None:
+        return NOOP_SPAN
+    return Span(_tracer, name, None, attributes, remote_parent)
+
+
+def context() -> typing.Optional[dict]:
+    """The current span, for continuing its trace in another process with `remote_span()`."""
+    current = _current.get()
+    if current is None:
+        return None
+    return {"trace": current.trace.trace_id, "span": current.span_id, "sampled": current.trace.sampled}
+
+
+def start_span(name: str, **attributes) -> typing.Union[Span, _NoopSpan]:
+    """
+    A child of the current span that is finished explicitly with `finish()`, for work that
+    continues somewhere else, like a message sent by the writer task. A no-op outside a trace.
+    """
+    parent = _current.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.tracer, name, parent, attributes)
@@ -0,0 +1,47 @@
+"""
+Copies the per-account `sessions/*.session` (and `*.meta.json`) files into the shared
+session database used by the "shared" and "memory" session backends. The original files
+are kept.
+
+    python migrate_sessions.py [--sessions-dir sessions] [--target sessions/sessions.db]
+"""
+import argparse
+import os
+
+import session_storage
+
+
+def migrate(sessions_dir: str, target: str) -> int:
+    store = session_storage.open_store("shared", target)
+    migrated = 0
+    try:
+        for file in sorted(os.listdir(sessions_dir)):
+            if not file.endswith(".session"):
+                continue
+            account = file[: -len(".session")]
+            store.import_sqlite_session(account, os.path.join(sessions_dir, file))
+            metadata_path = os.path.join(sessions_dir, account + ".meta.json")
+            if os.path.isfile(metadata_path):
+                store.import_metadata(account, metadata_path)
+            print(f"Migrated {account}")
+            migrated += 1
+    finally:
+        store.close()
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions-dir", default="sessions")
+    parser.add_argument("--target", default="sessions/sessions.db")
+    args = parser.parse_args()
+
+    migrated = migrate(args.sessions_dir, args.target)
+    print(f"{migrated} sessions migrated to {args.target}.")
+    print(
+        'Set "sessions": {"backend": "shared"} (or "memory") in configuration.json to use it.'
+    )
+
+
+if __name__ == "__main__":
+    main()
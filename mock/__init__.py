@@ -0,0 +1,4 @@
+"""
+Local stand-ins for the control server (`mock.server`) and telegram (`mock.telegram`), and
+a sandbox to run the bot against them (`mock.sandbox`); used by `benchmarks.bench_load`.
+"""
@@ -0,0 +1,235 @@
+"""
+Replays a recording made with `websocket.record_path` through `WebsocketClient`, with
+fake telegram, and reports how long the client took: per-frame handling time and the
+latency of reload replies. The same recording gives the same sequence of frames every
+time, so it can be kept as a regression test for a production incident.
+
+The client gets the protocol and websocket settings saved in the recording; `--config` takes
+a configuration.json to use instead, for recordings made before they were saved.
+
+    python -m mock.replay recording.ncws [--speed 10] [--latency-ms 0] [--fail-above-ms 200]
+        [--config configuration.json]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import shutil
+import statistics
+import sys
+import time
+import typing
+
+import websockets
+
+import ws_defs
+from mock import sandbox, telegram
+from ws_defs import codecs, recording
+
+T = ws_defs.WsMessageTypes
+
+
+def split_connections(
+    frames: typing.Iterable[recording.RecordedFrame],
+) -> typing.List[typing.Tuple[typing.Optional[str], typing.List[recording.RecordedFrame]]]:
+    """(subprotocol, frames) of each recorded connection."""
+    connections = []
+    for frame in frames:
+        if frame.direction == recording.Direction.Connected:
+            connections.append((frame.payload.decode() or None, []))
+        elif connections:
+            connections[-1][1].append(frame)
+    return connections
+
+
+def _messages(codec: codecs.WsCodec, frames: typing.List[recording.RecordedFrame]):
+    """Decodes the frames, joining fragments and unpacking batches."""
+    parts = []
+    for frame in frames:
+        parts.append(frame.frame)
+        if frame.flags & recording.FLAG_FRAGMENT:
+            continue
+        message = codec.decode(parts[0][:0].join(parts))
+        parts = []
+        if message.message_type == T.MT_C_Batch:
+            yield from message.data.messages
+        else:
+            yield message
+
+
+def account_names(connections) -> typing.List[str]:
+    names = {}
+    for subprotocol, frames in connections:
+        for message in _messages(codecs.codec_for_subprotocol(subprotocol), frames):
+            data = message.data
+            if message.message_type in (T.MT_C_SentClients, T.MT_C_SentClientsChunk):
+                names.update(dict.fromkeys(client.name for client in data.clients))
+            elif message.message_type == T.MT_S_ReloadClient:
+                names[data.client_name] = None
+            elif message.message_type in (
+                T.MT_C_ClientRegistered,
+                T.MT_C_ClientReloaded,
+                T.MT_C_ClientReloadedDelta,
+            ):
+                names[data.name] = None
+    return list(names)
+
+
+class ReplayWebsocket:
+    """Feeds recorded inbound frames to the client and times its replies."""
+
+    def __init__(
+        self,
+        subprotocol: typing.Optional[str],
+        frames: typing.List[recording.RecordedFrame],
+        speed: float,
+        client,
+    ):
+        self.subprotocol = subprotocol
+        self.codec = codecs.codec_for_subprotocol(subprotocol)
+        self.inbound = [frame for frame in frames if frame.direction == recording.Direction.Inbound]
+        self.speed = speed
+        self.client = client
+        self.sent = collections.Counter()
+        self.reload_latencies: typing.List[float] = []
+        self._reloads_started: typing.Dict[str, float] = {}
+        self._started = None
+
+    async def recv(self):
+        if self._started is None:
+            self._started = time.perf_counter()
+        if not self.inbound:
+            await self._drain()
+            raise websockets.ConnectionClosedOK(None, None)
+        frame = self.inbound.pop(0)
+        if self.speed:
+            delay = self._started + frame.time / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        message = self.codec.decode(frame.frame)
+        if message.message_type == T.MT_S_ReloadClient:
+            self._reloads_started.setdefault(message.data.client_name, time.perf_counter())
+        return frame.frame
+
+    async def _drain(self):
+        """Waits until the client handled everything and its send queue is empty."""
+        while not self.client._send_queue.empty() or any(
+            not task.done()
+            for task in self.client._handlers
+            if task.get_coro().__name__ != "_write_loop"
+        ):
+            await asyncio.sleep(0.01)
+
+    async def send(self, frame):
+        if not isinstance(frame, (str, bytes)):  # fragments of one message
+            parts = list(frame)
+            frame = parts[0][:0].join(parts)
+        message = self.codec.decode(frame)
+        messages = message.data.messages if message.message_type == T.MT_C_Batch else [message]
+        for message in messages:
+            self.sent[message.message_type.name] += 1
+            if message.message_type in (T.MT_C_ClientReloaded, T.MT_C_ClientReloadedDelta):
+                started = self._reloads_started.pop(message.data.name, None)
+                if started is not None:
+                    self.reload_latencies.append(time.perf_counter() - started)
+
+
+def _percentile(values: typing.List[float], p: int) -> typing.Optional[float]:
+    if len(values) < 2:
+        return values[0] if values else None
+    return statistics.quantiles(values, n=100)[p - 1]
+
+
+async def replay(args) -> int:
+    connections = split_connections(recording.read_frames(args.recording))
+    if not connections:
+        print("The recording has no connections")
+        return 1
+    names = account_names(connections)
+    if args.config:
+        with open(args.config) as f:
+            configuration = json.load(f)
+        settings = {
+            "protocol": configuration.get("protocol") or {},
+            "websocket": configuration.get("websocket") or {},
+        }
+    else:
+        settings = recording.recorded_settings(args.recording)
+    # the replay isn't recorded again
+    settings.get("websocket", {}).pop("record_path", None)
+    directory = sandbox.create_sandbox(names, settings)
+    backend = telegram.FakeTelegramBackend(
+        telegram.FakeTelegramSettings(
+            latency_ms=args.latency_ms, latency_jitter_ms=0, connect_ms=args.latency_ms
+        )
+    )
+    client_module = sandbox.import_client(directory, "ws://replay", backend)
+    client = client_module.WebsocketClient(
+        client_module.load_accounts(), "replay", "replay"
+    )
+
+    handling_times = []
+    process_message = client.process_message
+
+    async def timed_process_message(message):
+        started = time.perf_counter()
+        await process_message(message)
+        handling_times.append(time.perf_counter() - started)
+
+    client.process_message = timed_process_message
+
+    latencies = []
+    sent = collections.Counter()
+    started = time.perf_counter()
+    try:
+        for index, (subprotocol, frames) in enumerate(connections):
+            ws = ReplayWebsocket(subprotocol, frames, args.speed, client)
+            try:
+                await client.serve_connection(ws)
+            except websockets.ConnectionClosedOK:
+                pass
+            except Exception as e:
+                print(f"Connection {index} ended with {e!r}")
+            latencies += ws.reload_latencies
+            sent += ws.sent
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    elapsed = time.perf_counter() - started
+
+    print(f"{len(connections)} connections, {len(handling_times)} frames, {len(names)} accounts, {elapsed:.2f}s")
+    if handling_times:
+        print(
+            f"frame handling: mean {statistics.mean(handling_times) * 1e6:.0f}us, "
+            f"max {max(handling_times) * 1e3:.2f}ms"
+        )
+    p95 = _percentile(latencies, 95)
+    if latencies:
+        print(
+            f"{len(latencies)} reloads: p50 {_percentile(latencies, 50) * 1e3:.1f}ms, "
+            f"p95 {p95 * 1e3:.1f}ms, p99 {_percentile(latencies, 99) * 1e3:.1f}ms"
+        )
+    print("sent: " + ", ".join(f"{name} {count}" for name, count in sorted(sent.items())))
+    print(f"fake telegram requests: {backend.requests}")
+
+    if args.fail_above_ms is not None and p95 is not None and p95 * 1e3 > args.fail_above_ms:
+        print(f"Reload p95 {p95 * 1e3:.1f}ms is above {args.fail_above_ms}ms")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("recording")
+    parser.add_argument(
+        "--speed", type=float, default=0,
+        help="1 replays in real time, 10 ten times faster, 0 (default) as fast as possible",
+    )
+    parser.add_argument("--latency-ms", type=float, default=0, help="fake telegram latency")
+    parser.add_argument("--fail-above-ms", type=float, help="exit with 1 if reload p95 is above this")
+    parser.add_argument("--config", help="configuration.json with the recording client's settings")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(replay(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+A local stand-in for the control server: speaks the `ws_defs` protocol (any codec the client
+offers, batches, chunked and incremental registration, resume) and drives scripted load:
+registration requests, reload storms and print floods, timing the client's answers.
+"""
+import asyncio
+import random
+import time
+import typing
+
+import websockets
+
+import ws_defs
+from ws_defs import codecs
+
+T = ws_defs.WsMessageTypes
+
+LOCALES = {"en": {"bench.print": "Mock message {} of {}"}}
+
+
+class MockConnection:
+    def __init__(self, ws: websockets.WebSocketServerProtocol):
+        self.ws = ws
+        self.codec = codecs.codec_for_subprotocol(ws.subprotocol)
+        self.connected_at = time.monotonic()
+        self.clients: typing.Dict[str, ws_defs.SomeWsData] = {}
+        self.profiles: typing.Dict[str, dict] = {}
+        self.received_messages = 0
+        self.received_bytes = 0
+        self._registration: typing.Optional[asyncio.Future] = None
+        self._reloads: typing.Dict[str, typing.List[asyncio.Future]] = {}
+        self.closed = asyncio.get_running_loop().create_future()
+
+    async def send(self, message_type: T, data: typing.Optional[ws_defs.SomeWsData] = None):
+        await self.ws.send(self.codec.encode(ws_defs.WsMessage(message_type, data)))
+
+    async def serve(self):
+        await self.send(T.MS_S_Locales, ws_defs.WsDataLocales(LOCALES))
+        try:
+            async for frame in self.ws:
+                self.received_bytes += len(frame)
+                self._handle(self.codec.decode(frame))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if not self.closed.done():
+                self.closed.set_result(None)
+
+    def _handle(self, msg: ws_defs.WsMessage):
+        self.received_messages += 1
+        data = msg.data
+        if msg.message_type == T.MT_C_Batch:
+            for message in data.messages:
+                self._handle(message)
+        elif msg.message_type == T.MT_C_ConfigProfiles:
+            self.profiles.update(data.profiles)
+        elif msg.message_type in (T.MT_C_SentClients, T.MT_C_SentClientsChunk):
+            for client in data.clients:
+                self.clients[client.name] = client
+            if msg.message_type == T.MT_C_SentClients or data.last:
+                self._registered()
+        elif msg.message_type == T.MT_C_ClientRegistered:
+            self.clients[data.name] = data
+        elif msg.message_type == T.MT_C_RegistrationComplete:
+            self._registered()
+        elif msg.message_type in (T.MT_C_ClientReloaded, T.MT_C_ClientReloadedDelta):
+            if msg.message_type == T.MT_C_ClientReloaded:
+                self.clients[data.name] = data
+            for future in self._reloads.pop(data.name, []):
+                if not future.done():
+                    future.set_result(None)
+        elif msg.message_type == T.MT_C_ResumeClients:
+            # this server keeps nothing between connections, everything is stale
+            asyncio.ensure_future(
+                self.send(T.MT_S_ResumeAccepted, ws_defs.WsDataResumeAccepted(list(data.clients)))
+            )
+
+    def _registered(self):
+        if self._registration is not None and not self._registration.done():
+            self._registration.set_result(None)
+
+    async def request_clients(self, timeout: float = 600) -> float:
+        """Sends MT_S_SendClients, returns the seconds until every client was registered."""
+        self.clients.clear()
+        self._registration = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        await self.send(T.MT_S_SendClients)
+        await asyncio.wait_for(self._registration, timeout)
+        return time.perf_counter() - started
+
+    async def reload(self, name: str, timeout: float = 120) -> float:
+        """Asks the client to reload `name`, returns the seconds until the reply arrived."""
+        future = asyncio.get_running_loop().create_future()
+        self._reloads.setdefault(name, []).append(future)
+        started = time.perf_counter()
+        await self.send(T.MT_S_ReloadClient, ws_defs.WsDataReloadClient(name))
+        await asyncio.wait_for(future, timeout)
+        return time.perf_counter() - started
+
+    async def reload_storm(
+        self, count: int, concurrency: int, names: typing.Optional[typing.List[str]] = None
+    ) -> typing.List[float]:
+        """`count` reloads of random clients, `concurrency` at a time; returns their latencies."""
+        names = names or list(self.clients)
+        rng = random.Random(count)
+        slots = asyncio.Semaphore(concurrency)
+
+        async def one() -> float:
+            async with slots:
+                return await self.reload(rng.choice(names))
+
+        return list(await asyncio.gather(*[one() for _ in range(count)]))
+
+    async def print_flood(self, count: int) -> float:
+        """
+        Sends `count` localed print messages followed by a reload, and returns the seconds
+        until the reload came back, i.e. until the client got through the flood.
+        """
+        started = time.perf_counter()
+        for i in range(count):
+            await self.send(
+                T.MT_S_LocaledMessage,
+                ws_defs.WsDataLocaledMessage("bench.print", [i + 1, count], ws_defs.Color.None_),
+            )
+        await self.reload(next(iter(self.clients)))
+        return time.perf_counter() - started
+
+
+class MockServer:
+    """Accepts one client connection at a time and hands it to whoever awaits `connection()`."""
+
+    def __init__(self, host: str = "localhost", port: int = 0):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._connections: asyncio.Queue = asyncio.Queue()
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}/client_request"
+
+    async def start(self):
+        subprotocols = [
+            codec().subprotocol for codec in codecs.available_codecs().values()
+        ]
+        self._server = await websockets.serve(
+            self._serve, self.host, self.port, max_size=None, subprotocols=subprotocols
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, ws: websockets.WebSocketServerProtocol):
+        connection = MockConnection(ws)
+        await self._connections.put(connection)
+        await connection.serve()
+
+    async def connection(self, timeout: typing.Optional[float] = None) -> MockConnection:
+        return await asyncio.wait_for(self._connections.get(), timeout)
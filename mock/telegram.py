@@ -0,0 +1,147 @@
+"""
+A stand-in for `TelegramClient` that answers the few calls the bot makes without any network,
+with configurable latency and flood waits.
+"""
+import asyncio
+import dataclasses
+import random
+import time
+import types
+import typing
+import urllib.parse
+import zlib
+
+import telethon.errors
+import telethon.tl.functions.messages
+import telethon.tl.types
+
+BOT_ID = 6461526770
+BOT_ACCESS_HASH = 1234567890123456789
+WEBVIEW_URL = "https://clicker.joincommunity.xyz/clicker"
+
+
+@dataclasses.dataclass
+class FakeTelegramSettings:
+    latency_ms: float = 50  # mean latency of a request
+    latency_jitter_ms: float = 25  # uniform +- around the mean
+    flood_wait_probability: float = 0.0  # chance that a request gets a FloodWaitError
+    flood_wait_sec: int = 5
+    connect_ms: float = 100
+
+
+class FakeTelegramBackend:
+    """Shared by all fake clients of a process: settings and request counters."""
+
+    def __init__(self, settings: typing.Optional[FakeTelegramSettings] = None):
+        self.settings = settings or FakeTelegramSettings()
+        self.requests = 0
+        self.flood_waits = 0
+        self._random = random.Random(0)
+
+    async def delay(self, ms: float):
+        jitter = self.settings.latency_jitter_ms
+        await asyncio.sleep(max(0.0, ms + self._random.uniform(-jitter, jitter)) / 1000)
+
+    def client_factory(self) -> typing.Callable[..., "FakeTelegramClient"]:
+        """A replacement for `notcoin_client.telegram_client_factory`."""
+
+        def make_client(session, **kwargs) -> FakeTelegramClient:
+            return FakeTelegramClient(self, session, **kwargs)
+
+        return make_client
+
+
+def user_id_for(session) -> int:
+    """A stable fake user id per account, for file (`sessions/<name>`) and shared sessions alike."""
+    if isinstance(session, str):
+        name = session.rsplit("/", 1)[-1]
+    else:
+        name = getattr(session, "account", "")
+    return 10**9 + zlib.crc32(name.encode())
+
+
+class FakeTelegramClient:
+    def __init__(self, backend: FakeTelegramBackend, session, **kwargs):
+        self.backend = backend
+        self.session = session
+        self.flood_sleep_threshold = kwargs.get("flood_sleep_threshold", 60)
+        self.user_id = user_id_for(session)
+        self._connected = False
+        self._handlers = []
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def connect(self):
+        await self.backend.delay(self.backend.settings.connect_ms)
+        self._connected = True
+
+    async def disconnect(self):
+        self._connected = False
+
+    async def _request(self):
+        if not self._connected:
+            raise ConnectionError("Cannot send requests while disconnected")
+        self.backend.requests += 1
+        await self.backend.delay(self.backend.settings.latency_ms)
+        if self.backend._random.random() < self.backend.settings.flood_wait_probability:
+            self.backend.flood_waits += 1
+            seconds = self.backend.settings.flood_wait_sec
+            # like telethon, short flood waits are slept through instead of raised
+            if seconds > self.flood_sleep_threshold:
+                raise telethon.errors.FloodWaitError(request=None, capture=seconds)
+            await asyncio.sleep(seconds)
+
+    async def is_user_authorized(self) -> bool:
+        await self._request()
+        return True
+
+    async def get_me(self) -> telethon.tl.types.User:
+        await self._request()
+        return telethon.tl.types.User(id=self.user_id, first_name="Fake", access_hash=1)
+
+    async def get_entity(self, entity) -> telethon.tl.types.User:
+        await self._request()
+        return telethon.tl.types.User(
+            id=BOT_ID, access_hash=BOT_ACCESS_HASH, bot=True, username="notcoin_bot"
+        )
+
+    async def get_input_entity(self, entity) -> telethon.tl.types.InputPeerUser:
+        return telethon.tl.types.InputPeerUser(BOT_ID, BOT_ACCESS_HASH)
+
+    async def get_messages(self, entity=None, **kwargs) -> list:
+        await self._request()
+        button_type = getattr(telethon.tl.types, "KeyboardButtonWebView", None)
+        if button_type is None:  # renamed in newer layers, only the warm path works there
+            return []
+        button = types.SimpleNamespace(button=button_type(text="Play", url=WEBVIEW_URL))
+        return [types.SimpleNamespace(buttons=[[button]])]
+
+    async def send_message(self, entity, message, **kwargs):
+        await self._request()
+
+    def add_event_handler(self, callback, event=None):
+        self._handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self._handlers.remove((callback, event))
+
+    async def __call__(self, request):
+        await self._request()
+        if isinstance(request, telethon.tl.functions.messages.RequestWebViewRequest):
+            return types.SimpleNamespace(url=self._webview_url(request.url))
+        raise NotImplementedError(f"{type(request).__name__} is not faked")
+
+    def _webview_url(self, url: str) -> str:
+        user = '{"id":%d,"first_name":"Fake","language_code":"en"}' % self.user_id
+        web_app_data = urllib.parse.urlencode(
+            {
+                "query_id": "AAF" + "%016x" % random.getrandbits(64),
+                "user": user,
+                "auth_date": str(int(time.time())),
+                "hash": "%064x" % random.getrandbits(256),
+            }
+        )
+        return url + "#" + urllib.parse.urlencode(
+            {"tgWebAppData": web_app_data, "tgWebAppVersion": "7.0", "tgWebAppPlatform": "android"}
+        )
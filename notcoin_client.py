@@ -6,18 +6,29 @@ if not os.path.isfile("configuration.json"):
     configure_main()
 
 import asyncio
+import collections
+import contextlib
+import itertools
 import logging
 import json
+import multiprocessing
 import python_socks
 import sys
 import io
 import datetime
+import time
 import qrcode
-import tracemalloc
+import random
+import signal
 import websockets
 import ws_defs
+import ws_compression
+from ws_defs import recording
+import session_storage
+from diagnostics import http as diagnostics_http, loop_monitor, memory, metrics, tracing
 import typing
 import telethon
+import telethon.events
 import telethon.tl.patched
 import telethon.tl.types
 import telethon.tl.custom.messagebutton
@@ -38,8 +49,6 @@ def exit_after_enter():
 # you will still be forced to use proxy regardless of this variable value, as it will be enforced on server side.
 IS_DEBUG = os.getenv("NOTCOIN_DEBUG", "").lower() in ("true", "1", "yes")
 
-tracemalloc.start()
-
 NO_COLOR_MODE = os.getenv("NO_COLOR", "").lower() in ("true", "1", "yes")
 # logging level for 3rd party libraries
 GLOBAL_LOGGING_LEVEL = logging.WARN
@@ -102,30 +111,424 @@ if not os.path.isfile("configuration.json"):
 with open("configuration.json") as f:
     configuration = json.load(f)
 
-if not os.path.isfile("license.txt"):
-    logger.error(
-        "license.txt not found. Create `license.txt` and put your license there."
-    )
-    exit_after_enter()
+del f
 
-with open("license.txt") as f:
-    license_key = f.read().strip()
 
-del f
+def read_license(path: str = "license.txt") -> str:
+    if not os.path.isfile(path):
+        logger.error(f"{path} not found. Create `{path}` and put your license there.")
+        exit_after_enter()
+
+    with open(path) as license_file:
+        return license_file.read().strip()
+
+
+# each shard is a separate websocket connection with its own license and accounts
+SHARDS_CONFIG: typing.List[dict] = configuration.get("shards") or []
+license_key = None if SHARDS_CONFIG else read_license()
+
+
+SESSIONS_CONFIG = configuration.get("sessions") or {}
+session_store = session_storage.open_store(
+    SESSIONS_CONFIG.get("backend", "sqlite"),
+    SESSIONS_CONFIG.get("path", "sessions/sessions.db"),
+)
+
+
+DIAGNOSTICS_CONFIG = configuration.get("diagnostics") or {}
+tracing.configure(DIAGNOSTICS_CONFIG.get("tracing") or {})
+# started right away when enabled, so allocations made while starting up are traced too
+memory_profiler = memory.from_settings(DIAGNOSTICS_CONFIG.get("memory") or {})
+event_loop_monitor = loop_monitor.from_settings(DIAGNOSTICS_CONFIG.get("loop_monitor") or {})
+# updated on the hot path, so children are looked up once and kept where possible
+WEBAPP_DATA_SECONDS = metrics.Histogram(
+    "notcoin_webapp_data_fetch_seconds",
+    "Time to get web app data from telegram (cache misses)",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+WEBAPP_DATA_CACHE_HITS = metrics.Counter(
+    "notcoin_webapp_data_cache_hits_total", "Web app data requests answered from the cache"
+)
+WEBAPP_DATA_ERRORS = metrics.Counter(
+    "notcoin_webapp_data_errors_total", "Failed web app data requests", ["error"]
+)
+FLOOD_WAITS = metrics.Counter(
+    "notcoin_flood_waits_total", "FloodWait errors telegram returned for web app data requests"
+)
+FLOOD_WAIT_SECONDS = metrics.Counter(
+    "notcoin_flood_wait_seconds_total", "Seconds telegram asked to wait in those FloodWait errors"
+)
+# recorded where the telegram clients are, which with workers is not the main process
+WORKER_METRICS = (
+    WEBAPP_DATA_SECONDS,
+    WEBAPP_DATA_CACHE_HITS,
+    WEBAPP_DATA_ERRORS,
+    FLOOD_WAITS,
+    FLOOD_WAIT_SECONDS,
+)
+WS_MESSAGES = metrics.Counter(
+    "notcoin_ws_messages_total", "Websocket messages", ["shard", "direction", "type"]
+)
+WS_FRAME_SIZE = metrics.Counter(
+    "notcoin_ws_frame_size_total",
+    "Size of websocket frames before compression (bytes of binary, characters of text frames)",
+    ["shard", "direction"],
+)
+WS_SEND_SECONDS = metrics.Histogram(
+    "notcoin_ws_send_seconds",
+    "Time to hand a message to the websocket, i.e. waiting for the server to read",
+    ["shard"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
 
 
 class ServerNotRunningException(Exception):
     pass
 
 
-async def execute_tasks_in_chunks(
-    tasks: list,
-    chunk_size: int,
+class LicenseRejectedException(Exception):
+    """The server refused the license; reconnecting won't help."""
+
+
+class AdaptiveTaskScheduler:
+    """
+    Runs coroutines through a work queue, keeping up to `concurrency` of them in flight.
+
+    The limit is adjusted after every completed task: it grows by one after a full window of
+    successful tasks, and is halved when a task fails or takes much longer than the moving
+    average latency (which is what FloodWait sleeps and dead proxies look like). Every task
+    counts towards the average, so it follows a new normal latency instead of halving on each
+    task, and it is never taken as lower than `latency_floor`, so cache hits answered in
+    microseconds don't make every real request look slow. After halving, the limit is not
+    halved again until the tasks in flight at the time have completed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_concurrency: int = 5,
+        min_concurrency: int = 1,
+        max_concurrency: int = 50,
+        slow_factor: float = 3.0,
+        progress_interval: float = 5.0,
+        latency_floor: float = 0.05,
+    ):
+        self.name = name
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.concurrency = min(
+            max(initial_concurrency, self.min_concurrency), self.max_concurrency
+        )
+        self.slow_factor = slow_factor
+        self.latency_floor = latency_floor
+        self.progress_interval = progress_interval
+        self.logger = logger.getChild("scheduler").getChild(name)
+        self.timings: typing.Dict[str, float] = {}
+        self._average_latency: typing.Optional[float] = None
+        self._successes_in_window = 0
+        self._completed = 0
+        # completions to wait for before the limit may be halved again
+        self._no_decrease_until = 0
+
+    def _on_task_finished(self, elapsed: float, failed: bool):
+        slow = (
+            self._average_latency is not None
+            and elapsed > max(self._average_latency, self.latency_floor) * self.slow_factor
+        )
+        if self._average_latency is None:
+            self._average_latency = elapsed
+        else:
+            self._average_latency += (elapsed - self._average_latency) * 0.2
+        self._completed += 1
+
+        if failed or slow:
+            # the tasks already in flight were started under the old limit, their
+            # failures or slowness are the same congestion and mustn't halve it again
+            if self._completed >= self._no_decrease_until:
+                self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+                self._no_decrease_until = self._completed + self.concurrency * 2
+            self._successes_in_window = 0
+            return
+
+        self._successes_in_window += 1
+        if self._successes_in_window >= self.concurrency:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self._successes_in_window = 0
+
+    async def _timed(
+        self,
+        index: int,
+        label: str,
+        coro: typing.Awaitable,
+        on_result: typing.Optional[typing.Callable[[int, typing.Any], typing.Awaitable]],
+    ):
+        start = time.monotonic()
+        try:
+            result = await coro
+        finally:
+            self.timings[label] = time.monotonic() - start
+        if on_result is not None:
+            await on_result(index, result)
+        return result
+
+    async def run(
+        self,
+        tasks: typing.List[typing.Awaitable],
+        labels: typing.Optional[typing.List[str]] = None,
+        return_exceptions: bool = False,
+        on_result: typing.Optional[
+            typing.Callable[[int, typing.Any], typing.Awaitable]
+        ] = None,
+    ) -> list:
+        """
+        Awaits all `tasks` and returns their results in the same order, like `asyncio.gather`.
+        With `return_exceptions=False` the first error cancels the remaining tasks and is re-raised.
+        `on_result(index, result)` is awaited as soon as each task succeeds.
+        """
+        if labels is None:
+            labels = [str(i) for i in range(len(tasks))]
+        results: list = [None] * len(tasks)
+        queue = collections.deque(enumerate(tasks))
+        in_flight: typing.Dict[asyncio.Task, int] = {}
+        started_at = time.monotonic()
+        last_progress = started_at
+        done_count = 0
+
+        try:
+            while queue or in_flight:
+                while queue and len(in_flight) < self.concurrency:
+                    index, coro = queue.popleft()
+                    task = asyncio.ensure_future(
+                        self._timed(index, labels[index], coro, on_result)
+                    )
+                    in_flight[task] = index
+
+                done, _ = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    index = in_flight.pop(task)
+                    done_count += 1
+                    error = task.exception()
+                    self._on_task_finished(
+                        self.timings.get(labels[index], 0.0), error is not None
+                    )
+                    if error is None:
+                        results[index] = task.result()
+                    elif return_exceptions:
+                        results[index] = error
+                    else:
+                        raise error
+
+                now = time.monotonic()
+                if now - last_progress >= self.progress_interval and (
+                    queue or in_flight
+                ):
+                    last_progress = now
+                    self.logger.info(
+                        f"Progress: {done_count}/{len(tasks)} done, {len(in_flight)} in flight, "
+                        f"concurrency {self.concurrency}"
+                    )
+        finally:
+            for task in in_flight:
+                task.cancel()
+            for _, coro in queue:
+                if asyncio.iscoroutine(coro):
+                    coro.close()
+
+        if self.timings:
+            slowest = sorted(self.timings.items(), key=lambda x: x[1], reverse=True)
+            self.logger.info(
+                f"{len(tasks)} tasks done in {time.monotonic() - started_at:.2f}s, "
+                f"final concurrency {self.concurrency}, slowest: "
+                + ", ".join(f"{label} {elapsed:.2f}s" for label, elapsed in slowest[:5])
+            )
+        return results
+
+
+async def execute_tasks_adaptive(
+    name: str,
+    tasks: typing.List[typing.Awaitable],
+    labels: typing.Optional[typing.List[str]] = None,
+    return_exceptions: bool = False,
+    on_result: typing.Optional[typing.Callable[[int, typing.Any], typing.Awaitable]] = None,
 ) -> list:
-    results = []
-    for i in range(0, len(tasks), chunk_size):
-        results += await asyncio.gather(*tasks[i : i + chunk_size])
-    return results
+    scheduler_config = configuration.get("scheduler") or {}
+    scheduler = AdaptiveTaskScheduler(
+        name,
+        initial_concurrency=scheduler_config.get("initial_concurrency", 5),
+        min_concurrency=scheduler_config.get("min_concurrency", 1),
+        max_concurrency=scheduler_config.get("max_concurrency", 50),
+        slow_factor=scheduler_config.get("slow_factor", 3.0),
+        progress_interval=scheduler_config.get("progress_interval_sec", 5.0),
+        latency_floor=scheduler_config.get("latency_floor_sec", 0.05),
+    )
+    return await scheduler.run(tasks, labels, return_exceptions, on_result)
+
+
+WEBAPP_CACHE_CONFIG = configuration.get("webapp_cache") or {}
+START_HANDSHAKE_CONFIG = configuration.get("start_handshake") or {}
+WEBVIEW_THEME_PARAMS = (
+    '{"accent_text_color":"#ed8abf","bg_color":"#25181f",'
+    '"button_color":"#aa6085","button_text_color":"#ffffff",'
+    '"destructive_text_color":"#ec3942","header_bg_color":"#25181f",'
+    '"hint_color":"#866b79","link_color":"#ee89bf",'
+    '"secondary_bg_color":"#34242b","section_bg_color":"#25181f",'
+    '"section_header_text_color":"#ee89bf","subtitle_text_color":"#866b79",'
+    '"text_color":"#f5f5f5"}'
+)
+# what RequestWebView answers when the cached bot id, access hash or web app url went stale;
+# anything else (FloodWait, server errors) is not about the cache and mustn't throw it away
+STALE_BOT_DATA_ERRORS = (
+    telethon.errors.PeerIdInvalidError,
+    telethon.errors.UserIdInvalidError,
+    telethon.errors.InputUserDeactivatedError,
+    telethon.errors.BotInvalidError,
+    telethon.errors.UrlInvalidError,
+)
+
+
+class TelegramConnectionPool:
+    """
+    Limits how many telegram connections are open at once. Connections that are not used
+    for `idle_timeout` seconds are closed, and when the limit is reached the connection
+    idle for the longest time is closed to make room.
+    """
+
+    def __init__(self, max_open: int, idle_timeout: float):
+        self.logger = logger.getChild("connections")
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self._open: typing.Set["NotCoinAccountClient"] = set()
+        self._users: typing.Dict["NotCoinAccountClient", int] = {}
+        self._idle: typing.OrderedDict[
+            "NotCoinAccountClient", asyncio.TimerHandle
+        ] = collections.OrderedDict()
+        self._closing: typing.Dict["NotCoinAccountClient", asyncio.Task] = {}
+        self._opening: typing.Dict["NotCoinAccountClient", asyncio.Task] = {}
+        self._waiters: typing.List[asyncio.Future] = []
+
+    @property
+    def open_connections(self) -> int:
+        return len(self._open)
+
+    def _wake_waiters(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def acquire(self, account: "NotCoinAccountClient"):
+        self._users[account] = self._users.get(account, 0) + 1
+        idle_timer = self._idle.pop(account, None)
+        if idle_timer is not None:
+            idle_timer.cancel()
+        if account in self._open:
+            return
+
+        # concurrent users of one account share a single wait for a slot
+        if account not in self._opening:
+            self._opening[account] = asyncio.ensure_future(self._take_slot(account))
+        try:
+            await asyncio.shield(self._opening[account])
+        except BaseException:
+            self.release(account)
+            raise
+
+    async def _take_slot(self, account: "NotCoinAccountClient"):
+        try:
+            while True:
+                if account in self._closing:
+                    await asyncio.shield(self._closing[account])
+                elif len(self._open) < self.max_open:
+                    self._open.add(account)
+                    break
+                elif self._idle:
+                    victim, victim_timer = self._idle.popitem(last=False)
+                    victim_timer.cancel()
+                    self._close(victim)
+                else:
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+                    await waiter
+        finally:
+            del self._opening[account]
+        if account not in self._users:
+            # every user gave up while waiting
+            self._mark_idle(account)
+
+    def release(self, account: "NotCoinAccountClient"):
+        self._users[account] -= 1
+        if self._users[account] > 0:
+            return
+        del self._users[account]
+        if account in self._open:
+            self._mark_idle(account)
+
+    def _mark_idle(self, account: "NotCoinAccountClient"):
+        self._idle[account] = asyncio.get_running_loop().call_later(
+            self.idle_timeout, self._close_idle, account
+        )
+        # a waiter may evict it right away instead of waiting for the timer
+        self._wake_waiters()
+
+    def _close_idle(self, account: "NotCoinAccountClient"):
+        if self._idle.pop(account, None) is not None:
+            self._close(account)
+
+    def _close(self, account: "NotCoinAccountClient"):
+        self._open.discard(account)
+        task = asyncio.ensure_future(account.telegram_client.disconnect())
+        self._closing[account] = task
+
+        def on_closed(_):
+            self._closing.pop(account, None)
+            self._wake_waiters()
+
+        task.add_done_callback(on_closed)
+        self.logger.debug(f"Closed idle telegram connection of {account.name}")
+
+
+# presets selected with "profile" in tg_kwargs / tg_kwargs_override, explicit keys win
+TELETHON_PROFILES = {
+    "default": {},
+    # we only need telegram for web app data: no update stream, small entity cache
+    "minimal": {
+        "receive_updates": False,
+        "catch_up": False,
+        "sequential_updates": False,
+        "entity_cache_limit": 100,
+    },
+}
+
+
+def resolve_tg_kwargs(*layers: dict) -> dict:
+    kwargs = {}
+    for layer in layers:
+        kwargs.update(layer)
+    profile = kwargs.pop("profile", "default")
+    if profile not in TELETHON_PROFILES:
+        raise ValueError(
+            f"Unknown telegram profile {profile}! Possible profiles: "
+            + ", ".join(TELETHON_PROFILES)
+        )
+    return {**TELETHON_PROFILES[profile], **kwargs}
+
+
+CONNECTIONS_CONFIG = configuration.get("connections") or {}
+connection_pool: typing.Optional[TelegramConnectionPool] = None
+if CONNECTIONS_CONFIG.get("mode", "persistent") == "on_demand":
+    connection_pool = TelegramConnectionPool(
+        CONNECTIONS_CONFIG.get("max_open", 50),
+        CONNECTIONS_CONFIG.get("idle_disconnect_sec", 300),
+    )
+
+
+# what account clients are created with; the mock package swaps in a fake for load tests
+telegram_client_factory: typing.Callable[..., TelegramClient] = TelegramClient
+# called first in every worker process, where the swaps above have to be made again; must
+# be picklable, e.g. a module-level function
+worker_initializer: typing.Optional[typing.Callable[[], None]] = None
 
 
 class NotCoinAccountClient:
@@ -144,11 +547,78 @@ class NotCoinAccountClient:
         self.telegram_client: typing.Optional[TelegramClient] = None
         self.logger = logger.getChild("accounts").getChild(self.name)
         self.tg_kwargs_override = config.get("tg_kwargs_override") or {}
+        self.tg_kwargs = resolve_tg_kwargs(
+            configuration["tg_kwargs"], self.tg_kwargs_override
+        )
+
+        self._webapp_data: typing.Optional[typing.Tuple[str, str]] = None
+        self._webapp_data_expires_at = 0.0
+        self._webapp_data_refresh_at = float("inf")
+        self._webapp_data_served_reload = False
+        self._webapp_refresh: typing.Optional[asyncio.Task] = None
+
+        # self id, @notcoin_bot peer and web view url, so a warm refresh is a single request.
+        # Kept in the shared session store if there is one, a file next to the session otherwise
+        self.metadata_path = "sessions/" + self.name + ".meta.json"
+        self.metadata: typing.Dict[str, typing.Any] = {}
+        if session_store is not None:
+            self.metadata = session_store.load_metadata(self.name)
+        if not self.metadata and os.path.isfile(self.metadata_path):
+            try:
+                with open(self.metadata_path) as f:
+                    self.metadata = json.load(f)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Ignoring unreadable {self.metadata_path}: {e!r}")
+
+    def update_metadata(self, **values):
+        self.metadata.update(values)
+        if session_store is not None:
+            session_store.save_metadata(self.name, self.metadata)
+            return
+        tmp_path = self.metadata_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.metadata, f)
+        os.replace(tmp_path, self.metadata_path)
+
+    @property
+    def telegram_connected(self) -> bool:
+        return self.telegram_client is not None and self.telegram_client.is_connected()
+
+    @contextlib.asynccontextmanager
+    async def telegram_connection(self):
+        """
+        Makes sure the telegram client is connected for the duration of the block.
+        In "on_demand" connection mode the connection counts against `max_open`
+        and is closed after `idle_disconnect_sec` without use.
+        """
+        if connection_pool is not None:
+            with tracing.span("telegram.pool_wait", account=self.name):
+                await connection_pool.acquire(self)
+        try:
+            if not self.telegram_client.is_connected():
+                with tracing.span("telegram.connect", account=self.name):
+                    await self.telegram_client.connect()
+            yield self.telegram_client
+        finally:
+            if connection_pool is not None:
+                connection_pool.release(self)
+
+    def _make_session(self) -> typing.Union[str, session_storage.AccountSession]:
+        if session_store is None:
+            return "sessions/" + self.name
+        return session_storage.AccountSession(session_store, self.name)
 
     async def prepare_telegram_client(self):
         if self.telegram_client:
             return
 
+        with tracing.span("telegram.prepare", account=self.name):
+            self.telegram_client = self._create_telegram_client()
+            async with self.telegram_connection():
+                with tracing.span("telegram.authorize", account=self.name):
+                    await self._authorize()
+
+    def _create_telegram_client(self) -> TelegramClient:
         if self.use_proxy_for_telegram and self.proxy:
             proxy_str = self.proxy
             proxy_str = proxy_str.replace("https://", "").replace("http://", "")
@@ -168,9 +638,9 @@ class NotCoinAccountClient:
                 raise ValueError(f"Invalid proxy {self.proxy}")
 
             self.logger.info(f"Connecting to telegram with proxy {self.proxy}")
-            self.telegram_client = TelegramClient(
-                "sessions/" + self.name,
-                **{**configuration["tg_kwargs"], **self.tg_kwargs_override},
+            return telegram_client_factory(
+                self._make_session(),
+                **self.tg_kwargs,
                 proxy={
                     "proxy_type": python_socks.ProxyType.HTTP,
                     "addr": host,
@@ -180,12 +650,9 @@ class NotCoinAccountClient:
                 },
                 use_ipv6=True,
             )
-        else:
-            self.telegram_client = TelegramClient(
-                "sessions/" + self.name, **configuration["tg_kwargs"]
-            )
+        return telegram_client_factory(self._make_session(), **self.tg_kwargs)
 
-        await self.telegram_client.connect()
+    async def _authorize(self):
         if not await self.telegram_client.is_user_authorized():
             self.logger.info(
                 f"Telegram client {self.name:15s} is not authorized! Please scan qr code in your telegram app.."
@@ -222,78 +689,229 @@ class NotCoinAccountClient:
                     )
                 )
             me = await self.telegram_client.get_me()
+            # a fresh login may be another user, whose bot access hash differs
+            self.metadata.clear()
+            self.update_metadata(self_id=me.id)
             self.logger.info(f"Telegram client {self.name:15s} authorized! Id: {me.id}")
         else:
-            me = await self.telegram_client.get_me()
-            self.logger.info(f"Telegram client {self.name:15s} authorized! Id: {me.id}")
+            self_id = self.metadata.get("self_id")
+            if self_id is None:
+                self_id = (await self.telegram_client.get_me()).id
+                self.update_metadata(self_id=self_id)
+            self.logger.info(f"Telegram client {self.name:15s} authorized! Id: {self_id}")
+
+    @property
+    def webapp_data_refresh_at(self) -> float:
+        return self._webapp_data_refresh_at
 
-    async def get_webapp_data(self) -> typing.Tuple[str, str]:
+    async def get_webapp_data(self, fresh: bool = False) -> typing.Tuple[str, str]:
+        """
+        Returns the cached (web_app_data, web_app_url) while it is valid, otherwise requests
+        new data from telegram. Concurrent callers share a single request.
+        """
+        with tracing.span("webapp_data.get", account=self.name) as span:
+            if (
+                not fresh
+                and WEBAPP_CACHE_CONFIG.get("enabled", True)
+                and self._webapp_data is not None
+                and time.time() < self._webapp_data_expires_at
+            ):
+                span.set(cached=True)
+                WEBAPP_DATA_CACHE_HITS.inc()
+                return self._webapp_data
+            started = time.perf_counter()
+            try:
+                return await self.refresh_webapp_data()
+            finally:
+                WEBAPP_DATA_SECONDS.observe(time.perf_counter() - started)
+
+    async def refresh_webapp_data(self) -> typing.Tuple[str, str]:
+        if self._webapp_refresh is None:
+            self._webapp_refresh = asyncio.ensure_future(self._fetch_webapp_data())
+            self._webapp_refresh.add_done_callback(self._on_webapp_data_fetched)
+        # shielded, so a caller giving up doesn't throw away the request for everyone else
+        return await asyncio.shield(self._webapp_refresh)
+
+    def _on_webapp_data_fetched(self, task: asyncio.Task):
+        self._webapp_refresh = None
+        if task.cancelled() or task.exception() is not None:
+            error = None if task.cancelled() else task.exception()
+            WEBAPP_DATA_ERRORS.labels(type(error).__name__ if error else "cancelled").inc()
+            if isinstance(error, telethon.errors.FloodWaitError):
+                FLOOD_WAITS.inc()
+                FLOOD_WAIT_SECONDS.inc(error.seconds)
+            # retry a failed background refresh later rather than on every refresher tick
+            self._webapp_data_refresh_at = time.time() + WEBAPP_CACHE_CONFIG.get(
+                "retry_after_sec", 60
+            )
+            return
+
+        web_app_data, _ = self._webapp_data = task.result()
+        try:
+            issued_at = int(parse_qs(web_app_data)["auth_date"][0])
+        except (KeyError, ValueError):
+            issued_at = time.time()
+        self._webapp_data_expires_at = issued_at + WEBAPP_CACHE_CONFIG.get(
+            "ttl_sec", 3600
+        )
+        # spread refreshes over time, so they don't all hit telegram at once
+        self._webapp_data_refresh_at = (
+            self._webapp_data_expires_at
+            - WEBAPP_CACHE_CONFIG.get("refresh_before_sec", 600)
+            - random.uniform(0, WEBAPP_CACHE_CONFIG.get("refresh_spread_sec", 300))
+        )
+        self._webapp_data_served_reload = False
+
+    async def _request_webview(
+        self,
+        peer: telethon.tl.types.TypeInputPeer,
+        bot: telethon.tl.types.InputUser,
+        url: str,
+    ) -> typing.Tuple[str, str]:
+        req = telethon.tl.functions.messages.RequestWebViewRequest(
+            peer=peer,
+            bot=bot,
+            platform="android",
+            from_bot_menu=None,
+            start_param=None,
+            theme_params=telethon.tl.types.DataJSON(WEBVIEW_THEME_PARAMS),
+            reply_to=None,
+            send_as=None,
+            url=url,
+        )
+        with tracing.span("telegram.request_webview", account=self.name):
+            resp = await self.telegram_client(req)
+        webapp_data = parse_qs(urlparse(resp.url).fragment)["tgWebAppData"][0]
+        return webapp_data, resp.url
+
+    async def _start_bot(
+        self,
+        ent: telethon.tl.types.User,
+        input_ent: telethon.tl.types.TypeInputPeer,
+        message_to_send: str,
+    ) -> list:
+        """
+        Sends /start and returns the bot's reply as soon as the update for it arrives.
+        Falls back to polling the chat with backoff if no update came in time, or if
+        the client doesn't receive updates at all.
+        """
+        reply_timeout = START_HANDSHAKE_CONFIG.get("reply_timeout_sec", 30)
+        poll_timeout = START_HANDSHAKE_CONFIG.get("poll_timeout_sec", 60)
+        loop = asyncio.get_running_loop()
+        reply = loop.create_future()
+
+        async def on_reply(event: telethon.events.NewMessage.Event):
+            if not reply.done():
+                reply.set_result(event.message)
+
+        if not self.tg_kwargs.get("receive_updates", True):
+            # no update stream to wait on, go straight to polling
+            await self.telegram_client.send_message(input_ent, message_to_send)
+        else:
+            event_filter = telethon.events.NewMessage(chats=ent.id, incoming=True)
+            self.telegram_client.add_event_handler(on_reply, event_filter)
+            try:
+                await self.telegram_client.send_message(input_ent, message_to_send)
+                try:
+                    message = await asyncio.wait_for(reply, reply_timeout)
+                    if message.buttons:
+                        return [message]
+                except asyncio.TimeoutError:
+                    self.logger.warning(
+                        f"No reply from the bot within {reply_timeout}s, polling for it"
+                    )
+            finally:
+                self.telegram_client.remove_event_handler(on_reply, event_filter)
+
+        delay = 1
+        deadline = loop.time() + poll_timeout
+        while True:
+            messages = await self.telegram_client.get_messages(entity=ent)
+            if len(messages) >= 2:
+                return messages
+            if loop.time() >= deadline:
+                raise TimeoutError(f"Bot did not reply to /start, account {self.name}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+    async def _fetch_webapp_data(self) -> typing.Tuple[str, str]:
         await self.prepare_telegram_client()
-        ent = await self.telegram_client.get_entity("@notcoin_bot")
-        input_ent = await self.telegram_client.get_input_entity(ent)
+        async with self.telegram_connection():
+            return await self._request_webapp_data()
+
+    async def _request_webapp_data(self) -> typing.Tuple[str, str]:
+        bot_id = self.metadata.get("bot_id")
+        bot_access_hash = self.metadata.get("bot_access_hash")
+        webview_url = self.metadata.get("webview_url")
+        if bot_id and bot_access_hash is not None and webview_url:
+            try:
+                return await self._request_webview(
+                    telethon.tl.types.InputPeerUser(bot_id, bot_access_hash),
+                    telethon.tl.types.InputUser(bot_id, bot_access_hash),
+                    webview_url,
+                )
+            except STALE_BOT_DATA_ERRORS as e:
+                self.logger.info(f"Cached bot data rejected ({e!r}), resolving again")
+                self.update_metadata(
+                    bot_id=None, bot_access_hash=None, webview_url=None
+                )
+
+        with tracing.span("telegram.get_entity", account=self.name):
+            ent = await self.telegram_client.get_entity("@notcoin_bot")
+            input_ent = await self.telegram_client.get_input_entity(ent)
 
-        messages = await self.telegram_client.get_messages(entity=ent)
+        with tracing.span("telegram.get_messages", account=self.name):
+            messages = await self.telegram_client.get_messages(entity=ent)
         if len(messages) == 0:
             message_to_send = "/start"
             if configuration["ref"]:
                 message_to_send += " " + configuration["ref"]
             self.logger.info(f"No messages found, sending {message_to_send}")
-            await self.telegram_client.send_message(input_ent, message_to_send)
-
-            while True:
-                messages = await self.telegram_client.get_messages(entity=ent)
-                if len(messages) >= 2:
-                    break
-                await asyncio.sleep(1)
+            with tracing.span("telegram.start_bot", account=self.name):
+                messages = await self._start_bot(ent, input_ent, message_to_send)
 
-        resp = None
+        webview_url = None
         for message in messages:
-            if resp:
+            if webview_url:
                 break
             if not message.buttons:
                 continue
             for row in message.buttons:
-                if resp:
+                if webview_url:
                     break
                 for button in row:
                     button: telethon.tl.custom.messagebutton.MessageButton
                     if isinstance(
                         button.button, telethon.tl.types.KeyboardButtonWebView
                     ):
-                        req = telethon.tl.functions.messages.RequestWebViewRequest(
-                            peer=input_ent,
-                            bot=telethon.tl.types.InputUser(
-                                user_id=ent.id,
-                                access_hash=ent.access_hash,
-                            ),
-                            platform="android",
-                            from_bot_menu=None,
-                            start_param=None,
-                            theme_params=telethon.tl.types.DataJSON(
-                                '{"accent_text_color":"#ed8abf","bg_color":"#25181f",'
-                                '"button_color":"#aa6085","button_text_color":"#ffffff",'
-                                '"destructive_text_color":"#ec3942","header_bg_color":"#25181f",'
-                                '"hint_color":"#866b79","link_color":"#ee89bf",'
-                                '"secondary_bg_color":"#34242b","section_bg_color":"#25181f",'
-                                '"section_header_text_color":"#ee89bf","subtitle_text_color":"#866b79",'
-                                '"text_color":"#f5f5f5"}'
-                            ),
-                            reply_to=None,
-                            send_as=None,
-                            url=button.button.url,
-                        )
-                        resp = await self.telegram_client(req)
+                        webview_url = button.button.url
                         break
 
-        if not resp:
+        if not webview_url:
             raise ValueError(f"No webview found, account {self.name}")
 
-        webapp_data = parse_qs(urlparse(resp.url).fragment)["tgWebAppData"][0]
-
-        return webapp_data, resp.url
+        result = await self._request_webview(
+            input_ent,
+            telethon.tl.types.InputUser(user_id=ent.id, access_hash=ent.access_hash),
+            webview_url,
+        )
+        self.update_metadata(
+            bot_id=ent.id, bot_access_hash=ent.access_hash, webview_url=webview_url
+        )
+        return result
 
-    async def get_client_init_ws_data(self) -> ws_defs.WsMessageDataSendClientsClient:
-        web_app_data, web_app_url = await self.get_webapp_data()
+    async def get_client_init_ws_data(
+        self, for_reload: bool = False
+    ) -> ws_defs.WsMessageDataSendClientsClient:
+        """
+        `for_reload` marks a server reload request. A cached entry answers at most one of them:
+        if the server asks again, it most likely rejected that data, so a new one is requested.
+        """
+        web_app_data, web_app_url = await self.get_webapp_data(
+            fresh=for_reload and self._webapp_data_served_reload
+        )
+        if for_reload:
+            self._webapp_data_served_reload = True
         return ws_defs.WsMessageDataSendClientsClient(
             name=self.name,
             proxy=self.proxy,
@@ -303,6 +921,336 @@ class NotCoinAccountClient:
         )
 
 
+async def flush_sessions_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        flushed = session_store.flush()
+        if flushed:
+            logger.debug(f"Flushed {flushed} sessions")
+
+
+class WebAppDataRefresher:
+    """Renews cached web app data of every account shortly before it expires."""
+
+    def __init__(self, accounts: typing.List[NotCoinAccountClient]):
+        self.logger = logger.getChild("refresher")
+        self.accounts = accounts
+
+    async def run(self):
+        while True:
+            now = time.time()
+            due = [a for a in self.accounts if a.webapp_data_refresh_at <= now]
+            if due:
+                self.logger.info(f"Refreshing web app data of {len(due)} accounts")
+                results = await execute_tasks_adaptive(
+                    "refresh_webapp_data",
+                    [account.refresh_webapp_data() for account in due],
+                    [account.name for account in due],
+                    return_exceptions=True,
+                )
+                for account, result in zip(due, results):
+                    if isinstance(result, BaseException):
+                        self.logger.warning(
+                            f"Failed to refresh web app data of {account.name}: {result!r}"
+                        )
+
+            next_at = min(a.webapp_data_refresh_at for a in self.accounts)
+            await asyncio.sleep(min(max(next_at - time.time(), 1), 60))
+
+
+def start_account_background_tasks(
+    accounts: typing.List[NotCoinAccountClient],
+) -> typing.List[asyncio.Task]:
+    tasks = []
+    if session_store is not None and not session_store.write_through:
+        tasks.append(
+            asyncio.ensure_future(
+                flush_sessions_periodically(SESSIONS_CONFIG.get("flush_interval_sec", 30))
+            )
+        )
+    if WEBAPP_CACHE_CONFIG.get("enabled", True):
+        tasks.append(asyncio.ensure_future(WebAppDataRefresher(accounts).run()))
+    return tasks
+
+
+WORKERS_CONFIG = configuration.get("workers") or {}
+IPC_LINE_LIMIT = 2**24
+# how often workers send what WORKER_METRICS counted to the main process
+WORKER_METRICS_INTERVAL = 5
+
+
+class WorkerCrashedException(Exception):
+    pass
+
+
+class WorkerPool:
+    """
+    Runs the telegram clients in worker processes, so MTProto crypto and TL (de)serialisation
+    use more than one core. Workers connect back to a localhost socket and exchange
+    newline-delimited JSON requests and responses. A worker that dies is started again.
+    """
+
+    def __init__(self, account_names: typing.List[str], processes: int):
+        self.logger = logger.getChild("workers")
+        processes = max(1, min(processes, len(account_names)))
+        self.shards = [account_names[i::processes] for i in range(processes)]
+        self.worker_of = {
+            name: index for index, shard in enumerate(self.shards) for name in shard
+        }
+        self._token = os.urandom(16).hex()
+        self._port: typing.Optional[int] = None
+        self._server: typing.Optional[asyncio.AbstractServer] = None
+        self._processes: typing.List[typing.Optional[multiprocessing.Process]] = [
+            None
+        ] * processes
+        self._writers: typing.List[typing.Optional[asyncio.StreamWriter]] = [
+            None
+        ] * processes
+        self._ready: typing.List[asyncio.Event] = [
+            asyncio.Event() for _ in range(processes)
+        ]
+        self._pending: typing.List[typing.Dict[int, asyncio.Future]] = [
+            {} for _ in range(processes)
+        ]
+        self._request_id = 0
+        self._monitor: typing.Optional[asyncio.Task] = None
+        self._connections: typing.Set[asyncio.Task] = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._on_worker_connected, "127.0.0.1", 0, limit=IPC_LINE_LIMIT
+        )
+        self._port = self._server.sockets[0].getsockname()[1]
+        for index in range(len(self.shards)):
+            self._spawn(index)
+        self._monitor = asyncio.ensure_future(self._monitor_workers())
+        self.logger.info(
+            f"Started {len(self.shards)} workers for {len(self.worker_of)} accounts"
+        )
+
+    def _spawn(self, index: int):
+        process = multiprocessing.get_context("spawn").Process(
+            target=run_worker,
+            args=(
+                index,
+                self._port,
+                self._token,
+                self.shards[index],
+                self._max_open_connections(index),
+                worker_initializer,
+            ),
+            name=f"notcoin-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _max_open_connections(self, index: int) -> typing.Optional[int]:
+        """This worker's share of connections.max_open, so the limit holds for all of them."""
+        if connection_pool is None:
+            return None
+        share, rest = divmod(connection_pool.max_open, len(self.shards))
+        return max(1, share + (index < rest))
+
+    async def _on_worker_connected(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        connection = asyncio.current_task()
+        self._connections.add(connection)
+        connection.add_done_callback(self._connections.discard)
+        hello = json.loads(await reader.readline() or "null")
+        if not isinstance(hello, dict) or hello.get("token") != self._token:
+            writer.close()
+            return
+        index = hello["worker"]
+        self._writers[index] = writer
+        self._ready[index].set()
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                if "metrics" in response:
+                    metrics.add_changes(response["metrics"])
+                    continue
+                future = self._pending[index].pop(response["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(RuntimeError(response["error"]))
+                else:
+                    future.set_result(response["result"])
+        except ConnectionError as e:
+            self.logger.warning(f"Lost connection to worker {index}: {e!r}")
+        finally:
+            if self._writers[index] is writer:
+                self._ready[index].clear()
+                self._writers[index] = None
+                self._fail_pending(index)
+
+    def _fail_pending(self, index: int):
+        for future in self._pending[index].values():
+            if not future.done():
+                future.set_exception(
+                    WorkerCrashedException(f"Worker {index} stopped")
+                )
+        self._pending[index].clear()
+
+    async def _monitor_workers(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                self.logger.error(
+                    f"Worker {index} exited with code {process.exitcode}, restarting it"
+                )
+                self._fail_pending(index)
+                self._spawn(index)
+
+    async def close(self):
+        """Stops the workers: they exit when their connection closes, stragglers are killed."""
+        if self._monitor is not None:
+            self._monitor.cancel()
+        for writer in self._writers:
+            if writer is not None:
+                writer.close()
+        if self._connections:
+            await asyncio.wait(self._connections, timeout=5)
+        for task in self._connections:
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, 5)
+            if process.is_alive():
+                process.terminate()
+                await loop.run_in_executor(None, process.join, 5)
+
+    async def request(self, account_name: str, op: str, **params) -> typing.Any:
+        index = self.worker_of[account_name]
+        # the connection can drop again between the event being set and this task running
+        while self._writers[index] is None:
+            await self._ready[index].wait()
+        self._request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[index][self._request_id] = future
+        request = {"id": self._request_id, "op": op, "name": account_name, **params}
+        trace_context = tracing.context()
+        if trace_context is not None:
+            request["trace"] = trace_context
+        self._writers[index].write(json.dumps(request).encode() + b"\n")
+        await self._writers[index].drain()
+        return await future
+
+
+class RemoteAccountClient:
+    """Stands in for a NotCoinAccountClient that lives in a worker process."""
+
+    def __init__(self, account: NotCoinAccountClient, pool: WorkerPool):
+        self.name = account.name
+        self.proxy = account.proxy
+        self.pool = pool
+
+    async def prepare_telegram_client(self):
+        await self.pool.request(self.name, "prepare")
+
+    async def get_client_init_ws_data(
+        self, for_reload: bool = False
+    ) -> ws_defs.WsMessageDataSendClientsClient:
+        return ws_defs.WsMessageDataSendClientsClient.from_json(
+            await self.pool.request(
+                self.name, "client_init_ws_data", for_reload=for_reload
+            )
+        )
+
+
+
+def run_worker(
+    index: int,
+    port: int,
+    token: str,
+    account_names: typing.List[str],
+    max_open_connections: typing.Optional[int] = None,
+    initializer: typing.Optional[typing.Callable[[], None]] = None,
+):
+    """Entry point of a worker process started by WorkerPool."""
+    if initializer is not None:
+        initializer()
+    if connection_pool is not None and max_open_connections is not None:
+        connection_pool.max_open = max_open_connections
+    asyncio.run(_worker_main(index, port, token, account_names))
+
+
+async def _worker_main(
+    index: int, port: int, token: str, account_names: typing.List[str]
+):
+    names = set(account_names)
+    accounts = {
+        account.name: account for account in load_accounts() if account.name in names
+    }
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", port, limit=IPC_LINE_LIMIT
+    )
+    writer.write(json.dumps({"token": token, "worker": index}).encode() + b"\n")
+    background_tasks = start_account_background_tasks(list(accounts.values()))
+    # telethon runs on this process's loop, which can block like the main one
+    if event_loop_monitor is not None:
+        background_tasks.append(asyncio.ensure_future(event_loop_monitor.run()))
+    # the telegram clients live here, so this process reports its own memory
+    memory_profiler.logger = memory_profiler.logger.getChild(f"worker{index}")
+    memory_profiler.count_accounts = lambda: len(accounts)
+    memory_profiler.install_signal_handler(asyncio.get_running_loop())
+    background_tasks.append(asyncio.ensure_future(memory_profiler.run()))
+
+    async def send_metrics():
+        while True:
+            await asyncio.sleep(WORKER_METRICS_INTERVAL)
+            changes = metrics.take_changes(WORKER_METRICS)
+            if changes:
+                writer.write(json.dumps({"metrics": changes}).encode() + b"\n")
+                await writer.drain()
+
+    background_tasks.append(asyncio.ensure_future(send_metrics()))
+
+    async def handle(request: dict):
+        response = {"id": request["id"]}
+        try:
+            # the spans of the request's telegram calls continue the main process's trace
+            with tracing.remote_span(
+                f"worker.{request['op']}",
+                request.get("trace"),
+                account=request["name"],
+                worker=index,
+            ):
+                account = accounts[request["name"]]
+                if request["op"] == "prepare":
+                    await account.prepare_telegram_client()
+                    response["result"] = None
+                elif request["op"] == "client_init_ws_data":
+                    client = await account.get_client_init_ws_data(request["for_reload"])
+                    response["result"] = client.to_json()
+                else:
+                    raise ValueError(f"Unknown op {request['op']}")
+        except Exception as e:
+            response["error"] = repr(e)
+        writer.write(json.dumps(response).encode() + b"\n")
+        await writer.drain()
+
+    handlers = set()
+    # the parent closing the connection means it is gone, so the worker exits too
+    while line := await reader.readline():
+        task = asyncio.ensure_future(handle(json.loads(line)))
+        handlers.add(task)
+        task.add_done_callback(handlers.discard)
+    for task in background_tasks + list(handlers):
+        task.cancel()
+    if session_store is not None:
+        session_store.close()
+
+
 WS_URL = "wss://nocoin.aperlaqf.work/client_request"
 if IS_DEBUG:
     WS_URL = "ws://localhost:51371/client_request"
@@ -312,48 +1260,475 @@ if LOCALE not in ("en", "ru"):
     logger.error(f"Язык {LOCALE} не найден! Возможные языки: en, ru")
     exit_after_enter()
 
+# optional protocol extensions, only enable the ones the server supports
+PROTOCOL_CONFIG = configuration.get("protocol") or {}
+WEBSOCKET_CONFIG = configuration.get("websocket") or {}
+for codec_name in set(PROTOCOL_CONFIG.get("codecs", [])) - set(
+    ws_defs.codecs.available_codecs()
+):
+    logger.warning(f"Codec {codec_name} is not available, install its package to use it")
+
+# outgoing messages with a lower priority value are written first
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+MESSAGE_PRIORITIES = {
+    ws_defs.WsMessageTypes.MT_C_ClientReloaded: PRIORITY_URGENT,
+    ws_defs.WsMessageTypes.MT_C_ActivateTurboBoost: PRIORITY_URGENT,
+    ws_defs.WsMessageTypes.MT_C_ResumeClients: PRIORITY_URGENT,
+    ws_defs.WsMessageTypes.MT_C_ClientReloadedDelta: PRIORITY_URGENT,
+    # must reach the server before the clients that refer to the profiles
+    ws_defs.WsMessageTypes.MT_C_ConfigProfiles: PRIORITY_URGENT,
+    ws_defs.WsMessageTypes.MT_C_ClientRegistered: PRIORITY_NORMAL,
+    # must stay behind the MT_C_ClientRegistered messages it concludes
+    ws_defs.WsMessageTypes.MT_C_RegistrationComplete: PRIORITY_NORMAL,
+    ws_defs.WsMessageTypes.MT_C_SentClients: PRIORITY_BULK,
+    ws_defs.WsMessageTypes.MT_C_SentClientsChunk: PRIORITY_BULK,
+}
+
 
 class WebsocketClient:
-    def __init__(self, accounts: typing.List[NotCoinAccountClient]):
+    def __init__(
+        self,
+        accounts: typing.List[NotCoinAccountClient],
+        license_key: str,
+        name: str = "main",
+    ):
+        self.name = name
+        self.license_key = license_key
         self.logger = logger.getChild("websocket")
+        if SHARDS_CONFIG:
+            self.logger = self.logger.getChild(name)
         self.accounts = {account.name: account for account in accounts}
-        self.write_lock = asyncio.Lock()
         self.ws: typing.Optional[websockets.WebSocketClientProtocol] = None
         self._locales = {}
+        self._handler_slots = asyncio.Semaphore(
+            WEBSOCKET_CONFIG.get("max_concurrent_handlers", 16)
+        )
+        self._handlers: typing.Set[asyncio.Task] = set()
+        self._reloads_in_flight: typing.Dict[str, asyncio.Task] = {}
+        self._connection_task: typing.Optional[asyncio.Task] = None
+        self._handler_error: typing.Optional[BaseException] = None
+        self._send_queue: typing.Optional[asyncio.PriorityQueue] = None
+        self._send_seq = 0
+        self.codec: ws_defs.WsCodec = ws_defs.codec_for_subprotocol(None)
+        # what the server has for each client, offered back when resuming after a reconnect
+        self._registered: typing.Dict[str, str] = {}
+        # the last data sent for each client, reloads only send what changed since
+        self._sent_clients: typing.Dict[str, ws_defs.WsMessageDataSendClientsClient] = {}
+        # client name -> priorities of the queued messages carrying its data, not written yet
+        self._unsent_clients: typing.Dict[str, typing.List[int]] = {}
+        self._profiles_sent: typing.Set[str] = set()
+        # id of a configuration dict -> (the dict, its profile hash); accounts share the dicts
+        self._profile_hashes: typing.Dict[int, typing.Tuple[dict, str]] = {}
+        self.connected_at: typing.Optional[float] = None
+        self.disconnected_at: typing.Optional[float] = None
+        self.last_message_at: typing.Optional[float] = None
+        self.reconnects = 0
+        self.compression_stats = ws_compression.CompressionStats()
+        self.recorder: typing.Optional[recording.FrameRecorder] = None
+        if WEBSOCKET_CONFIG.get("record_path"):
+            record_path = WEBSOCKET_CONFIG["record_path"].format(
+                shard=name, started=int(time.time())
+            )
+            if os.path.dirname(record_path):
+                os.makedirs(os.path.dirname(record_path), exist_ok=True)
+            self.logger.info(f"Recording the connection to {record_path}")
+            self.recorder = recording.FrameRecorder(
+                record_path,
+                {
+                    "protocol": PROTOCOL_CONFIG,
+                    "websocket": {
+                        key: value
+                        for key, value in WEBSOCKET_CONFIG.items()
+                        if key != "record_path"
+                    },
+                },
+            )
+        self._received_metrics = {
+            message_type: WS_MESSAGES.labels(name, "received", message_type.name)
+            for message_type in ws_defs.WsMessageTypes
+        }
+        self._sent_metrics = {
+            message_type: WS_MESSAGES.labels(name, "sent", message_type.name)
+            for message_type in ws_defs.WsMessageTypes
+        }
+        self._received_size_metric = WS_FRAME_SIZE.labels(name, "received")
+        self._sent_size_metric = WS_FRAME_SIZE.labels(name, "sent")
+        self._send_seconds_metric = WS_SEND_SECONDS.labels(name)
 
     async def send_message(
         self,
         message_type: ws_defs.WsMessageTypes,
         data: typing.Optional[ws_defs.SomeWsData],
+        priority: typing.Optional[int] = None,
+        clients: typing.Sequence[ws_defs.WsMessageDataSendClientsClient] = (),
     ):
-        async with self.write_lock:
-            await self.ws.send(
-                json.dumps(
-                    ws_defs.WsMessage(message_type, data).to_json(),
-                    separators=(",", ":"),
+        """
+        Queues a message for the writer task. Waits only while the queue is full,
+        i.e. when the server reads slower than we produce. `clients` are the clients whose
+        data the message carries; the writer marks them sent once it is written.
+        """
+        if priority is None:
+            priority = MESSAGE_PRIORITIES.get(message_type, PRIORITY_NORMAL)
+        self._send_seq += 1
+        # finished by the writer once the message is sent, so it covers the time in the queue
+        span = tracing.start_span("ws.send", shard=self.name, type=message_type.name)
+        await self._send_queue.put(
+            (priority, self._send_seq, ws_defs.WsMessage(message_type, data), span, clients)
+        )
+        for client in clients:
+            self._unsent_clients.setdefault(client.name, []).append(priority)
+
+    def _written(self, span, clients: typing.Sequence[ws_defs.WsMessageDataSendClientsClient]):
+        span.finish()
+        for client in clients:
+            self._mark_sent(client)
+            priorities = self._unsent_clients.get(client.name)
+            if priorities:
+                priorities.pop(0)
+                if not priorities:
+                    del self._unsent_clients[client.name]
+
+    async def _write_loop(self, queue: asyncio.PriorityQueue):
+        batch_frames = PROTOCOL_CONFIG.get("batch_frames", False)
+        batch_max_message_bytes = WEBSOCKET_CONFIG.get("batch_max_message_bytes", 1024)
+        batch_max_messages = WEBSOCKET_CONFIG.get("batch_max_messages", 64)
+        fragment_size = WEBSOCKET_CONFIG.get("fragment_size", 65536)
+
+        while True:
+            _, _, message, span, clients = await queue.get()
+            self._sent_metrics[message.message_type].value += 1
+            if (
+                message.message_type == ws_defs.WsMessageTypes.MT_C_SentClients
+                and fragment_size
+            ):
+                await self._send_fragmented(message, fragment_size)
+                self._written(span, clients)
+                continue
+            frame = self.codec.encode(message)
+            if (
+                not batch_frames
+                or queue.empty()
+                or len(frame) > batch_max_message_bytes
+            ):
+                await self._send_frame(frame)
+                self._written(span, clients)
+                continue
+
+            # combine everything small that is already queued into one frame
+            parts = [frame]
+            written = [(span, clients)]
+            large_frame = None
+            fragmented = None
+            while not queue.empty() and len(parts) < batch_max_messages:
+                _, _, message, span, clients = queue.get_nowait()
+                self._sent_metrics[message.message_type].value += 1
+                if (
+                    message.message_type == ws_defs.WsMessageTypes.MT_C_SentClients
+                    and fragment_size
+                ):
+                    fragmented = message
+                    break
+                frame = self.codec.encode(message)
+                if len(frame) > batch_max_message_bytes:
+                    large_frame = frame
+                    break
+                parts.append(frame)
+                written.append((span, clients))
+
+            if len(parts) == 1:
+                await self._send_frame(parts[0])
+            else:
+                await self._send_frame(self.codec.encode_batch(parts))
+            for batched_span, batched_clients in written:
+                self._written(batched_span, batched_clients)
+            if large_frame is not None:
+                await self._send_frame(large_frame)
+                self._written(span, clients)
+            elif fragmented is not None:
+                await self._send_fragmented(fragmented, fragment_size)
+                self._written(span, clients)
+
+    async def _send_frame(self, frame: typing.Union[str, bytes]):
+        if self.recorder is not None:
+            self.recorder.record(recording.Direction.Outbound, frame)
+        started = time.perf_counter()
+        await self.ws.send(frame)
+        self._send_seconds_metric.observe(time.perf_counter() - started)
+        self._sent_size_metric.value += len(frame)
+
+    async def _send_fragmented(self, message: ws_defs.WsMessage, fragment_size: int):
+        """
+        Sends a large message as websocket fragments encoded on the fly, so the whole
+        message is never held in memory or sent as a single frame.
+        """
+        fragments = self.codec.encode_fragments(message, fragment_size)
+        first = next(fragments)
+        second = next(fragments, None)
+        if second is None:
+            await self._send_frame(first)
+        else:
+            fragments = itertools.chain((first, second), fragments)
+            if self.recorder is not None:
+                fragments = self.recorder.record_fragments(
+                    recording.Direction.Outbound, fragments
+                )
+            started = time.perf_counter()
+            await self.ws.send(self._count_sent(fragments))
+            self._send_seconds_metric.observe(time.perf_counter() - started)
+
+    def _count_sent(
+        self, fragments: typing.Iterable[typing.Union[str, bytes]]
+    ) -> typing.Iterator[typing.Union[str, bytes]]:
+        for fragment in fragments:
+            self._sent_size_metric.value += len(fragment)
+            yield fragment
+
+    def _profile_hash(self, configuration: dict) -> str:
+        cached = self._profile_hashes.get(id(configuration))
+        if cached is None or cached[0] is not configuration:
+            cached = (configuration, ws_defs.canonical_hash(configuration)[:16])
+            self._profile_hashes[id(configuration)] = cached
+        return cached[1]
+
+    async def _compact_clients(
+        self, clients: typing.List[ws_defs.WsMessageDataSendClientsClient]
+    ) -> typing.List[ws_defs.WsMessageDataSendClientsClient]:
+        """
+        With `config_profiles`, replaces each configuration with a reference to a profile,
+        first sending the profiles the server doesn't have yet in one message.
+        """
+        if not PROTOCOL_CONFIG.get("config_profiles"):
+            return clients
+        new_profiles = {}
+        compacted = []
+        for client in clients:
+            if not client.configuration:
+                compacted.append(client)
+                continue
+            ref = self._profile_hash(client.configuration)
+            if ref not in self._profiles_sent:
+                new_profiles[ref] = client.configuration
+            compacted.append(client.with_configuration_ref(ref))
+        if new_profiles:
+            await self.send_message(
+                ws_defs.WsMessageTypes.MT_C_ConfigProfiles,
+                ws_defs.WsDataConfigProfiles(profiles=new_profiles),
+            )
+            self._profiles_sent.update(new_profiles)
+        return compacted
+
+    async def _resend_profiles(self):
+        """Registers the profiles that resumed clients refer to on the new connection."""
+        refs = {client.configuration_ref for client in self._sent_clients.values()}
+        profiles = {
+            ref: configuration
+            for configuration, ref in self._profile_hashes.values()
+            if ref in refs
+        }
+        if profiles:
+            await self.send_message(
+                ws_defs.WsMessageTypes.MT_C_ConfigProfiles,
+                ws_defs.WsDataConfigProfiles(profiles=profiles),
+            )
+            self._profiles_sent.update(profiles)
+
+    def _mark_sent(self, client: ws_defs.WsMessageDataSendClientsClient):
+        self._sent_clients[client.name] = client
+        self._registered[client.name] = client.content_hash()
+
+    async def send_reloaded_client(self, client: ws_defs.WsMessageDataSendClientsClient):
+        (client,) = await self._compact_clients([client])
+        queued = self._unsent_clients.get(client.name)
+        if queued:
+            # a delta could overtake the queued data it is based on, so send it whole and
+            # behind that data
+            await self.send_message(
+                ws_defs.WsMessageTypes.MT_C_ClientReloaded,
+                client,
+                priority=max(queued),
+                clients=[client],
+            )
+            return
+        previous = self._sent_clients.get(client.name)
+        delta = None
+        if PROTOCOL_CONFIG.get("delta_reloads") and previous is not None:
+            delta = client.delta_from(previous)
+        if delta is not None:
+            await self.send_message(
+                ws_defs.WsMessageTypes.MT_C_ClientReloadedDelta, delta, clients=[client]
+            )
+        else:
+            await self.send_message(
+                ws_defs.WsMessageTypes.MT_C_ClientReloaded, client, clients=[client]
+            )
+
+    async def register_clients_incrementally(self):
+        """
+        Sends every client as soon as its web app data is ready, then a completion marker
+        with the clients that failed or did not make it before `registration_timeout_sec`.
+        """
+        logger.info("Registering clients as they become ready...")
+        timeout = PROTOCOL_CONFIG.get("registration_timeout_sec", 120)
+        accounts = list(self.accounts.values())
+
+        async def send_ready(_, client: ws_defs.WsMessageDataSendClientsClient):
+            (client,) = await self._compact_clients([client])
+            await self.send_message(
+                ws_defs.WsMessageTypes.MT_C_ClientRegistered, client, clients=[client]
+            )
+            self.logger.debug(f"Client {client.name} registered")
+
+        results = await execute_tasks_adaptive(
+            "register_clients",
+            [
+                asyncio.wait_for(account.get_client_init_ws_data(), timeout)
+                for account in accounts
+            ],
+            [account.name for account in accounts],
+            return_exceptions=True,
+            on_result=send_ready,
+        )
+        failed = []
+        for account, result in zip(accounts, results):
+            if isinstance(result, BaseException):
+                self.logger.error(f"Client {account.name} failed to register: {result!r}")
+                failed.append(account.name)
+
+        await self.send_message(
+            ws_defs.WsMessageTypes.MT_C_RegistrationComplete,
+            ws_defs.WsDataRegistrationComplete(failed=failed),
+        )
+        logger.info(
+            f"Registration complete: {len(accounts) - len(failed)} registered, {len(failed)} failed"
+        )
+
+    def _spawn_handler(self, msg: ws_defs.WsMessage) -> asyncio.Task:
+        attributes = {}
+        if msg.message_type == ws_defs.WsMessageTypes.MT_S_ReloadClient:
+            attributes["account"] = msg.data.client_name
+
+        async def handle():
+            # the root of the trace of everything done for this server request
+            with tracing.span(msg.message_type.name, shard=self.name, **attributes):
+                async with self._handler_slots:
+                    await self.handle_message(msg)
+
+        task = asyncio.ensure_future(handle())
+        self._handlers.add(task)
+        task.add_done_callback(self._on_handler_done)
+        return task
+
+    def _on_handler_done(self, task: asyncio.Task):
+        self._handlers.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        # surface the error from the connection loop, like it would have been when handled inline
+        if self._handler_error is None:
+            self._handler_error = task.exception()
+            if self._connection_task is not None:
+                self._connection_task.cancel()
+
+    async def refresh_stale_clients(self, client_names: typing.List[str]):
+        """Sends refreshed data of the clients the server rejected when resuming."""
+        client_names = [name for name in client_names if name in self.accounts]
+        logger.info(f"Registration resumed, refreshing {len(client_names)} stale clients")
+        # the server's copy of these is outdated, a delta wouldn't apply to it
+        for name in client_names:
+            self._sent_clients.pop(name, None)
+
+        async def send_reloaded(_, client: ws_defs.WsMessageDataSendClientsClient):
+            await self.send_reloaded_client(client)
+
+        results = await execute_tasks_adaptive(
+            "refresh_stale_clients",
+            [
+                self.accounts[name].get_client_init_ws_data(for_reload=True)
+                for name in client_names
+            ],
+            client_names,
+            return_exceptions=True,
+            on_result=send_reloaded,
+        )
+        for name, result in zip(client_names, results):
+            if isinstance(result, BaseException):
+                self.logger.error(f"Client {name} failed to refresh: {result!r}")
+
+    async def process_message(self, message: typing.Union[str, bytes]):
+        """
+        Parses a frame and handles it. Messages that go to telegram are started as tracked
+        tasks so the receive loop keeps reading; everything else is handled inline, in order.
+        A frame that doesn't match the schema is logged and skipped.
+        """
+        try:
+            msg = self.codec.decode(message)
+        except ws_defs.WsSchemaError as e:
+            self.logger.warning(f"Skipping a message that doesn't match the schema: {e}")
+            return
+        self._received_metrics[msg.message_type].value += 1
+        if msg.message_type == ws_defs.WsMessageTypes.MT_S_ReloadClient:
+            client_name = msg.data.client_name
+            if client_name in self._reloads_in_flight:
+                self.logger.debug(
+                    f"Refresh of client {client_name} is already in progress, merging request"
                 )
+                return
+            task = self._spawn_handler(msg)
+            self._reloads_in_flight[client_name] = task
+            task.add_done_callback(
+                lambda _: self._reloads_in_flight.pop(client_name, None)
             )
+        elif msg.message_type in (
+            ws_defs.WsMessageTypes.MT_S_SendClients,
+            ws_defs.WsMessageTypes.MT_S_ResumeAccepted,
+        ):
+            self._spawn_handler(msg)
+        else:
+            await self.handle_message(msg)
 
-    async def process_message(self, message: str):
-        data = json.loads(message)
-        msg = ws_defs.WsMessage.from_json(data)
+    async def handle_message(self, msg: ws_defs.WsMessage):
         if msg.message_type == ws_defs.WsMessageTypes.MT_S_InUse:
-            logger.error("There is already a client with this license running!")
-            exit_after_enter()
+            raise LicenseRejectedException(
+                "There is already a client with this license running!"
+            )
         elif msg.message_type == ws_defs.WsMessageTypes.MT_S_SendClients:
+            self._registered.clear()
+            self._sent_clients.clear()
+            if PROTOCOL_CONFIG.get("incremental_registration"):
+                await self.register_clients_incrementally()
+                return
+
             logger.info("Preparing all clients to be used...")
             tasks = []
             for account in self.accounts.values():
                 tasks.append(account.get_client_init_ws_data())
 
-            clients_ready = await execute_tasks_in_chunks(tasks, 5)
+            clients_ready = await execute_tasks_adaptive(
+                "send_clients", tasks, list(self.accounts)
+            )
             logger.info("All clients prepared! Sending...")
-            await self.send_message(
-                ws_defs.WsMessageTypes.MT_C_SentClients,
-                ws_defs.WsDataSentClients(
+            clients_ready = await self._compact_clients(clients_ready)
+            if PROTOCOL_CONFIG.get("chunked_registration"):
+                chunk_size = WEBSOCKET_CONFIG.get("chunk_clients", 200)
+                for start in range(0, max(len(clients_ready), 1), chunk_size):
+                    chunk = clients_ready[start : start + chunk_size]
+                    await self.send_message(
+                        ws_defs.WsMessageTypes.MT_C_SentClientsChunk,
+                        ws_defs.WsDataSentClientsChunk(
+                            clients=chunk,
+                            last=start + chunk_size >= len(clients_ready),
+                        ),
+                        clients=chunk,
+                    )
+            else:
+                await self.send_message(
+                    ws_defs.WsMessageTypes.MT_C_SentClients,
+                    ws_defs.WsDataSentClients(
+                        clients=clients_ready,
+                    ),
                     clients=clients_ready,
-                ),
-            )
+                )
             logger.info("All clients sent!")
 
         elif msg.message_type == ws_defs.WsMessageTypes.MT_S_ErrorDisconnect:
@@ -368,11 +1743,11 @@ class WebsocketClient:
                 f"Server requested a refreshed data of client {message.client_name}. Refreshing..."
             )
             account = self.accounts[message.client_name]
-            await self.send_message(
-                ws_defs.WsMessageTypes.MT_C_ClientReloaded,
-                await account.get_client_init_ws_data(),
-            )
+            client = await account.get_client_init_ws_data(for_reload=True)
+            await self.send_reloaded_client(client)
             self.logger.info(f"Client {message.client_name} refreshed!")
+        elif msg.message_type == ws_defs.WsMessageTypes.MT_S_ResumeAccepted:
+            await self.refresh_stale_clients(msg.data.stale)
 
         elif msg.message_type == ws_defs.WsMessageTypes.MT_S_ClientFullyStopped:
             self.logger.error(
@@ -392,28 +1767,311 @@ class WebsocketClient:
                 text = text.format(*message.formatting)
             print(message.color.to_str(text))
 
+    async def serve_connection(self, ws: websockets.WebSocketClientProtocol):
+        self.ws = ws
+        self.codec = ws_defs.codec_for_subprotocol(ws.subprotocol)
+        if self.recorder is not None:
+            self.recorder.connected(ws.subprotocol)
+        if ws.subprotocol:
+            self.logger.info(f"Using {self.codec.name} codec")
+        self._handler_error = None
+        self._connection_task = asyncio.current_task()
+        self._send_queue = asyncio.PriorityQueue(
+            WEBSOCKET_CONFIG.get("send_queue_size", 256)
+        )
+        # whatever the last connection didn't write is gone with its queue
+        self._unsent_clients.clear()
+        writer = asyncio.ensure_future(self._write_loop(self._send_queue))
+        self._handlers.add(writer)
+        writer.add_done_callback(self._on_handler_done)
+        self.connected_at = time.monotonic()
+        # profiles are registered per connection
+        self._profiles_sent.clear()
+        if not PROTOCOL_CONFIG.get("resume"):
+            self._sent_clients.clear()
+        try:
+            if PROTOCOL_CONFIG.get("resume") and self._registered:
+                self.logger.info(
+                    f"Offering {len(self._registered)} registered clients to resume"
+                )
+                await self._resend_profiles()
+                await self.send_message(
+                    ws_defs.WsMessageTypes.MT_C_ResumeClients,
+                    ws_defs.WsDataResumeClients(clients=dict(self._registered)),
+                )
+            while True:
+                message = await self.ws.recv()
+                if self.recorder is not None:
+                    self.recorder.record(recording.Direction.Inbound, message)
+                self.last_message_at = time.monotonic()
+                self._received_size_metric.value += len(message)
+                await self.process_message(message)
+        except asyncio.CancelledError:
+            if self._handler_error is not None:
+                asyncio.current_task().uncancel()
+                raise self._handler_error
+            raise
+        finally:
+            self._connection_task = None
+            for task in list(self._handlers):
+                task.cancel()
+            if self.compression_stats.sent_raw or self.compression_stats.received_raw:
+                self.logger.info(f"Compression: {self.compression_stats.summary()}")
+            if self.recorder is not None:
+                self.recorder.flush()
+
     async def run(self):
+        # the server picks one of the offered codecs, or none for the plain JSON format
+        subprotocols = ws_defs.offered_subprotocols(PROTOCOL_CONFIG.get("codecs", []))
         try:
             async with websockets.connect(
-                WS_URL + "?license_key=" + license_key,
+                WS_URL + "?license_key=" + self.license_key,
                 ping_timeout=600 if IS_DEBUG else 20,
-            ) as self.ws:
-                self.ws: websockets.WebSocketClientProtocol
-                while True:
-                    message = await self.ws.recv()
-                    await self.process_message(message)
+                subprotocols=subprotocols or None,
+                compression=None,
+                extensions=ws_compression.client_extensions(
+                    WEBSOCKET_CONFIG.get("compression") or {}, self.compression_stats
+                ),
+            ) as ws:
+                await self.serve_connection(ws)
         except websockets.exceptions.InvalidStatusCode as e:
             if e.status_code == 400:
-                logger.error("Invalid or expired license key!")
-                logger.error("Неверный или просроченный ключ лицензии!")
-                exit_after_enter()
+                raise LicenseRejectedException(
+                    "Invalid or expired license key!\nНеверный или просроченный ключ лицензии!"
+                )
             elif e.status_code == 502:
                 raise ServerNotRunningException()
             else:
                 raise
 
+    async def run_forever(self):
+        """Keeps the connection up, reconnecting with exponential backoff and jitter."""
+        try:
+            reconnect_attempt = 0
+            while True:
+                self.connected_at = None
+                try:
+                    await self.run()
+                except KeyboardInterrupt:
+                    exit(0)
+                except websockets.exceptions.ConnectionClosedError:
+                    self.logger.error("Connection closed")
+                except ServerNotRunningException:
+                    self.logger.error("Server is not running")
+                except ConnectionRefusedError:
+                    self.logger.error("Connection refused")
+                except LicenseRejectedException as e:
+                    self.logger.error(str(e))
+                    if not SHARDS_CONFIG:
+                        exit_after_enter()
+                    # the other shards have their own licenses and keep running
+                    self.logger.error(f"Shard {self.name} stopped")
+                    return
+                except Exception as e:
+                    self.logger.exception(e)
+                    if not SHARDS_CONFIG:
+                        exit_after_enter()
+                    # one shard's failure doesn't take the others down, it reconnects
+                finally:
+                    self.disconnected_at = time.monotonic()
 
-async def main():
+                self.reconnects += 1
+                if self.connected_at is not None and time.monotonic() - self.connected_at >= (
+                    WEBSOCKET_CONFIG.get("stable_connection_sec", 60)
+                ):
+                    reconnect_attempt = 0
+                # so clients don't all come back at the same moment after a server restart
+                delay_cap = min(
+                    WEBSOCKET_CONFIG.get("reconnect_max_delay_sec", 120),
+                    WEBSOCKET_CONFIG.get("reconnect_base_delay_sec", 2)
+                    * 2 ** min(reconnect_attempt, 16),
+                )
+                delay = delay_cap / 2 + random.uniform(0, delay_cap / 2)
+                reconnect_attempt += 1
+                self.logger.info(f"Reconnecting in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+        finally:
+            # the recording spans reconnects, it is complete once the shard stops
+            if self.recorder is not None:
+                self.recorder.close()
+
+    def health(self) -> typing.Dict[str, typing.Any]:
+        now = time.monotonic()
+        connected = self.ws is not None and self._connection_task is not None
+        return {
+            "shard": self.name,
+            "connected": connected,
+            "accounts": len(self.accounts),
+            "registered": len(self._registered),
+            "reconnects": self.reconnects,
+            "handlers_in_flight": len(self._handlers),
+            "compression_sent_saved": self.compression_stats.sent_saved,
+            "compression_received_saved": self.compression_stats.received_saved,
+            "seconds_since_last_message": (
+                None if self.last_message_at is None else now - self.last_message_at
+            ),
+            "seconds_down": (
+                None
+                if connected or self.disconnected_at is None
+                else now - self.disconnected_at
+            ),
+        }
+
+
+def build_websocket_clients(
+    accounts: typing.List[NotCoinAccountClient],
+) -> typing.List[WebsocketClient]:
+    if not SHARDS_CONFIG:
+        return [WebsocketClient(accounts, license_key)]
+
+    by_name = {account.name: account for account in accounts}
+    shards = []
+    assigned = set()
+    for index, shard in enumerate(SHARDS_CONFIG):
+        name = shard.get("name") or f"shard{index}"
+        shard_accounts = []
+        for account_name in shard.get("accounts") or []:
+            if account_name not in by_name:
+                logger.warning(f"Shard {name}: account {account_name} not found")
+            elif account_name in assigned:
+                logger.warning(f"Shard {name}: account {account_name} is already in another shard")
+            else:
+                assigned.add(account_name)
+                shard_accounts.append(by_name[account_name])
+        shards.append((name, shard, shard_accounts))
+
+    unassigned = [account for account in accounts if account.name not in assigned]
+    if unassigned:
+        logger.warning(
+            f"Accounts not assigned to any shard, adding them to shard {shards[0][0]}: "
+            + ", ".join(account.name for account in unassigned)
+        )
+        shards[0][2].extend(unassigned)
+
+    clients = []
+    shard_of_license: typing.Dict[str, str] = {}
+    for name, shard, shard_accounts in shards:
+        if not shard_accounts:
+            logger.warning(f"Shard {name} has no accounts, not connecting it")
+            continue
+        shard_license = read_license(shard.get("license_file", "license.txt"))
+        if shard_license in shard_of_license:
+            # the server would take them for one client and keep disconnecting one of them
+            logger.error(
+                f"Shards {shard_of_license[shard_license]} and {name} use the same license, "
+                "every shard needs its own"
+            )
+            exit_after_enter()
+        shard_of_license[shard_license] = name
+        clients.append(WebsocketClient(shard_accounts, shard_license, name))
+    return clients
+
+
+async def monitor_shards(clients: typing.List[WebsocketClient]):
+    """Periodically logs the health of every shard."""
+    shard_logger = logger.getChild("shards")
+    while True:
+        await asyncio.sleep(WEBSOCKET_CONFIG.get("health_log_interval_sec", 60))
+        for health in (client.health() for client in clients):
+            if health["connected"]:
+                shard_logger.info(
+                    f"Shard {health['shard']}: connected, {health['registered']}/{health['accounts']} "
+                    f"registered, {health['handlers_in_flight']} requests in progress, "
+                    f"{health['reconnects']} reconnects"
+                )
+            else:
+                down = health["seconds_down"]
+                shard_logger.warning(
+                    f"Shard {health['shard']}: disconnected"
+                    + (f" for {down:.0f}s" if down is not None else "")
+                    + f", {health['reconnects']} reconnects"
+                )
+
+
+async def start_diagnostics(
+    clients: typing.List[WebsocketClient],
+    accounts: typing.List[typing.Union[NotCoinAccountClient, "RemoteAccountClient"]],
+) -> typing.Optional[diagnostics_http.DiagnosticsServer]:
+    """
+    Serves `/metrics`, `/memory` and `/loop` on `diagnostics.http_port`, if set. Metrics of state that is kept anyway
+    (connections, queues) are registered here and read when scraped.
+    """
+    if not DIAGNOSTICS_CONFIG.get("http_port"):
+        return None
+
+    def per_shard(value: typing.Callable[[WebsocketClient], float]):
+        return lambda: {(client.name,): value(client) for client in clients}
+
+    metrics.Counter(
+        "notcoin_ws_reconnects_total", "Websocket reconnects", ["shard"],
+        function=per_shard(lambda client: client.reconnects),
+    )
+    metrics.Gauge(
+        "notcoin_ws_connected", "1 while the shard is connected", ["shard"],
+        function=per_shard(lambda client: int(client.health()["connected"])),
+    )
+    metrics.Gauge(
+        "notcoin_ws_registered_clients", "Clients the server has", ["shard"],
+        function=per_shard(lambda client: len(client._registered)),
+    )
+    metrics.Gauge(
+        "notcoin_ws_reloads_in_progress",
+        "Refresh requests from the server being processed or waiting for a handler slot",
+        ["shard"],
+        function=per_shard(lambda client: len(client._reloads_in_flight)),
+    )
+    metrics.Gauge(
+        "notcoin_ws_send_queue_length", "Messages waiting to be sent", ["shard"],
+        function=per_shard(
+            lambda client: client._send_queue.qsize() if client._send_queue is not None else 0
+        ),
+    )
+    # telegram clients of worker processes are not visible from here
+    local_accounts = [
+        account for account in accounts if isinstance(account, NotCoinAccountClient)
+    ]
+    metrics.Gauge(
+        "notcoin_telegram_connected", "1 while the account's telegram client is connected",
+        ["account"],
+        function=lambda: {
+            (account.name,): int(account.telegram_connected) for account in local_accounts
+        },
+    )
+    span_tracer = tracing.tracer()
+    if span_tracer is not None:
+        metrics.Counter(
+            "notcoin_trace_spans_written_total", "Spans written to the trace file",
+            function=lambda: {(): span_tracer.written},
+        )
+        metrics.Counter(
+            "notcoin_trace_spans_dropped_total", "Spans dropped because the writer fell behind",
+            function=lambda: {(): span_tracer.dropped},
+        )
+    if connection_pool is not None:
+        metrics.Gauge(
+            "notcoin_telegram_open_connections", "Open telegram connections (on_demand mode)",
+            function=lambda: {(): connection_pool.open_connections},
+        )
+
+    server = diagnostics_http.DiagnosticsServer(
+        DIAGNOSTICS_CONFIG.get("http_host", "127.0.0.1"), DIAGNOSTICS_CONFIG["http_port"]
+    )
+    server.add_route(
+        "/metrics", lambda: ("text/plain; version=0.0.4", metrics.REGISTRY.render())
+    )
+
+    async def memory_report():
+        # compared to the last periodic report, which stays the baseline of the next one
+        return "text/plain", await memory_profiler.report_in_executor(update=False)
+
+    server.add_route("/memory", memory_report)
+    if event_loop_monitor is not None:
+        server.add_route("/loop", lambda: ("text/plain", event_loop_monitor.report()))
+    await server.start()
+    return server
+
+
+def load_accounts() -> typing.List[NotCoinAccountClient]:
     accounts = []
     for file in os.listdir("configs"):
         with open("configs/" + file) as cnf_read:
@@ -421,39 +2079,74 @@ async def main():
             if name == "example":
                 continue
             accounts.append(NotCoinAccountClient(name, json.load(cnf_read)))
+    return accounts
 
+
+async def main():
+    # the event loop only keeps weak references to tasks
+    background_tasks = []
+    # started first, so stalls while authenticating (like drawing QR codes) are caught too
+    if event_loop_monitor is not None:
+        background_tasks.append(asyncio.ensure_future(event_loop_monitor.run()))
+
+    accounts = load_accounts()
     if len(accounts) == 0:
         logger.error("No accounts found")
         exit_after_enter()
 
     logger.info("Accounts found: " + ", ".join([account.name for account in accounts]))
-    logger.info("Authenticating...")
-    tasks = []
-    for account in accounts:
-        # await account.prepare_telegram_client()
-        tasks.append(account.prepare_telegram_client())
-    await execute_tasks_in_chunks(tasks, 5)
+    worker_pool = None
+    if WORKERS_CONFIG.get("processes", 0) > 0:
+        worker_pool = WorkerPool(
+            [account.name for account in accounts], WORKERS_CONFIG["processes"]
+        )
+        await worker_pool.start()
+        accounts = [
+            RemoteAccountClient(account, worker_pool) for account in accounts
+        ]
+    try:
+        logger.info("Authenticating...")
+        tasks = []
+        for account in accounts:
+            # await account.prepare_telegram_client()
+            tasks.append(account.prepare_telegram_client())
+        await execute_tasks_adaptive(
+            "authenticate", tasks, [account.name for account in accounts]
+        )
 
-    logger.info("Authenticated! Running websocket client...")
-    client = WebsocketClient(accounts)
-    while True:
-        try:
-            await client.run()
-        except KeyboardInterrupt:
-            exit(0)
-        except websockets.exceptions.ConnectionClosedError:
-            logger.error("Connection closed")
-        except ServerNotRunningException:
-            logger.error("Server is not running")
-        except ConnectionRefusedError:
-            logger.error("Connection refused")
-        except Exception as e:
-            logger.exception(e)
-            exit_after_enter()
+        if worker_pool is None:
+            background_tasks += start_account_background_tasks(accounts)
 
-        logger.info("Reconnecting in 5 seconds...")
-        await asyncio.sleep(5)
+        logger.info("Authenticated! Running websocket client...")
+        clients = build_websocket_clients(accounts)
+        if len(clients) > 1:
+            background_tasks.append(asyncio.ensure_future(monitor_shards(clients)))
+        memory_profiler.count_accounts = lambda: len(accounts)
+        memory_profiler.install_signal_handler(asyncio.get_running_loop())
+        background_tasks.append(asyncio.ensure_future(memory_profiler.run()))
+        diagnostics_server = await start_diagnostics(clients, accounts)
+        if sys.platform != "win32":
+            # unwinds like ctrl+c, so recordings, traces and sessions are closed properly
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, asyncio.current_task().cancel
+            )
+        # shards reconnect independently, one being down doesn't hold up the others
+        try:
+            await asyncio.gather(*[client.run_forever() for client in clients])
+        finally:
+            if diagnostics_server is not None:
+                await diagnostics_server.stop()
+    finally:
+        # also when authentication fails, so no worker or IPC task is left behind
+        if worker_pool is not None:
+            await worker_pool.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    finally:
+        if session_store is not None:
+            session_store.close()
+        if tracing.tracer() is not None:
+            tracing.tracer().close()
@@ -0,0 +1,298 @@
+"""
+Telethon session backends that keep every account in one SQLite database,
+instead of one `sessions/<name>.session` file (and file handle) per account.
+"""
+import datetime
+import json
+import os
+import sqlite3
+import typing
+
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
+from telethon.tl import types
+
+
+class SharedSessionStore:
+    """
+    A single WAL-mode database with the sessions of all accounts, keyed by account name.
+
+    With `write_through=True` every `session.save()` Telethon makes is committed right away
+    (like `SQLiteSession` does). With `write_through=False` sessions live in memory and
+    changed ones are written in one transaction whenever `flush()` is called. The same goes
+    for the per-account metadata the client keeps next to the session.
+    """
+
+    def __init__(self, path: str, write_through: bool = True):
+        self.path = path
+        self.write_through = write_through
+        self._dirty: typing.Dict[str, "AccountSession"] = {}
+        self._dirty_metadata: typing.Dict[str, dict] = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.execute("pragma synchronous=normal")
+        self._conn.executescript(
+            """
+            create table if not exists sessions (
+                account text primary key,
+                dc_id integer,
+                server_address text,
+                port integer,
+                auth_key blob,
+                takeout_id integer
+            );
+            create table if not exists entities (
+                account text,
+                id integer,
+                hash integer not null,
+                username text,
+                phone integer,
+                name text,
+                date integer,
+                primary key (account, id)
+            );
+            create table if not exists update_state (
+                account text,
+                id integer,
+                pts integer,
+                qts integer,
+                date integer,
+                seq integer,
+                primary key (account, id)
+            );
+            create table if not exists metadata (
+                account text primary key,
+                data text
+            );
+            """
+        )
+        self._conn.commit()
+
+    def load(self, session: "AccountSession"):
+        row = self._conn.execute(
+            "select dc_id, server_address, port, auth_key, takeout_id from sessions"
+            " where account = ?",
+            (session.account,),
+        ).fetchone()
+        if row:
+            (
+                session._dc_id,
+                session._server_address,
+                session._port,
+                key,
+                session._takeout_id,
+            ) = row
+            session._auth_key = AuthKey(data=key) if key else None
+
+        session._entities = set(
+            self._conn.execute(
+                "select id, hash, username, phone, name from entities where account = ?",
+                (session.account,),
+            ).fetchall()
+        )
+        for entity_id, pts, qts, date, seq in self._conn.execute(
+            "select id, pts, qts, date, seq from update_state where account = ?",
+            (session.account,),
+        ):
+            session._update_states[entity_id] = types.updates.State(
+                pts=pts,
+                qts=qts,
+                date=datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc),
+                seq=seq,
+                unread_count=0,
+            )
+        session._new_entities.clear()
+
+    def load_metadata(self, account: str) -> dict:
+        if account in self._dirty_metadata:
+            return dict(self._dirty_metadata[account])
+        row = self._conn.execute(
+            "select data from metadata where account = ?", (account,)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_metadata(self, account: str, metadata: dict):
+        if not self.write_through:
+            self._dirty_metadata[account] = dict(metadata)
+            return
+        with self._conn:
+            self._conn.execute(
+                "insert or replace into metadata values (?,?)", (account, json.dumps(metadata))
+            )
+
+    def mark_dirty(self, session: "AccountSession"):
+        self._dirty[session.account] = session
+
+    def write(self, sessions: typing.Iterable["AccountSession"]):
+        """Writes the given sessions in a single transaction."""
+        with self._conn:
+            for session in sessions:
+                self._conn.execute(
+                    "insert or replace into sessions values (?,?,?,?,?,?)",
+                    (
+                        session.account,
+                        session.dc_id,
+                        session.server_address,
+                        session.port,
+                        session.auth_key.key if session.auth_key else b"",
+                        session.takeout_id,
+                    ),
+                )
+                if session._new_entities:
+                    now = int(datetime.datetime.now().timestamp())
+                    self._conn.executemany(
+                        "insert or replace into entities values (?,?,?,?,?,?,?)",
+                        [
+                            (session.account, *row, now)
+                            for row in session._new_entities
+                        ],
+                    )
+                    session._new_entities.clear()
+                self._conn.executemany(
+                    "insert or replace into update_state values (?,?,?,?,?,?)",
+                    [
+                        (
+                            session.account,
+                            entity_id,
+                            state.pts,
+                            state.qts,
+                            state.date.timestamp(),
+                            state.seq,
+                        )
+                        for entity_id, state in session.get_update_states()
+                    ],
+                )
+                self._dirty.pop(session.account, None)
+
+    def flush(self) -> int:
+        """Writes every session changed since the last flush, returns how many were written."""
+        dirty = list(self._dirty.values())
+        if dirty:
+            self.write(dirty)
+        if self._dirty_metadata:
+            with self._conn:
+                self._conn.executemany(
+                    "insert or replace into metadata values (?,?)",
+                    [
+                        (account, json.dumps(metadata))
+                        for account, metadata in self._dirty_metadata.items()
+                    ],
+                )
+            self._dirty_metadata.clear()
+        return len(dirty)
+
+    def delete(self, account: str):
+        self._dirty.pop(account, None)
+        self._dirty_metadata.pop(account, None)
+        with self._conn:
+            for table in ("sessions", "entities", "update_state", "metadata"):
+                self._conn.execute(f"delete from {table} where account = ?", (account,))
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def import_sqlite_session(self, account: str, path: str):
+        """Copies a Telethon `.session` file into the store under `account`."""
+        source = sqlite3.connect(path)
+        try:
+            row = source.execute(
+                "select dc_id, server_address, port, auth_key, takeout_id from sessions"
+            ).fetchone()
+            entities = source.execute(
+                "select id, hash, username, phone, name, date from entities"
+            ).fetchall()
+            update_states = source.execute(
+                "select id, pts, qts, date, seq from update_state"
+            ).fetchall()
+        finally:
+            source.close()
+
+        with self._conn:
+            if row:
+                self._conn.execute(
+                    "insert or replace into sessions values (?,?,?,?,?,?)",
+                    (account, *row),
+                )
+            self._conn.executemany(
+                "insert or replace into entities values (?,?,?,?,?,?,?)",
+                [(account, *entity) for entity in entities],
+            )
+            self._conn.executemany(
+                "insert or replace into update_state values (?,?,?,?,?,?)",
+                [(account, *state) for state in update_states],
+            )
+
+    def import_metadata(self, account: str, path: str):
+        """Copies a client `.meta.json` file into the store under `account`."""
+        with open(path) as f:
+            metadata = json.load(f)
+        with self._conn:
+            self._conn.execute(
+                "insert or replace into metadata values (?,?)", (account, json.dumps(metadata))
+            )
+
+
+class AccountSession(MemorySession):
+    """In-memory Telethon session of one account, persisted through a `SharedSessionStore`."""
+
+    def __init__(self, store: SharedSessionStore, account: str):
+        super().__init__()
+        self.store = store
+        self.account = account
+        self._new_entities: typing.Set[tuple] = set()
+        store.load(self)
+
+    def _changed(self):
+        self.store.mark_dirty(self)
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._changed()
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._changed()
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._changed()
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        self._changed()
+
+    def process_entities(self, tlo):
+        rows = set(self._entities_to_rows(tlo)) - self._entities
+        if rows:
+            self._entities |= rows
+            self._new_entities |= rows
+            self._changed()
+
+    def save(self):
+        if self.store.write_through and self.account in self.store._dirty:
+            self.store.write([self])
+
+    def close(self):
+        self.save()
+
+    def delete(self):
+        self.store.delete(self.account)
+
+
+def open_store(backend: str, path: str) -> typing.Optional[SharedSessionStore]:
+    """
+    Returns the store for the `sessions.backend` setting: `"sqlite"` (Telethon's own file per
+    account, no store), `"shared"` (one database, written through) or `"memory"` (one database,
+    flushed in batches).
+    """
+    if backend == "sqlite":
+        return None
+    if backend not in ("shared", "memory"):
+        raise ValueError(f"Unknown session backend {backend}")
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return SharedSessionStore(path, write_through=backend == "shared")
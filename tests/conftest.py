@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(scope="session")
+def sandbox_dir(tmp_path_factory) -> str:
+    from mock import sandbox
+
+    return sandbox.create_sandbox(
+        3,
+        {"protocol": {"batch_frames": True, "config_profiles": True, "delta_reloads": True}},
+        directory=str(tmp_path_factory.mktemp("sandbox")),
+    )
+
+
+@pytest.fixture(scope="session")
+def client_module(sandbox_dir):
+    """
+    `notcoin_client` imported in a sandbox with fake telegram. It reads its configuration
+    on import and can only be imported once, so every test shares this one.
+    """
+    from mock import sandbox, telegram
+
+    cwd = os.getcwd()
+    try:
+        return sandbox.import_client(
+            sandbox_dir,
+            "ws://127.0.0.1:1",
+            telegram.FakeTelegramBackend(telegram.FakeTelegramSettings()),
+        )
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def in_sandbox(client_module, sandbox_dir, monkeypatch):
+    """`notcoin_client` for tests that use its files (accounts, sessions), which are relative paths."""
+    monkeypatch.chdir(sandbox_dir)
+    return client_module
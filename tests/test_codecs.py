@@ -0,0 +1,66 @@
+import pytest
+
+import ws_defs
+from benchmarks.bench_protocol import sample_data
+from ws_defs import codecs
+
+T = ws_defs.WsMessageTypes
+CODECS = sorted(codecs.available_codecs())
+
+
+def sample_message(message_type: T) -> ws_defs.WsMessage:
+    data_class = ws_defs.ws_defs.binds[message_type]
+    return ws_defs.WsMessage(message_type, sample_data(data_class) if data_class else None)
+
+
+@pytest.fixture(params=CODECS)
+def codec(request) -> codecs.WsCodec:
+    return codecs.available_codecs()[request.param]()
+
+
+@pytest.mark.parametrize("message_type", list(ws_defs.ws_defs.binds), ids=lambda t: t.name)
+def test_round_trip(codec, message_type):
+    message = sample_message(message_type)
+    decoded = codec.decode(codec.encode(message))
+    assert decoded.message_type == message.message_type
+    # compared as JSON, WsMessage (in MT_C_Batch) has no __eq__
+    assert decoded.to_json() == message.to_json()
+
+
+def test_legacy_codec_round_trip():
+    message = sample_message(T.MT_C_SentClients)
+    frame = codecs.LEGACY_CODEC.encode(message)
+    assert isinstance(frame, str)
+    assert codecs.LEGACY_CODEC.decode(frame).data == message.data
+
+
+def test_batch_of_encoded_frames(codec):
+    messages = [sample_message(T.MT_C_ClientRegistered), sample_message(T.MT_C_ActivateTurboBoost)]
+    batch = codec.decode(codec.encode_batch([codec.encode(m) for m in messages]))
+    assert batch.message_type == T.MT_C_Batch
+    assert [(m.message_type, m.data) for m in batch.data.messages] == [
+        (m.message_type, m.data) for m in messages
+    ]
+
+
+@pytest.mark.parametrize("fragment_size", [1, 200, 1 << 20])
+def test_fragments_form_the_same_frame(codec, fragment_size):
+    message = sample_message(T.MT_C_SentClients)
+    fragments = list(codec.encode_fragments(message, fragment_size))
+    assert fragments[0][:0].join(fragments) == codec.encode(message)
+    if fragment_size == 1:
+        assert len(fragments) > 1
+
+
+def test_codec_for_subprotocol():
+    for name, factory in codecs.available_codecs().items():
+        assert codecs.codec_for_subprotocol(factory().subprotocol).name == name
+    assert codecs.codec_for_subprotocol(None) is codecs.LEGACY_CODEC
+    assert codecs.offered_subprotocols(["unknown", "json"]) == [codecs.JSON_SUBPROTOCOL]
+
+
+def test_msgpack_rejects_text_frames():
+    if "msgpack" not in CODECS:
+        pytest.skip("msgpack is not installed")
+    with pytest.raises(ValueError):
+        codecs.MsgpackCodec().decode('{"type":4}')
@@ -0,0 +1,55 @@
+import ws_defs
+
+CONFIGURATION = {"tap": True, "boosts": ["turbo"]}
+
+
+def make_client(**overrides) -> ws_defs.WsMessageDataSendClientsClient:
+    values = dict(
+        name="account0",
+        proxy="http://proxy",
+        web_app_data="query_id=1",
+        web_app_url="https://clicker",
+        configuration=CONFIGURATION,
+        configuration_ref=None,
+    )
+    values.update(overrides)
+    return ws_defs.WsMessageDataSendClientsClient(**values)
+
+
+def test_delta_carries_only_changed_fields():
+    delta = make_client(web_app_data="query_id=2").delta_from(make_client())
+    assert delta == ws_defs.WsDataClientReloadedDelta("account0", web_app_data="query_id=2")
+    assert delta.to_json() == {"name": "account0", "web_app_data": "query_id=2"}
+
+
+def test_unchanged_client_gives_an_empty_delta():
+    assert make_client().delta_from(make_client()).to_json() == {"name": "account0"}
+
+
+def test_no_delta_when_a_field_becomes_empty():
+    assert make_client(proxy="").delta_from(make_client()) is None
+
+
+def test_no_delta_between_inline_configuration_and_profile():
+    profile = make_client().with_configuration_ref("abc")
+    assert profile.delta_from(make_client()) is None
+    assert make_client().delta_from(profile) is None
+    assert profile.delta_from(profile.with_configuration_ref("abc")).to_json() == {"name": "account0"}
+
+
+def test_configuration_ref():
+    client = make_client().with_configuration_ref("abc")
+    assert client.configuration is None
+    assert client.to_json() == {
+        "name": "account0",
+        "proxy": "http://proxy",
+        "web_app_data": "query_id=1",
+        "web_app_url": "https://clicker",
+        "configuration_ref": "abc",
+    }
+
+
+def test_content_hash_ignores_key_order():
+    reordered = make_client(configuration=dict(reversed(CONFIGURATION.items())))
+    assert reordered.content_hash() == make_client().content_hash()
+    assert make_client(proxy="other").content_hash() != make_client().content_hash()
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def scheduler(client_module):
+    return client_module.AdaptiveTaskScheduler(
+        "test", initial_concurrency=4, min_concurrency=1, max_concurrency=8, latency_floor=0.01
+    )
+
+
+def test_results_keep_order_and_limit_is_respected(scheduler):
+    in_flight = 0
+    peak = 0
+
+    async def task(i):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.001 * (i % 3))
+        in_flight -= 1
+        return i
+
+    assert asyncio.run(scheduler.run([task(i) for i in range(40)])) == list(range(40))
+    assert peak <= scheduler.max_concurrency
+
+
+def test_grows_after_a_window_of_successes(scheduler):
+    for _ in range(4):
+        scheduler._on_task_finished(0.01, failed=False)
+    assert scheduler.concurrency == 5
+    for _ in range(100):
+        scheduler._on_task_finished(0.01, failed=False)
+    assert scheduler.concurrency == scheduler.max_concurrency
+
+
+def test_halves_once_per_congestion(scheduler):
+    scheduler.concurrency = 8
+    scheduler._on_task_finished(0.01, failed=True)
+    assert scheduler.concurrency == 4
+    # the failures of tasks started under the old limit don't halve it again
+    scheduler._on_task_finished(0.01, failed=True)
+    assert scheduler.concurrency == 4
+    for _ in range(8):
+        scheduler._on_task_finished(0.01, failed=True)
+    assert scheduler.concurrency == 2
+    for _ in range(100):
+        scheduler._on_task_finished(0.01, failed=True)
+    assert scheduler.concurrency == scheduler.min_concurrency
+
+
+def test_slow_task_halves_but_fast_cache_hits_do_not(scheduler):
+    for _ in range(3):
+        scheduler._on_task_finished(0.00001, failed=False)
+    # slower than the average, but within slow_factor of the latency floor
+    scheduler._on_task_finished(0.02, failed=False)
+    assert scheduler.concurrency == 5
+    scheduler._on_task_finished(1.0, failed=False)
+    assert scheduler.concurrency == 2
+
+
+def test_return_exceptions(scheduler):
+    async def task(i):
+        if i == 2:
+            raise ValueError(i)
+        return i
+
+    results = asyncio.run(scheduler.run([task(i) for i in range(5)], return_exceptions=True))
+    assert results[:2] == [0, 1] and results[3:] == [3, 4]
+    assert isinstance(results[2], ValueError)
+
+
+def test_first_error_cancels_the_rest(scheduler):
+    started = []
+    cancelled = []
+
+    async def task(i):
+        started.append(i)
+        if i == 0:
+            raise ValueError(i)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(i)
+            raise
+
+    async def main():
+        with pytest.raises(ValueError):
+            await scheduler.run([task(i) for i in range(10)])
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert sorted(cancelled) == sorted(started[1:])
+    assert len(started) < 10
+
+
+def test_on_result(scheduler):
+    seen = []
+
+    async def task(i):
+        return i * 2
+
+    async def on_result(index, result):
+        seen.append((index, result))
+
+    asyncio.run(scheduler.run([task(i) for i in range(6)], on_result=on_result))
+    assert sorted(seen) == [(i, i * 2) for i in range(6)]
@@ -0,0 +1,98 @@
+import typing
+
+import pytest
+
+import ws_defs
+from ws_defs import Color  # generated code looks field types up by name in this module
+from ws_defs.schema import SomeWsData, WsSchemaError, ws_data
+
+
+@ws_data
+class Item(SomeWsData):
+    value: int
+
+
+@ws_data
+class Sample(SomeWsData):
+    name: str
+    color: Color
+    items: typing.List[Item]
+    nested: "Item"
+    note: typing.Optional[str]
+
+
+def make_sample(**overrides) -> Sample:
+    values = dict(name="a", color=ws_defs.Color.Red, items=[Item(1), Item(2)], nested=Item(3), note=None)
+    values.update(overrides)
+    return Sample(**values)
+
+
+def test_generated_class():
+    sample = make_sample()
+    assert Sample.__slots__ == ("name", "color", "items", "nested", "note")
+    assert not hasattr(sample, "__dict__")
+    assert [f.name for f in Sample.__ws_fields__] == list(Sample.__slots__)
+    assert [f.optional for f in Sample.__ws_fields__] == [False] * 4 + [True]
+    assert Sample("a", ws_defs.Color.Red, [], Item(0)).note is None
+    assert repr(Item(1)) == "Item(value=1)"
+
+
+def test_abstract_base():
+    with pytest.raises(TypeError):
+        SomeWsData()
+
+
+def test_to_json_and_back():
+    sample = make_sample(note="hello")
+    data = sample.to_json()
+    assert data == {
+        "name": "a",
+        "color": "red",
+        "items": [{"value": 1}, {"value": 2}],
+        "nested": {"value": 3},
+        "note": "hello",
+    }
+    assert Sample.from_json(data) == sample
+
+
+def test_empty_optional_fields_are_left_out():
+    data = make_sample().to_json()
+    assert "note" not in data
+    assert Sample.from_json(data).note is None
+    assert Sample.from_json(dict(data, note=None)).note is None
+
+
+@pytest.mark.parametrize(
+    "change, error",
+    [
+        ({"name": 1}, "Sample.name must be str"),
+        ({"color": "purple"}, "Sample.color is not a valid Color"),
+        ({"items": {}}, "Sample.items must be a list"),
+        ({"items": [{"value": "1"}]}, "Item.value must be int"),
+        ({"nested": []}, "Item must be an object"),
+    ],
+)
+def test_invalid_fields(change, error):
+    with pytest.raises(WsSchemaError, match=error):
+        Sample.from_json(dict(make_sample().to_json(), **change))
+
+
+def test_missing_field():
+    data = make_sample().to_json()
+    del data["name"]
+    with pytest.raises(WsSchemaError, match="Sample is missing"):
+        Sample.from_json(data)
+
+
+def test_message_with_unknown_type():
+    with pytest.raises(ValueError):
+        ws_defs.WsMessage.from_json({"type": 1000, "data": None})
+    with pytest.raises(ValueError):
+        ws_defs.WsMessage.from_json({"data": None})
+
+
+def test_null_formatting_is_accepted():
+    message = ws_defs.WsMessage.from_json(
+        {"type": ws_defs.WsMessageTypes.MT_S_LocaledMessage, "data": {"locale_key": "k", "formatting": None, "color": ""}}
+    )
+    assert message.data.formatting is None
@@ -0,0 +1,107 @@
+import datetime
+
+import pytest
+from telethon.crypto import AuthKey
+from telethon.sessions import SQLiteSession
+from telethon.tl import types
+
+import session_storage
+
+AUTH_KEY = AuthKey(b"k" * 256)
+STATE = types.updates.State(
+    pts=1, qts=2, date=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc), seq=3, unread_count=0
+)
+BOT = types.contacts.ResolvedPeer(
+    peer=types.PeerUser(5),
+    chats=[],
+    users=[types.User(id=5, access_hash=7, username="notcoin_bot", first_name="Notcoin")],
+)
+
+
+def fill(session: session_storage.AccountSession):
+    session.set_dc(2, "149.154.167.51", 443)
+    session.auth_key = AUTH_KEY
+    session.process_entities(BOT)
+    session.set_update_state(0, STATE)
+
+
+def assert_filled(session: session_storage.AccountSession):
+    assert (session.dc_id, session.server_address, session.port) == (2, "149.154.167.51", 443)
+    assert session.auth_key.key == AUTH_KEY.key
+    assert session.get_input_entity(5) == types.InputPeerUser(5, 7)
+    assert session.get_update_state(0) == STATE
+
+
+@pytest.fixture(params=["shared", "memory"])
+def store(request, tmp_path):
+    store = session_storage.open_store(request.param, str(tmp_path / "sessions" / "sessions.db"))
+    yield store
+    store.close()
+
+
+def reopen(store: session_storage.SharedSessionStore) -> session_storage.SharedSessionStore:
+    store.close()
+    return session_storage.SharedSessionStore(store.path, store.write_through)
+
+
+def test_open_store(tmp_path):
+    assert session_storage.open_store("sqlite", str(tmp_path / "sessions.db")) is None
+    with pytest.raises(ValueError):
+        session_storage.open_store("redis", str(tmp_path / "sessions.db"))
+
+
+def test_session_round_trip(store):
+    session = session_storage.AccountSession(store, "account0")
+    fill(session)
+    session.save()
+    store = reopen(store)
+    assert_filled(session_storage.AccountSession(store, "account0"))
+    assert session_storage.AccountSession(store, "account1").auth_key is None
+    store.close()
+
+
+def test_write_through_and_flush(store):
+    session = session_storage.AccountSession(store, "account0")
+    fill(session)
+    session.save()
+    # a second connection sees what has been committed so far
+    other = session_storage.SharedSessionStore(store.path)
+    assert (session_storage.AccountSession(other, "account0").auth_key is not None) == store.write_through
+    assert store.flush() == (0 if store.write_through else 1)
+    assert session_storage.AccountSession(other, "account0").auth_key is not None
+    assert store.flush() == 0
+    other.close()
+
+
+def test_metadata(store):
+    assert store.load_metadata("account0") == {}
+    store.save_metadata("account0", {"self_id": 1})
+    assert store.load_metadata("account0") == {"self_id": 1}
+    store = reopen(store)
+    assert store.load_metadata("account0") == {"self_id": 1}
+    store.close()
+
+
+def test_delete(store):
+    session = session_storage.AccountSession(store, "account0")
+    fill(session)
+    session.save()
+    store.save_metadata("account0", {"self_id": 1})
+    session.delete()
+    store = reopen(store)
+    assert session_storage.AccountSession(store, "account0").auth_key is None
+    assert store.load_metadata("account0") == {}
+    store.close()
+
+
+def test_import_sqlite_session(store, tmp_path):
+    legacy = SQLiteSession(str(tmp_path / "account0"))
+    legacy.set_dc(2, "149.154.167.51", 443)
+    legacy.auth_key = AUTH_KEY
+    legacy.process_entities(BOT)
+    legacy.set_update_state(0, STATE)
+    legacy.save()
+    legacy.close()
+
+    store.import_sqlite_session("account0", str(tmp_path / "account0.session"))
+    assert_filled(session_storage.AccountSession(store, "account0"))
@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+
+import pytest
+
+import ws_defs
+from ws_defs import codecs
+
+T = ws_defs.WsMessageTypes
+
+
+class FakeWebsocket:
+    """Keeps the frames sent to it; never receives anything."""
+
+    subprotocol = None
+
+    def __init__(self):
+        self.frames = []
+
+    async def send(self, frame):
+        if not isinstance(frame, (str, bytes)):
+            frame = "".join(frame)
+        self.frames.append(frame)
+
+    async def recv(self):
+        await asyncio.Event().wait()
+
+    def messages(self):
+        """The messages sent, with batches taken apart, and how many frames carried them."""
+        messages = []
+        for frame in self.frames:
+            message = codecs.LEGACY_CODEC.decode(frame)
+            if message.message_type == T.MT_C_Batch:
+                messages += message.data.messages
+            else:
+                messages.append(message)
+        return messages
+
+
+@pytest.fixture
+def connected(in_sandbox):
+    """Runs `test(client, websocket)` with a client serving a fake connection."""
+
+    def run(test):
+        async def main():
+            client = in_sandbox.WebsocketClient(in_sandbox.load_accounts(), "test")
+            ws = FakeWebsocket()
+            connection = asyncio.ensure_future(client.serve_connection(ws))
+            await asyncio.sleep(0)
+            try:
+                await test(client, ws)
+            finally:
+                connection.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await connection
+
+        asyncio.run(main())
+
+    return run
+
+
+async def written(client):
+    while not client._send_queue.empty() or client._unsent_clients:
+        await asyncio.sleep(0)
+
+
+def make_client(**overrides):
+    values = dict(
+        name="account0",
+        proxy="http://proxy",
+        web_app_data="query_id=1",
+        web_app_url="https://clicker",
+        configuration={"tap": True},
+        configuration_ref=None,
+    )
+    values.update(overrides)
+    return ws_defs.WsMessageDataSendClientsClient(**values)
+
+
+def test_queued_messages_are_batched(connected):
+    async def test(client, ws):
+        for name in ("account0", "account1", "account2"):
+            await client.send_message(
+                T.MT_C_ActivateTurboBoost, ws_defs.WsDataActivateTurboBoost(name)
+            )
+        await written(client)
+        assert len(ws.frames) == 1
+        assert [m.data.client_name for m in ws.messages()] == ["account0", "account1", "account2"]
+
+    connected(test)
+
+
+def test_large_messages_are_not_batched(connected):
+    async def test(client, ws):
+        await client.send_message(T.MT_C_ActivateTurboBoost, ws_defs.WsDataActivateTurboBoost("a"))
+        await client.send_message(T.MT_C_ActivateTurboBoost, ws_defs.WsDataActivateTurboBoost("a" * 2000))
+        await written(client)
+        assert [codecs.LEGACY_CODEC.decode(f).message_type for f in ws.frames] == [
+            T.MT_C_ActivateTurboBoost,
+            T.MT_C_ActivateTurboBoost,
+        ]
+
+    connected(test)
+
+
+def test_profiles_and_delta_reloads(connected):
+    async def test(client, ws):
+        await client.send_reloaded_client(make_client())
+        await written(client)
+        profiles, full = ws.messages()
+        assert profiles.message_type == T.MT_C_ConfigProfiles
+        ((ref, configuration),) = profiles.data.profiles.items()
+        assert configuration == {"tap": True}
+        assert full.message_type == T.MT_C_ClientReloaded
+        assert full.data.configuration is None and full.data.configuration_ref == ref
+
+        # the profile is sent once per connection, the next reload is a delta
+        ws.frames.clear()
+        await client.send_reloaded_client(make_client(web_app_data="query_id=2"))
+        await written(client)
+        (delta,) = ws.messages()
+        assert delta.message_type == T.MT_C_ClientReloadedDelta
+        assert delta.data.to_json() == {"name": "account0", "web_app_data": "query_id=2"}
+
+        # a new configuration is a new profile, and still fits in a delta
+        ws.frames.clear()
+        await client.send_reloaded_client(make_client(configuration={"tap": False}))
+        await written(client)
+        profiles, delta = ws.messages()
+        assert profiles.data.profiles == {delta.data.configuration_ref: {"tap": False}}
+        assert delta.message_type == T.MT_C_ClientReloadedDelta
+
+    connected(test)
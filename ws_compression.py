@@ -0,0 +1,106 @@
+"""
+permessage-deflate settings for the connection to the server, and counters of how many bytes
+the compression saves in each direction.
+"""
+import typing
+
+from websockets import frames
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+
+
+class CompressionStats:
+    """Payload bytes of data frames before (`raw`) and after (`wire`) compression."""
+
+    def __init__(self):
+        self.sent_raw = 0
+        self.sent_wire = 0
+        self.received_raw = 0
+        self.received_wire = 0
+
+    @staticmethod
+    def _saved(raw: int, wire: int) -> typing.Optional[float]:
+        return 1 - wire / raw if raw else None
+
+    @property
+    def sent_saved(self) -> typing.Optional[float]:
+        return self._saved(self.sent_raw, self.sent_wire)
+
+    @property
+    def received_saved(self) -> typing.Optional[float]:
+        return self._saved(self.received_raw, self.received_wire)
+
+    def summary(self) -> str:
+        def direction(raw: int, wire: int) -> str:
+            saved = self._saved(raw, wire)
+            if saved is None:
+                return "nothing"
+            return f"{raw / 1024:.0f} KiB as {wire / 1024:.0f} KiB ({saved:.0%} saved)"
+
+        return (
+            f"sent {direction(self.sent_raw, self.sent_wire)}, "
+            f"received {direction(self.received_raw, self.received_wire)}"
+        )
+
+
+class CountingExtension(Extension):
+    """Wraps the negotiated extension and counts data frame sizes around it."""
+
+    def __init__(self, extension: Extension, stats: CompressionStats):
+        self.extension = extension
+        self.stats = stats
+        self.name = extension.name
+
+    def decode(self, frame: frames.Frame, *, max_size: typing.Optional[int] = None):
+        wire = len(frame.data)
+        frame = self.extension.decode(frame, max_size=max_size)
+        if frame.opcode not in frames.CTRL_OPCODES:
+            self.stats.received_wire += wire
+            self.stats.received_raw += len(frame.data)
+        return frame
+
+    def encode(self, frame: frames.Frame):
+        raw = len(frame.data)
+        frame = self.extension.encode(frame)
+        if frame.opcode not in frames.CTRL_OPCODES:
+            self.stats.sent_raw += raw
+            self.stats.sent_wire += len(frame.data)
+        return frame
+
+    def __repr__(self):
+        return f"CountingExtension({self.extension!r})"
+
+
+class CountingDeflateFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, stats: CompressionStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def process_response_params(self, params, accepted_extensions):
+        return CountingExtension(
+            super().process_response_params(params, accepted_extensions), self.stats
+        )
+
+
+def client_extensions(
+    settings: dict, stats: CompressionStats
+) -> typing.List[ClientPerMessageDeflateFactory]:
+    """
+    Extensions to pass to `websockets.connect` (with `compression=None`) for the
+    `websocket.compression` settings; an empty list turns compression off.
+    """
+    if not settings.get("enabled", True):
+        return []
+    compress_settings = {"memLevel": settings.get("mem_level", 5)}
+    if "level" in settings:
+        compress_settings["level"] = settings["level"]
+    return [
+        CountingDeflateFactory(
+            stats,
+            server_no_context_takeover=settings.get("server_no_context_takeover", False),
+            client_no_context_takeover=settings.get("client_no_context_takeover", False),
+            server_max_window_bits=settings.get("server_max_window_bits"),
+            client_max_window_bits=settings.get("client_max_window_bits", True),
+            compress_settings=compress_settings,
+        )
+    ]
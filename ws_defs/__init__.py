@@ -11,8 +11,24 @@ from .ws_defs import (
     WsMessageDataSendClientsClient,
     WsDataLocales,
     WsDataLocaledMessage,
+    WsDataRegistrationComplete,
+    WsDataBatch,
+    WsDataResumeClients,
+    WsDataResumeAccepted,
+    WsDataSentClientsChunk,
+    WsDataConfigProfiles,
+    WsDataClientReloadedDelta,
+    canonical_hash,
     Color,
 )
+from .schema import WsSchemaError, ws_data
+from .codecs import (
+    WsCodec,
+    JsonCodec,
+    MsgpackCodec,
+    offered_subprotocols,
+    codec_for_subprotocol,
+)
 
 __all__ = [
     "WsMessage",
@@ -27,5 +43,20 @@ __all__ = [
     "WsMessageDataSendClientsClient",
     "WsDataLocales",
     "WsDataLocaledMessage",
+    "WsDataRegistrationComplete",
+    "WsDataBatch",
+    "WsDataResumeClients",
+    "WsDataResumeAccepted",
+    "WsDataSentClientsChunk",
+    "WsDataConfigProfiles",
+    "WsDataClientReloadedDelta",
+    "canonical_hash",
     "Color",
+    "WsSchemaError",
+    "ws_data",
+    "WsCodec",
+    "JsonCodec",
+    "MsgpackCodec",
+    "offered_subprotocols",
+    "codec_for_subprotocol",
 ]
@@ -0,0 +1,53 @@
+"""
+Prints the message schema as JSON, to compare the client's protocol with the server's:
+
+    python -m ws_defs > schema.json
+"""
+import json
+import typing
+
+from .schema import SomeWsData
+from .ws_defs import binds
+
+
+def type_to_json(tp) -> typing.Any:
+    if isinstance(tp, typing.ForwardRef):
+        return tp.__forward_arg__
+    origin = typing.get_origin(tp)
+    if origin is not None:
+        return {origin.__name__: [type_to_json(arg) for arg in typing.get_args(tp)]}
+    if tp is typing.Any:
+        return "any"
+    if isinstance(tp, type) and issubclass(tp, SomeWsData):
+        return tp.__name__
+    if hasattr(tp, "__members__"):
+        return {tp.__name__: [member.value for member in tp]}
+    return tp.__name__
+
+
+def schema() -> dict:
+    classes = {}
+    messages = {}
+    pending = [data_class for data_class in binds.values() if data_class]
+    while pending:
+        data_class = pending.pop()
+        if data_class.__name__ in classes:
+            continue
+        classes[data_class.__name__] = {
+            field.name: {"type": type_to_json(field.type), "optional": field.optional}
+            for field in data_class.__ws_fields__
+        }
+        for field in data_class.__ws_fields__:
+            for tp in (field.type, *typing.get_args(field.type)):
+                if isinstance(tp, type) and issubclass(tp, SomeWsData):
+                    pending.append(tp)
+    for message_type, data_class in binds.items():
+        messages[message_type.name] = {
+            "type": int(message_type),
+            "data": data_class.__name__ if data_class else None,
+        }
+    return {"messages": messages, "data": dict(sorted(classes.items()))}
+
+
+if __name__ == "__main__":
+    print(json.dumps(schema(), indent=2))
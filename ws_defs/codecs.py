@@ -0,0 +1,188 @@
+import abc
+import json
+import typing
+
+from .ws_defs import WsMessage, WsMessageTypes
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+Frame = typing.Union[str, bytes]
+
+
+class WsCodec(abc.ABC):
+    """
+    Turns messages into websocket frames and back. Every codec goes through
+    `WsMessage.to_json`/`from_json`, so all message types in `binds` work with all codecs.
+    """
+
+    name: str  # short name used in the configuration
+    subprotocol: typing.Optional[str]  # websocket subprotocol, None for the legacy format
+
+    @abc.abstractmethod
+    def encode(self, message: WsMessage) -> Frame:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, frame: Frame) -> WsMessage:
+        pass
+
+    @abc.abstractmethod
+    def encode_batch(self, frames: typing.List[Frame]) -> Frame:
+        """Combines already encoded frames into one MT_C_Batch frame without decoding them."""
+        pass
+
+    @abc.abstractmethod
+    def _dump(self, value) -> Frame:
+        pass
+
+    @abc.abstractmethod
+    def _list_message_parts(
+        self, message_type: WsMessageTypes, field: str, count: int
+    ) -> typing.Tuple[Frame, Frame, Frame]:
+        """Prefix, item separator and suffix of a message whose data is a single list field."""
+        pass
+
+    def encode_fragments(self, message: WsMessage, fragment_size: int) -> typing.Iterator[Frame]:
+        """
+        Encodes a message whose data is a single list (like MT_C_SentClients) item by item,
+        yielding fragments of about `fragment_size` that together form the same message.
+        Only one fragment and the item being encoded are held in memory at a time.
+        """
+        (field,) = message.data.__ws_fields__
+        items = getattr(message.data, field.name)
+        prefix, separator, suffix = self._list_message_parts(
+            message.message_type, field.name, len(items)
+        )
+        buffer = [prefix]
+        size = len(prefix)
+        for index, item in enumerate(items):
+            if index:
+                buffer.append(separator)
+            piece = self._dump(item.to_json())
+            buffer.append(piece)
+            size += len(separator) + len(piece)
+            if size >= fragment_size:
+                yield prefix[:0].join(buffer)
+                buffer = []
+                size = 0
+        buffer.append(suffix)
+        yield prefix[:0].join(buffer)
+
+
+class JsonCodec(WsCodec):
+    """Text frames with JSON, the format the server has always spoken. Uses orjson when installed."""
+
+    name = "json"
+
+    def __init__(self, subprotocol: typing.Optional[str] = None):
+        self.subprotocol = subprotocol
+
+    if orjson is not None:
+
+        def _dump(self, value) -> Frame:
+            return orjson.dumps(value).decode()
+
+        def decode(self, frame: Frame) -> WsMessage:
+            return WsMessage.from_json(orjson.loads(frame))
+
+    else:
+
+        def _dump(self, value) -> Frame:
+            return json.dumps(value, separators=(",", ":"))
+
+        def decode(self, frame: Frame) -> WsMessage:
+            return WsMessage.from_json(json.loads(frame))
+
+    def encode(self, message: WsMessage) -> Frame:
+        return self._dump(message.to_json())
+
+    def _list_message_parts(
+        self, message_type: WsMessageTypes, field: str, count: int
+    ) -> typing.Tuple[Frame, Frame, Frame]:
+        return '{"type":%d,"data":{"%s":[' % (message_type, field), ",", "]}}"
+
+    def encode_batch(self, frames: typing.List[Frame]) -> Frame:
+        prefix, separator, suffix = self._list_message_parts(
+            WsMessageTypes.MT_C_Batch, "messages", len(frames)
+        )
+        return prefix + separator.join(frames) + suffix
+
+
+class MsgpackCodec(WsCodec):
+    """Binary frames with msgpack, smaller and faster to parse than JSON for the client lists."""
+
+    name = "msgpack"
+    subprotocol = "notcoin.msgpack.v1"
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed")
+        self._packer = msgpack.Packer()
+
+    def _dump(self, value) -> Frame:
+        return self._packer.pack(value)
+
+    def encode(self, message: WsMessage) -> Frame:
+        return self._packer.pack(message.to_json())
+
+    def decode(self, frame: Frame) -> WsMessage:
+        if isinstance(frame, str):
+            raise ValueError("msgpack codec received a text frame")
+        return WsMessage.from_json(msgpack.unpackb(frame))
+
+    def encode_batch(self, frames: typing.List[Frame]) -> Frame:
+        prefix, _, _ = self._list_message_parts(
+            WsMessageTypes.MT_C_Batch, "messages", len(frames)
+        )
+        return b"".join((prefix, *frames))
+
+    def _list_message_parts(
+        self, message_type: WsMessageTypes, field: str, count: int
+    ) -> typing.Tuple[Frame, Frame, Frame]:
+        prefix = b"".join(
+            (
+                self._packer.pack_map_header(2),
+                self._packer.pack("type"),
+                self._packer.pack(int(message_type)),
+                self._packer.pack("data"),
+                self._packer.pack_map_header(1),
+                self._packer.pack(field),
+                self._packer.pack_array_header(count),
+            )
+        )
+        return prefix, b"", b""
+
+
+JSON_SUBPROTOCOL = "notcoin.json.v1"
+LEGACY_CODEC = JsonCodec()
+
+
+def available_codecs() -> typing.Dict[str, typing.Callable[[], WsCodec]]:
+    codecs = {"json": lambda: JsonCodec(JSON_SUBPROTOCOL)}
+    if msgpack is not None:
+        codecs["msgpack"] = MsgpackCodec
+    return codecs
+
+
+def offered_subprotocols(preferred: typing.List[str]) -> typing.List[str]:
+    """Subprotocols to offer in the handshake, in order of preference, skipping unavailable codecs."""
+    codecs = available_codecs()
+    return [codecs[name]().subprotocol for name in preferred if name in codecs]
+
+
+def codec_for_subprotocol(subprotocol: typing.Optional[str]) -> WsCodec:
+    """The codec for the subprotocol the server picked; the legacy JSON format if it picked none."""
+    for factory in available_codecs().values():
+        codec = factory()
+        if codec.subprotocol == subprotocol:
+            return codec
+    return LEGACY_CODEC
@@ -0,0 +1,147 @@
+"""
+A compact binary log of the frames of websocket connections, for replaying them later
+(`python -m mock.replay`). Files ending in `.gz` are gzip-compressed.
+
+Layout: the magic, then records of `<d B B I` (seconds since the recording started,
+direction, flags, payload length) followed by the payload. The first record holds the
+client's settings, so a replay can run the same code paths.
+"""
+import asyncio
+import atexit
+import enum
+import gzip
+import json
+import struct
+import time
+import typing
+
+MAGIC = b"NCWSREC1"
+_RECORD = struct.Struct("<dBBI")
+
+FLAG_BINARY = 1
+FLAG_FRAGMENT = 2  # a fragment of a message, more fragments of it follow
+
+FLUSH_INTERVAL = 1.0  # seconds a recorded frame may wait in the buffer
+
+
+class Direction(enum.IntEnum):
+    Connected = 0  # a new connection, the payload is the negotiated subprotocol
+    Inbound = 1
+    Outbound = 2
+    Settings = 3  # the recording client's protocol and websocket settings, as JSON
+
+
+class RecordedFrame(typing.NamedTuple):
+    time: float
+    direction: Direction
+    flags: int
+    payload: bytes
+
+    @property
+    def frame(self) -> typing.Union[str, bytes]:
+        """The payload as websockets delivers it: bytes for binary frames, str for text."""
+        return self.payload if self.flags & FLAG_BINARY else self.payload.decode()
+
+
+def _open(path: str, mode: str) -> typing.BinaryIO:
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+class FrameRecorder:
+    def __init__(self, path: str, settings: typing.Optional[dict] = None):
+        self.path = path
+        self._file = _open(path, "wb")
+        self._file.write(MAGIC)
+        self._started = self._flushed_at = time.monotonic()
+        self._flush_timer: typing.Optional[asyncio.TimerHandle] = None
+        # a gzip file without its trailer can only be read up to the last flush
+        atexit.register(self.close)
+        self._write(Direction.Settings, 0, json.dumps(settings or {}).encode())
+
+    def _write(self, direction: Direction, flags: int, payload: bytes):
+        now = time.monotonic()
+        self._file.write(_RECORD.pack(now - self._started, direction, flags, len(payload)))
+        self._file.write(payload)
+        # so a killed process loses at most about a second of the recording, also when
+        # nothing else is recorded after this frame
+        if now - self._flushed_at >= FLUSH_INTERVAL:
+            self.flush()
+        elif self._flush_timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self._flush_timer = loop.call_later(
+                FLUSH_INTERVAL - (now - self._flushed_at), self.flush
+            )
+
+    def connected(self, subprotocol: typing.Optional[str]):
+        self._write(Direction.Connected, 0, (subprotocol or "").encode())
+        self.flush()
+
+    def record(
+        self, direction: Direction, frame: typing.Union[str, bytes], fragment: bool = False
+    ):
+        flags = FLAG_FRAGMENT if fragment else 0
+        if isinstance(frame, str):
+            frame = frame.encode()
+        else:
+            flags |= FLAG_BINARY
+        self._write(direction, flags, frame)
+
+    def record_fragments(
+        self, direction: Direction, fragments: typing.Iterable[typing.Union[str, bytes]]
+    ) -> typing.Iterator[typing.Union[str, bytes]]:
+        """Passes the fragments of one message through, recording each of them."""
+        previous = None
+        for fragment in fragments:
+            if previous is not None:
+                self.record(direction, previous, fragment=True)
+            previous = fragment
+            yield fragment
+        if previous is not None:
+            self.record(direction, previous)
+
+    def flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._file.closed:
+            self._file.flush()
+            self._flushed_at = time.monotonic()
+
+    def close(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._file.close()
+        atexit.unregister(self.close)
+
+
+def read_frames(path: str) -> typing.Iterator[RecordedFrame]:
+    """The recorded frames in order; a recording cut off mid-record ends at the last full one."""
+    with _open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a frame recording")
+        while True:
+            try:
+                header = f.read(_RECORD.size)
+                if len(header) < _RECORD.size:
+                    return
+                at, direction, flags, length = _RECORD.unpack(header)
+                payload = f.read(length)
+            except EOFError:  # truncated gzip stream
+                return
+            if len(payload) < length:
+                return
+            yield RecordedFrame(at, Direction(direction), flags, payload)
+
+
+def recorded_settings(path: str) -> dict:
+    """The settings the recording client had, empty for recordings made without them."""
+    for frame in read_frames(path):
+        if frame.direction == Direction.Settings:
+            return json.loads(frame.payload)
+        break
+    return {}
@@ -0,0 +1,222 @@
+import abc
+import enum
+import sys
+import types
+import typing
+
+
+class WsSchemaError(ValueError):
+    """A received message doesn't match the schema of its type."""
+
+
+class SomeWsData(abc.ABC):
+    __slots__ = ()
+    __ws_fields__: typing.Tuple["WsField", ...] = ()
+
+    @abc.abstractmethod
+    def to_json(self):
+        return None
+
+    @classmethod
+    @abc.abstractmethod
+    def from_json(cls, data):
+        return None
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join(f"{f.name}={getattr(self, f.name)!r}" for f in self.__ws_fields__),
+        )
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(
+            getattr(self, f.name) == getattr(other, f.name) for f in self.__ws_fields__
+        )
+
+
+class WsField(typing.NamedTuple):
+    name: str
+    type: typing.Any
+    optional: bool  # may be missing; it is left out of the message when falsy
+
+
+_PRIMITIVES = (str, int, float, bool)
+
+
+def _unwrap_optional(tp) -> typing.Tuple[typing.Any, bool]:
+    if typing.get_origin(tp) is typing.Union:
+        args = [arg for arg in typing.get_args(tp) if arg is not type(None)]
+        if len(args) == 1 and len(typing.get_args(tp)) == 2:
+            return args[0], True
+    return tp, False
+
+
+def _type_name(tp) -> str:
+    """Name under which generated code refers to a type; forward references stay names."""
+    if isinstance(tp, typing.ForwardRef):
+        return tp.__forward_arg__
+    if isinstance(tp, str):
+        return tp
+    return tp.__name__
+
+
+def _is_nested(tp) -> bool:
+    return isinstance(tp, (typing.ForwardRef, str)) or (
+        isinstance(tp, type) and issubclass(tp, SomeWsData)
+    )
+
+
+def _decode_lines(tp, var: str, where: str) -> typing.List[str]:
+    """Code that checks `var` against `tp` and replaces it with the decoded value."""
+    origin = typing.get_origin(tp)
+    if tp is typing.Any:
+        return []
+    if tp in _PRIMITIVES:
+        return [
+            f"if type({var}) is not {tp.__name__}:",
+            f"    raise WsSchemaError('{where} must be {tp.__name__}, got ' + type({var}).__name__)",
+        ]
+    if tp is dict or origin is dict:
+        return [
+            f"if type({var}) is not dict:",
+            f"    raise WsSchemaError('{where} must be an object, got ' + type({var}).__name__)",
+        ]
+    if tp is list or origin is list:
+        (item,) = typing.get_args(tp) or (typing.Any,)
+        lines = [
+            f"if type({var}) is not list:",
+            f"    raise WsSchemaError('{where} must be a list, got ' + type({var}).__name__)",
+        ]
+        if _is_nested(item):
+            lines.append(f"{var} = [{_type_name(item)}.from_json(x) for x in {var}]")
+        elif item in _PRIMITIVES:
+            lines += [
+                f"for x in {var}:",
+                f"    if type(x) is not {item.__name__}:",
+                f"        raise WsSchemaError('{where} items must be {item.__name__}, got ' + type(x).__name__)",
+            ]
+        return lines
+    if isinstance(tp, type) and issubclass(tp, enum.Enum):
+        return [
+            "try:",
+            f"    {var} = {tp.__name__}({var})",
+            "except ValueError:",
+            f"    raise WsSchemaError('{where} is not a valid {tp.__name__}: ' + repr({var})) from None",
+        ]
+    if _is_nested(tp):
+        return [f"{var} = {_type_name(tp)}.from_json({var})"]
+    raise TypeError(f"{where}: unsupported type {tp!r}")
+
+
+def _encode_expr(tp, value: str) -> str:
+    origin = typing.get_origin(tp)
+    if tp is list or origin is list:
+        (item,) = typing.get_args(tp) or (typing.Any,)
+        if _is_nested(item):
+            return f"[x.to_json() for x in {value}]"
+        return value
+    if isinstance(tp, type) and issubclass(tp, enum.Enum):
+        return f"{value}.value"
+    if _is_nested(tp):
+        return f"{value}.to_json()"
+    return value
+
+
+def _compile(cls_name: str, source: str, module_globals: dict, name: str):
+    namespace = {}
+    exec(compile(source, f"<ws_data {cls_name}>", "exec"), {}, namespace)
+    function = namespace[name]
+    # bound to the defining module's globals, so names (including forward references)
+    # resolve there at call time without the module getting the generated names
+    return types.FunctionType(
+        function.__code__, module_globals, name, function.__defaults__
+    )
+
+
+def ws_data(cls):
+    """
+    Turns a class with annotated fields into a message data class: it gets `__slots__`,
+    an `__init__` taking the fields in order, and `to_json`/`from_json` generated for its
+    fields, with `from_json` validating types while it decodes. `Optional[...]` fields
+    may be null or missing, default to None when no required field follows them, and are
+    left out of `to_json` when falsy.
+    """
+    fields = []
+    for name, tp in cls.__dict__.get("__annotations__", {}).items():
+        tp, optional = _unwrap_optional(tp)
+        fields.append(WsField(name, tp, optional))
+
+    # generated code refers to types by name, so they (and WsSchemaError) must be
+    # importable names in the module that defines the class
+    globals_ = sys.modules[cls.__module__].__dict__
+
+    # only optional fields after the last required one can have a default
+    last_required = max((i for i, f in enumerate(fields) if not f.optional), default=-1)
+    init_args = ", ".join(
+        f"{f.name}=None" if f.optional and i > last_required else f.name
+        for i, f in enumerate(fields)
+    )
+    init_body = [f"    self.{f.name} = {f.name}" for f in fields] or ["    pass"]
+    init_src = f"def __init__(self, {init_args}):\n" + "\n".join(init_body)
+
+    to_json_lines = ["def to_json(self):"]
+    to_json_lines.append(
+        "    res = {"
+        + ", ".join(
+            f"{f.name!r}: {_encode_expr(f.type, 'self.' + f.name)}"
+            for f in fields
+            if not f.optional
+        )
+        + "}"
+    )
+    for f in fields:
+        if f.optional:
+            to_json_lines += [
+                f"    if self.{f.name}:",
+                f"        res[{f.name!r}] = {_encode_expr(f.type, 'self.' + f.name)}",
+            ]
+    to_json_lines.append("    return res")
+
+    from_json_lines = [
+        "def from_json(cls, data):",
+        "    if type(data) is not dict:",
+        f"        raise WsSchemaError('{cls.__name__} must be an object, got ' + type(data).__name__)",
+    ]
+    required = [f for f in fields if not f.optional]
+    if required:
+        from_json_lines += [
+            "    try:",
+            *[f"        f_{f.name} = data[{f.name!r}]" for f in required],
+            "    except KeyError as e:",
+            f"        raise WsSchemaError('{cls.__name__} is missing ' + str(e)) from None",
+        ]
+    for f in fields:
+        where = f"{cls.__name__}.{f.name}"
+        decode = _decode_lines(f.type, f"f_{f.name}", where)
+        if f.optional:
+            from_json_lines.append(f"    f_{f.name} = data.get({f.name!r})")
+            if decode:
+                from_json_lines.append(f"    if f_{f.name} is not None:")
+                from_json_lines += ["        " + line for line in decode]
+        else:
+            from_json_lines += ["    " + line for line in decode]
+    from_json_lines.append(
+        "    return cls(" + ", ".join(f"f_{f.name}" for f in fields) + ")"
+    )
+
+    body = dict(cls.__dict__)
+    body.pop("__dict__", None)
+    body.pop("__weakref__", None)
+    body["__slots__"] = tuple(f.name for f in fields)
+    body["__ws_fields__"] = tuple(fields)
+    body["__init__"] = _compile(cls.__name__, init_src, globals_, "__init__")
+    body["to_json"] = _compile(cls.__name__, "\n".join(to_json_lines), globals_, "to_json")
+    body["from_json"] = classmethod(
+        _compile(cls.__name__, "\n".join(from_json_lines), globals_, "from_json")
+    )
+    new_cls = type(cls)(cls.__name__, cls.__bases__, body)
+    new_cls.__qualname__ = cls.__qualname__
+    return new_cls
+
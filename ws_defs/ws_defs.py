@@ -1,7 +1,10 @@
-import abc
 import enum
+import hashlib
+import json
 import typing
 
+from .schema import SomeWsData, WsSchemaError, ws_data
+
 
 class WsMessageTypes(enum.IntEnum):
     """Enum for WebSocket message types."""
@@ -17,6 +20,14 @@ class WsMessageTypes(enum.IntEnum):
     MT_C_ActivateTurboBoost = 8  # activate turbo boost
     MT_S_LocaledMessage = 9  # send locale code and formatting params to client
     MS_S_Locales = 10  # send locales to client
+    MT_C_ClientRegistered = 11  # one client is ready (incremental registration)
+    MT_C_RegistrationComplete = 12  # incremental registration finished, lists failed clients
+    MT_C_Batch = 13  # several small client messages combined into one frame
+    MT_C_ResumeClients = 14  # after reconnecting, offer the clients registered before
+    MT_S_ResumeAccepted = 15  # resume accepted, lists clients that have to be refreshed
+    MT_C_ConfigProfiles = 16  # configurations referenced by hash from the clients sent after it
+    MT_C_ClientReloadedDelta = 17  # client reloaded, only the fields that changed
+    MT_C_SentClientsChunk = 18  # part of the response to MT_S_SendClients (chunked registration)
 
 
 colors = {"green": "\033[92m", "red": "\033[91m", "blue": "\033[94m", "": "\033[0m", "yellow": "\033[93m"}
@@ -34,180 +45,133 @@ class Color(enum.StrEnum):
         return color_reset + colors[self.value] + text + color_reset
 
 
-class SomeWsData(abc.ABC):
-    @abc.abstractmethod
-    def to_json(self):
-        return None
-
-    @classmethod
-    @abc.abstractmethod
-    def from_json(cls, data):
-        return None
-
-
+@ws_data
 class WsMessageDataSendClientsClient(SomeWsData):
     name: str
     proxy: str
     web_app_data: str
     web_app_url: str
     configuration: typing.Optional[dict]
+    configuration_ref: typing.Optional[str]  # hash of a profile from MT_C_ConfigProfiles
 
-    def __init__(
-        self,
-        name: str,
-        proxy: str,
-        web_app_data: str,
-        web_app_url: str,
-        configuration: typing.Optional[dict] = None,
-    ):
-        self.name = name
-        self.proxy = proxy
-        self.web_app_data = web_app_data
-        self.web_app_url = web_app_url
-        self.configuration = configuration
-
-    def to_json(self):
-        res = {
-            "name": self.name,
-            "proxy": self.proxy,
-            "web_app_data": self.web_app_data,
-            "web_app_url": self.web_app_url,
-        }
-        if self.configuration:
-            res["configuration"] = self.configuration
-        return res
+    def content_hash(self) -> str:
+        """sha256 of the canonical (sorted keys, compact) JSON form, used to resume a registration."""
+        return canonical_hash(self.to_json())
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(
-            name=data["name"],
-            proxy=data["proxy"],
-            web_app_data=data["web_app_data"],
-            web_app_url=data["web_app_url"],
-            configuration=data.get("configuration"),
+    def with_configuration_ref(self, ref: str) -> "WsMessageDataSendClientsClient":
+        """A copy that refers to its configuration by profile hash instead of carrying it."""
+        return WsMessageDataSendClientsClient(
+            self.name, self.proxy, self.web_app_data, self.web_app_url, None, ref
         )
 
-
+    def delta_from(
+        self, previous: "WsMessageDataSendClientsClient"
+    ) -> typing.Optional["WsDataClientReloadedDelta"]:
+        """
+        The fields that changed since `previous`, or None when a change can't be expressed
+        as a delta (a field became empty, or the configuration moved between inline and profile).
+        """
+        changed = {}
+        for field in WsDataClientReloadedDelta.__ws_fields__[1:]:
+            value = getattr(self, field.name)
+            if value != getattr(previous, field.name):
+                if not value:
+                    return None
+                changed[field.name] = value
+        if bool(self.configuration_ref) != bool(previous.configuration_ref):
+            return None
+        return WsDataClientReloadedDelta(self.name, **changed)
+
+
+def canonical_hash(data) -> str:
+    """sha256 of the canonical (sorted keys, compact) JSON form of `data`."""
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+@ws_data
 class WsDataErrorDisconnect(SomeWsData):
     message: str
 
-    def __init__(self, message: str):
-        self.message = message
-
-    def to_json(self):
-        return {"message": self.message}
-
-    @classmethod
-    def from_json(cls, data):
-        return cls(message=data["message"])
-
 
+@ws_data
 class WsDataPrint(SomeWsData):
     message: str
     color: Color
 
-    def __init__(self, message: str, color: Color):
-        self.message = message
-        self.color = color
-
-    def to_json(self):
-        return {"message": self.message, "color": self.color.value}
-
-    @classmethod
-    def from_json(cls, data):
-        return cls(message=data["message"], color=Color(data["color"]))
-
 
+@ws_data
 class WsDataSentClients(SomeWsData):
     clients: typing.List[WsMessageDataSendClientsClient]
 
-    def __init__(self, clients: typing.List[WsMessageDataSendClientsClient]):
-        self.clients = clients
-
-    def to_json(self):
-        return {"clients": [c.to_json() for c in self.clients]}
-
-    @classmethod
-    def from_json(cls, data):
-        return cls(
-            clients=[
-                WsMessageDataSendClientsClient.from_json(c) for c in data["clients"]
-            ]
-        )
-
 
+@ws_data
 class WsDataReloadClient(SomeWsData):
     client_name: str
 
-    def __init__(self, client_name: str):
-        self.client_name = client_name
-
-    def to_json(self):
-        return {"client_name": self.client_name}
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(client_name=data["client_name"])
+@ws_data
+class WsDataClientFullyStopped(SomeWsData):
+    client_name: str
 
 
-class WsDataClientFullyStopped(SomeWsData):
+@ws_data
+class WsDataActivateTurboBoost(SomeWsData):
     client_name: str
 
-    def __init__(self, client_name: str):
-        self.client_name = client_name
 
-    def to_json(self):
-        return {"client_name": self.client_name}
+@ws_data
+class WsDataLocaledMessage(SomeWsData):
+    locale_key: str
+    formatting: typing.Optional[typing.List[typing.Any]]  # null when there is nothing to format
+    color: Color
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(client_name=data["client_name"])
 
+@ws_data
+class WsDataLocales(SomeWsData):
+    locales: typing.Dict[str, typing.Dict[str, str]] # {"en": {"key": "value"}, "ru": {"key": "value"}}
 
-class WsDataActivateTurboBoost(SomeWsData):
-    client_name: str
 
-    def __init__(self, client_name: str):
-        self.client_name = client_name
+@ws_data
+class WsDataRegistrationComplete(SomeWsData):
+    failed: typing.List[str]
 
-    def to_json(self):
-        return {"client_name": self.client_name}
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(client_name=data["client_name"])
+@ws_data
+class WsDataBatch(SomeWsData):
+    messages: typing.List["WsMessage"]
 
 
-class WsDataLocaledMessage(SomeWsData):
-    locale_key: str
-    formatting: typing.List[typing.Any]
-    color: Color
+@ws_data
+class WsDataResumeClients(SomeWsData):
+    clients: typing.Dict[str, str]  # {"client name": "content hash"}
 
-    def __init__(self, locale_key: str, formatting: typing.List[typing.Any], color: Color):
-        self.locale_key = locale_key
-        self.formatting = formatting
-        self.color = color
 
-    def to_json(self):
-        return {"locale_key": self.locale_key, "formatting": self.formatting, "color": self.color.value}
+@ws_data
+class WsDataResumeAccepted(SomeWsData):
+    stale: typing.List[str]
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(locale_key=data["locale_key"], formatting=data["formatting"], color=Color(data["color"]))
 
+@ws_data
+class WsDataSentClientsChunk(SomeWsData):
+    clients: typing.List[WsMessageDataSendClientsClient]
+    last: bool  # the server has all clients once it gets this chunk
 
-class WsDataLocales(SomeWsData):
-    locales: typing.Dict[str, typing.Dict[str, str]] # {"en": {"key": "value"}, "ru": {"key": "value"}}
 
-    def __init__(self, locales: typing.Dict[str, typing.Dict[str, str]]):
-        self.locales = locales
+@ws_data
+class WsDataConfigProfiles(SomeWsData):
+    profiles: typing.Dict[str, dict]  # {"profile hash": configuration}
 
-    def to_json(self):
-        return {"locales": self.locales}
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(locales=data["locales"])
+@ws_data
+class WsDataClientReloadedDelta(SomeWsData):
+    name: str
+    proxy: typing.Optional[str]
+    web_app_data: typing.Optional[str]
+    web_app_url: typing.Optional[str]
+    configuration: typing.Optional[dict]
+    configuration_ref: typing.Optional[str]
 
 
 binds = {
@@ -217,19 +181,29 @@ binds = {
     WsMessageTypes.MT_S_ErrorDisconnect: WsDataErrorDisconnect,
     WsMessageTypes.MT_S_Print: WsDataPrint,
     WsMessageTypes.MT_S_ReloadClient: WsDataReloadClient,
-    WsMessageTypes.MT_C_ClientReloaded: None,
+    WsMessageTypes.MT_C_ClientReloaded: WsMessageDataSendClientsClient,
     WsMessageTypes.MT_S_ClientFullyStopped: WsDataClientFullyStopped,
     WsMessageTypes.MT_C_ActivateTurboBoost: WsDataActivateTurboBoost,
     WsMessageTypes.MS_S_Locales: WsDataLocales,
-    WsMessageTypes.MT_S_LocaledMessage: WsDataLocaledMessage
+    WsMessageTypes.MT_S_LocaledMessage: WsDataLocaledMessage,
+    WsMessageTypes.MT_C_ClientRegistered: WsMessageDataSendClientsClient,
+    WsMessageTypes.MT_C_RegistrationComplete: WsDataRegistrationComplete,
+    WsMessageTypes.MT_C_Batch: WsDataBatch,
+    WsMessageTypes.MT_C_ResumeClients: WsDataResumeClients,
+    WsMessageTypes.MT_S_ResumeAccepted: WsDataResumeAccepted,
+    WsMessageTypes.MT_C_ConfigProfiles: WsDataConfigProfiles,
+    WsMessageTypes.MT_C_ClientReloadedDelta: WsDataClientReloadedDelta,
+    WsMessageTypes.MT_C_SentClientsChunk: WsDataSentClientsChunk,
 }
 
 
 class WsMessage:
+    __slots__ = ("message_type", "data")
+
     message_type: WsMessageTypes
     data: typing.Optional[SomeWsData]
 
-    def __init__(self, message_type: WsMessageTypes, data: SomeWsData):
+    def __init__(self, message_type: WsMessageTypes, data: typing.Optional[SomeWsData]):
         self.message_type = message_type
         self.data = data
 
@@ -241,22 +215,30 @@ class WsMessage:
 
     @classmethod
     def from_json(cls, data):
-        if not isinstance(data, dict):
+        if type(data) is not dict:
             raise TypeError("data must be a dict")
 
-        if "type" not in data:
-            raise ValueError("data must contain message_type")
-
-        if data["type"] not in binds:
+        try:
+            message_type, decode = _decoders[data["type"]]
+        except KeyError:
+            if "type" not in data:
+                raise ValueError("data must contain message_type") from None
             raise ValueError(
                 f"data must contain valid message_type (got {data['type']})"
-            )
+            ) from None
+        except TypeError:  # unhashable type
+            raise ValueError(
+                f"data must contain valid message_type (got {data['type']})"
+            ) from None
 
-        data_some_ws_data = binds[data["type"]]
-        data_init = (
-            data_some_ws_data.from_json(data["data"]) if data_some_ws_data else None
-        )
-        return cls(
-            message_type=WsMessageTypes(data["type"]),
-            data=data_init,
-        )
+        return cls(message_type, decode(data["data"]) if decode else None)
+
+
+# message type value -> (type, data decoder), so decoding is a single lookup
+_decoders: typing.Dict[
+    int,
+    typing.Tuple[WsMessageTypes, typing.Optional[typing.Callable[[typing.Any], SomeWsData]]],
+] = {
+    int(message_type): (message_type, data_class.from_json if data_class else None)
+    for message_type, data_class in binds.items()
+}